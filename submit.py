@@ -6,6 +6,12 @@
 import sys, os
 from textwrap import dedent
 
+# raw_input was renamed in Python 3
+try:
+    raw_input
+except NameError:
+    raw_input = input
+
 # NOTE: This script deliberately does not contain calls to
 # non-standard library modules, and should remain one file long
 
@@ -49,9 +55,24 @@ def main():
     If list_limits is given on the command line, the job limits on the current
     host will be given, and the program will terminate.
 
+    Some tasks that are not submissions are run as a command given first:
+
+      submit.py drain [--help]    Submit the jobs waiting in the spool
+      submit.py watch [--help]    Follow the submitted jobs until they finish
+      submit.py ledger [--help]   Query and report on the submitted jobs
+      submit.py efficiency [--help]
+                                  Find the jobs that asked for too much
+      submit.py progress [--help] Follow the progress of the running jobs
+
     See man page for more info.
     '''
 
+    # Run a command instead of submitting if one was given
+    commands = {'drain': drain, 'watch': watch, 'ledger': ledger,
+                'efficiency': efficiency, 'progress': progress}
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        return commands[sys.argv[1]](sys.argv[2:])
+
    ## Determine the host file system and it's properties
    #host = determine_host(os.uname()[1])
     # get the fully qualified domain name and use that to determine host
@@ -59,7 +80,7 @@ def main():
     host = determine_host(socket.getfqdn())
 
     # Check arguments
-    from argparse import ArgumentParser, RawDescriptionHelpFormatter
+    from argparse import ArgumentParser, RawDescriptionHelpFormatter, SUPPRESS
     parser = ArgumentParser(description=dedent(main.__doc__),
                             formatter_class=RawDescriptionHelpFormatter,
                             prefix_chars='-+')
@@ -126,14 +147,89 @@ def main():
                        'job.', action='store_true', default=False)
     queue.add_argument('-ex', '--exact', help='Use exact node arrangement'
                        'on LionXF or LionXG.', action='store_true', default=False)
+    queue.add_argument('--array', help='Group compatible inputs (same '
+                       'program and resources) into job arrays instead of '
+                       'submitting one job per input.', action='store_true',
+                       default=False)
+    queue.add_argument('--array-limit', help='Maximum number of array tasks '
+                       'allowed to run at once.', type=int, metavar='N')
+    queue.add_argument('--array-size', help='Maximum number of tasks in one '
+                       'job array, %(default)i is default.', type=int,
+                       default=1000, metavar='N')
+    queue.add_argument('--pack', help='Run up to %(metavar)s compatible '
+                       'inputs concurrently inside one allocation instead of '
+                       'submitting one job per input.', type=int, metavar='N')
+    queue.add_argument('--pack-cores', help='The number of cores each packed '
+                       'input runs on.  Default is all of --ppn.', type=int,
+                       metavar='CORES')
+    queue.add_argument('--no-preflight', help='Submit the inputs without '
+                       'first checking them for errors that would make the '
+                       'job fail as soon as it starts.', dest='preflight',
+                       action='store_false', default=True)
+    queue.add_argument('--no-cache', help='Run the job even if an identical '
+                       'input has already been run to completion.',
+                       dest='cache', action='store_false', default=True)
+    queue.add_argument('--bind', help='How to place the MPI ranks: bound to '
+                       'cores packed onto the sockets, bound to sockets with '
+                       'the ranks spread over them, or not bound.  The '
+                       'default depends on the host and program.',
+                       choices=('cores', 'sockets', 'none'))
+    queue.add_argument('--threads', help='The OpenMP threads per MPI rank, '
+                       '%(default)i is default.  --ppn still counts cores, so '
+                       'each node runs PPN/%(metavar)s ranks.', type=int,
+                       default=1, metavar='N')
+    queue.add_argument('--grace', help='Ask SLURM for a warning %(metavar)s '
+                       'before the walltime runs out, so that the job can '
+                       'save its restart files and partial output, '
+                       '%(default)i is default.', type=int, default=300,
+                       metavar='SECONDS')
+    queue.add_argument('--chain', help='If the run is killed by the '
+                       'walltime or does not converge, submit a job that '
+                       'continues it from its restart files, up to '
+                       '%(metavar)s times.  Only Dalton can be continued.',
+                       type=int, default=0, metavar='N')
+    queue.add_argument('--bcast', help='Broadcast the input and restart '
+                       'files to node-local storage on every node of the '
+                       'job and run there, gathering the results from the '
+                       'first node at the end, instead of running in the '
+                       'shared scratch directory.  For ABINIT, NWChem and '
+                       'Dalton.', action='store_true', default=False)
+    queue.add_argument('--predict', help='Fill in a missing walltime and '
+                       'memory from past runs of similar inputs.',
+                       action='store_true', default=False)
+    queue.add_argument('--probe', help='Instead of running the inputs, run '
+                       'each for a few iterations on every --probe-cores '
+                       'core count to measure how it scales.  Later inputs '
+                       'of the program and a similar size are then run on '
+                       'the best core count unless -n or -p is given.',
+                       action='store_true', default=False)
+    queue.add_argument('--probe-cores', help='The core counts to probe, '
+                       '%(default)s is default.', nargs='+', type=int,
+                       default=[1, 4, 16, 64], metavar='CORES')
+    queue.add_argument('--spool', help='Put the jobs in the spool instead of '
+                       'submitting them; "submit.py drain" submits them at a '
+                       'steady rate.', action='store_true', default=False)
+    queue.add_argument('--dependency', help='Only start the job(s) once '
+                       'the given dependency is satisfied, e.g. '
+                       'afterok:1234:1235.')
+    queue.add_argument('--workflow', help='Submit the chained steps described '
+                       'in the workflow file %(metavar)s.  See run_workflow '
+                       'for the format.', metavar='FILE')
+    queue.add_argument('--step', help=SUPPRESS)
     queue.add_argument('-O', '--open', help='Use the open queue on ACI-b',
                         action='store_true', default=False)
     queue.add_argument('-A', '--allocation', help="Select allocation to submit to, "
                        "'a', 'e', or 'c'. Default is 'o', open queue;"
                        "'a' is our standard, paid allocation; "
                        "'e' is basic computing nodes, lxj18_e_g_bc_default; " 
-                       "'c' is another allocation of standard computing nodes, lxj18_c_t_sc_default;",
+                       "'c' is another allocation of standard computing nodes, lxj18_c_t_sc_default; "
+                       "'auto' picks the one expected to start the job soonest.",
                         type=str, default='o' )
+    queue.add_argument('--queue-snapshot', help='With -A auto, read the '
+                       'expected start times of the pending jobs from '
+                       '%(metavar)s, saved with squeue --start -h -o '
+                       '"%%a %%P %%S", instead of asking squeue.',
+                       metavar='FILE')
     # Options for jobs submitted on an interactive system
     inter = parser.add_argument_group('opts for interactive hosts',
                              'These have no effect on a queueing system')
@@ -145,6 +241,15 @@ def main():
     inter.add_argument('--nice', help='The niceness (0 to 20), '
                        '%(default)i is default.', default=19, type=int,
                        choices=range(21), metavar='NICE')
+    inter.add_argument('-j', '--jobs', help='Run up to %(metavar)s inputs at '
+                       'once, %(default)i is default.', default=1, type=int,
+                       metavar='N')
+    inter.add_argument('--cores', help='The number of cores the concurrent '
+                       'jobs may use in total.  Default is all cores.',
+                       type=int)
+    inter.add_argument('--maxmem', help='The memory (MB) the concurrent jobs '
+                       'may use in total.  Default is the available memory.',
+                       type=int)
     inter.add_argument('-q', '--quiet', action='store_true', default=False,
                        help='Do not print anything to screen.')
     args, subopts = parser.parse_known_args()
@@ -160,6 +265,10 @@ def main():
         args.exclusive[0] = int(args.exclusive[0])
         args.lexclusive = True
 
+    # A workflow brings its own inputs
+    if args.workflow:
+        args.input_files = []
+
     # Verify the options based on the host
     opts, input_files = host.verify_options(args)
 
@@ -170,8 +279,11 @@ def main():
             data = f.read()
         allocations = json.loads(data)
         args.allocation = args.allocation.lower()
+        # -A auto chooses the allocation of each job once its size is known
+        host.allocations = allocations
         try:
-            host.queue = allocations[args.allocation]
+            host.queue = None if args.allocation == 'auto' \
+                         else allocations[args.allocation]
         except KeyError:
             sys.exit("Unrecognized allocation. Current allocations available: " + ', '.join(list(allocations.keys())))
     except TypeError:
@@ -181,6 +293,52 @@ def main():
         if not host.local:
             sys.exit("You need to set the environment variable ALLOCATIONS and point it to the correct file")
 
+    # Submit a workflow, or one deferred step of a workflow from inside a job
+    if args.workflow and args.spool:
+        sys.exit('A workflow needs job IDs for its dependencies, so it '
+                 'cannot be spooled.')
+    if args.workflow:
+        run_workflow(args.workflow, host, opts, subopts, args.step)
+        return
+
+    # Check all inputs before any of them waits in the queue, keeping the
+    # submittables of those that passed
+    jobs = None
+    if args.preflight and host.submit_type == 'queue':
+        jobs = preflight_inputs(input_files, host, opts, subopts)
+    elif args.probe or args.array or args.pack or args.jobs > 1:
+        jobs = [determine_file_type(f, host, opts, subopts)
+                for f in input_files]
+        jobs = [j for j in jobs if j is not None]
+
+    # Measure the scaling of the inputs if requested
+    if args.probe:
+        if host.submit_type != 'queue':
+            sys.exit('Probing the scaling needs a queueing host.')
+        submit_probes(jobs, host, opts, subopts, args.probe_cores)
+        return
+
+    # Group the inputs into job arrays if requested
+    if args.array and host.submit_type == 'queue':
+        submit_arrays(jobs, args.array_size, args.array_limit)
+        return
+
+    # Pack the inputs into shared allocations if requested
+    if args.pack and host.submit_type == 'queue':
+        submit_packs(jobs, args.pack, args.pack_cores)
+        return
+
+    # Run several inputs at once on an interactive host if requested
+    if args.jobs > 1 and host.submit_type == 'interactive':
+        run_local(jobs, args.jobs, args.cores, args.maxmem)
+        return
+
+    # Submit the inputs that were already checked
+    if jobs is not None:
+        for job in jobs:
+            job.submit()
+        return
+
     # Loop over files, submitting each one
     for f in input_files:
 
@@ -231,6 +389,7 @@ def determine_file_type(input_file, host, opts, subopts):
                     'nw'  : 'nwchem', 'dal': 'dalton',
                     'g09' : 'gaussian', 'qchem' : 'qchem',
                     'in'  : 'abinit', 'dim': 'dim',
+                    'sh'  : 'shell',
                     'script' : None,
                   }[os.path.splitext(input_file)[1][1:]]
     except KeyError:
@@ -275,10 +434,2125 @@ def determine_file_type(input_file, host, opts, subopts):
         return Gaussian(input_file, host, opts, subopts)
     elif program == 'dim':
         return DIM(input_file, host, opts, subopts)
+    elif program == 'shell':
+        return Shell(input_file, host, opts, subopts)
     elif program is None:
         return PBSScript(input_file, host, opts, subopts)
 
 
+def preflight_inputs(files, host, opts, subopts, threads=8):
+    '''Run the pre-flight checks of all inputs at once and return the
+    submittables of those that passed, reporting the problems of the
+    others.  The checks mostly wait on the filesystem or on a syntax
+    checker, so they run in threads.'''
+    from concurrent.futures import ThreadPoolExecutor
+
+    jobs = []
+    for f in files:
+        try:
+            jobs.append((f, determine_file_type(f, host, opts, subopts)))
+        except SystemExit as e:
+            jobs.append((f, str(e)))
+
+    def check(job):
+        if job is None:
+            return []
+        if not isinstance(job, Submittable):
+            return [job]
+        try:
+            return job.preflight()
+        except (IOError, OSError) as e:
+            return [str(e)]
+
+    with ThreadPoolExecutor(threads) as pool:
+        problems = list(pool.map(check, [job for f, job in jobs]))
+    passed = []
+    for (f, job), found in zip(jobs, problems):
+        if found:
+            print('Pre-flight check of {0} failed:'.format(f), file=sys.stderr)
+            for problem in found:
+                print('   ', problem.replace('\n', '\n    '), file=sys.stderr)
+        elif job is not None:
+            passed.append(job)
+    failed = sum(1 for found in problems if found)
+    if failed:
+        print('Skipping {0:d} input(s); use --no-preflight to submit them '
+              'anyway.'.format(failed), file=sys.stderr)
+    return passed
+
+
+def group_jobs(jobs):
+    '''Group submittables that can share one scheduler request, i.e. those
+    with the same program and the same requested resources.  Resources are
+    requested once for the first input and then reused for every other input
+    that did not specify them.  Returns a dictionary of resources to jobs.'''
+    from collections import OrderedDict
+    groups = OrderedDict()
+    answers = None
+    for job in jobs:
+        # Skip inputs whose results can be reused
+        job.edit_input()
+        if job.from_cache():
+            continue
+        if answers is not None:
+            job.nodes = job.nodes if job.nodes else answers[0]
+            job.ppn   = job.ppn   if job.ppn   else answers[1]
+            job.wall  = job.wall  if job.wall  else answers[2]
+            job.mem   = job.mem   if job.mem   else answers[3]
+        nodes, ppn, wall, mem = job.request_resources()
+        if answers is None:
+            answers = nodes, ppn, job.host.td2hms(wall), mem
+        key = (type(job), nodes, ppn, wall, mem, job.lexclusive)
+        groups.setdefault(key, []).append(job)
+    return groups
+
+
+def write_driver(first, script, resources, errfile, body, directives=()):
+    '''Write a bash job script that runs other job scripts, using the
+    queue directives of the first submittable plus any extra directives.'''
+    from os import chmod
+    nodes, ppn, wall, mem = resources
+    with open(script, 'w') as sc:
+        if first.host.queue_type == 'PBS':
+            first.write_PBS_header(sc, nodes, ppn, wall, mem,
+                                   errfile=errfile, shell='bash')
+        else:
+            first.write_SBATCH_header(sc, nodes, ppn, wall, mem,
+                                      errfile=errfile, shell='bash')
+        for directive in directives:
+            print(directive, file=sc)
+        print(body.rstrip(), file=sc)
+    chmod(script, 0o755)
+
+
+def submit_driver(jobs, script, what, resources, kind):
+    '''Submit a driver script written by write_driver for jobs, or tell the
+    user how to if only the script was requested.  Returns the job ID.'''
+    from os.path import relpath
+    first = jobs[0]
+    command = first.queue_command(script, first.jobname())
+    if not first.script:
+        print('Submitting {0} {1} {2}...'.format(type(first).__name__, what,
+                                                 relpath(script)))
+        record = job_record(jobs, script, command, resources, kind)
+        jobid = queue_send(command, first.spool, record,
+                           retry=not first.workflow)
+        print()
+        return jobid
+    else:
+        print('Wrote {0} {1} script {2}...'.format(type(first).__name__, what,
+                                                   relpath(script)))
+        print('Submit with "{0}"'.format(' '.join(command)))
+        print()
+
+
+def submit_arrays(jobs, size, limit=None):
+    '''Submit a list of submittables as job arrays.  Inputs are grouped by
+    program and requested resources, each input gets its own script as usual,
+    and one array script runs the script listed in a manifest for each task.
+    Job scripts given as inputs are submitted as they are.  Returns the job
+    IDs.'''
+    jobids = [j.submit() for j in jobs if isinstance(j, PBSScript)]
+    jobs = [j for j in jobs if not isinstance(j, PBSScript)]
+    for key, members in group_jobs(jobs).items():
+        for start in range(0, len(members), size):
+            chunk = members[start:start+size]
+            if len(chunk) == 1:
+                jobids.append(chunk[0].submit_queue(key[1:5]))
+            else:
+                jobids.append(submit_array(chunk, key[1:5], limit))
+    return jobids
+
+
+def submit_array(jobs, resources, limit=None):
+    '''Write the member scripts, manifest and array script for a group of
+    compatible submittables and submit the array.'''
+    from os.path import join
+    first = jobs[0]
+
+    # Name the array after the first input
+    name = '{0}.array.{1}'.format(first.noext['base'], len(jobs))
+    name = join(first.path, name)
+    manifest = name + '.manifest'
+
+    # The array runs in one allocation, chosen from the size of a task
+    first.pick_allocation(resources, jobs[1:])
+
+    # Write one script per input, exactly as for a single job
+    with open(manifest, 'w') as mf:
+        for i, job in enumerate(jobs):
+            member = job.write_script(*resources)
+            print(i, member, job.input['full'], sep='\t', file=mf)
+
+    # The array task looks up its script in the manifest and runs it
+    last = len(jobs) - 1
+    throttle = '%{0:d}'.format(limit) if limit else ''
+    if first.host.queue_type == 'PBS':
+        # PBS does not expand the task index in #PBS -e, so each task
+        # sends its output to its own file itself, as %a does on SLURM
+        taskid, errfile = '$PBS_ARRAYID', name+'.err'
+        array = '#PBS -t 0-{0:d}{1}'.format(last, throttle)
+        redirect = 'exec >> {0}.{1}.err 2>&1\n'.format(name, taskid)
+    else:
+        taskid, errfile = '$SLURM_ARRAY_TASK_ID', name+'.%a.err'
+        array = '#SBATCH --array=0-{0:d}{1}'.format(last, throttle)
+        redirect = ''
+    body = dedent('''\
+      {redirect}# Manifest of array task index, script and input:
+      #   {manifest}
+      SCRIPT=$(awk -F'\t' -v i={taskid} '$1 == i {{print $2}}' {manifest})
+      cd "$(dirname "$SCRIPT")"
+      # Pass on the walltime warning so the task can save its restart files
+      trap 'kill -USR1 $! 2>/dev/null; wait $!' USR1 TERM
+      "$SCRIPT" &
+      wait $!
+      ''').format(manifest=manifest, taskid=taskid, redirect=redirect)
+    write_driver(first, name+'.script', resources, errfile, body, [array])
+    return submit_driver(jobs, name+'.script',
+                         'array of {0:d} jobs'.format(len(jobs)), resources,
+                         'array')
+
+
+def submit_packs(jobs, per, cores=None):
+    '''Submit a list of submittables packed into shared allocations.  Inputs
+    are grouped as for job arrays, then bin-packed by input size into
+    allocations of at most per inputs, longest first onto the least loaded
+    allocation.  Job scripts given as inputs are submitted as they are.
+    Returns the job IDs.'''
+    from os.path import getsize
+    jobids = [j.submit() for j in jobs if isinstance(j, PBSScript)]
+    jobs = [j for j in jobs if not isinstance(j, PBSScript)]
+    for key, members in group_jobs(jobs).items():
+        nbins = -(-len(members) // per)
+        bins = [[] for _ in range(nbins)]
+        loads = [0] * nbins
+        members = sorted(members, key=lambda j: getsize(j.input['full']),
+                         reverse=True)
+        for job in members:
+            open_bins = [b for b in range(nbins) if len(bins[b]) < per]
+            b = min(open_bins, key=lambda b: loads[b])
+            bins[b].append(job)
+            loads[b] += getsize(job.input['full'])
+        for chunk in bins:
+            if len(chunk) == 1:
+                jobids.append(chunk[0].submit_queue(key[1:5]))
+            else:
+                jobids.append(submit_pack(chunk, key[1:5], cores))
+    return jobids
+
+
+def submit_pack(jobs, resources, cores=None):
+    '''Write the member scripts and a worker-pool script that runs them
+    concurrently inside one allocation, then submit it.'''
+    from os.path import join
+    first = jobs[0]
+    nodes, ppn, wall, mem = resources
+
+    # Work out how many members fit into the allocation at once
+    if ppn < 1: ppn = first.host.maxppn
+    cores = cores if cores else ppn
+    slots = max(1, (nodes * ppn) // cores)
+
+    # The pack is one job, so its allocation is chosen from its full size
+    first.pick_allocation(resources, jobs[1:])
+
+    # Each member is written for its own share of the allocation
+    name = '{0}.pack.{1}'.format(first.noext['base'], len(jobs))
+    name = join(first.path, name)
+    members = [job.write_script(*resources, pp=cores) for job in jobs]
+
+    # The members start their own MPI launchers, so they run as background
+    # workers rather than as srun job steps.  On SLURM the inner srun is
+    # limited to the member's share of the tasks.
+    if first.host.queue_type == 'SBATCH':
+        limit = 'export SLURM_NTASKS={0:d} SLURM_EXACT=1'.format(cores)
+    else:
+        limit = ''
+    body = dedent('''\
+      # Packed {njobs:d} jobs, {slots:d} at a time with {cores:d} cores each
+      export OMP_NUM_THREADS={threads:d}
+      {limit}
+
+      run_member() {{
+          trap 'kill -USR1 $! 2>/dev/null; wait $!' USR1 TERM
+          cd "$(dirname "$1")" || return
+          "$1" &
+          wait $!
+          rc=$?
+          echo "$(date '+%F %T') finished $1 with status $rc" >> {log}
+      }}
+
+      # Pass on the walltime warning so the members can save their restart
+      # files
+      trap 'STOP=1; kill -USR1 $(jobs -rp) 2>/dev/null; wait' USR1 TERM
+
+      for SCRIPT in {members}; do
+          while [ $(jobs -rp | wc -l) -ge {slots:d} ]; do
+              wait -n
+          done
+          [ -n "$STOP" ] && break
+          echo "$(date '+%F %T') started $SCRIPT" >> {log}
+          run_member "$SCRIPT" &
+      done
+      wait
+      ''').format(njobs=len(jobs), slots=slots, cores=cores, limit=limit,
+                   threads=first.threads,
+                   log=name+'.log', members=' \\\n'.join(members))
+    write_driver(first, name+'.script', resources, name+'.err', body)
+    rounds = -(-len(jobs) // slots)
+    if rounds > 1:
+        print('Note: {0:d} jobs run {1:d} at a time, so the walltime must '
+              'cover {2:d} consecutive jobs.'.format(len(jobs), slots, rounds),
+              file=sys.stderr)
+    return submit_driver(jobs, name+'.script',
+                         'pack of {0:d} jobs'.format(len(jobs)), resources,
+                         'pack')
+
+
+def run_local(jobs, maxjobs, cores=None, mem=None):
+    '''Run interactive submittables concurrently, each in its own process.
+    A job is started when fewer than maxjobs are running and its cores and
+    memory fit in what is left of the budget, counting the load from other
+    users of the machine.  Each job uses --nodes times --ppn cores (or one)
+    and --mem MB per core.  The exit status of the program is reported
+    when a job finishes.'''
+    from multiprocessing import get_context
+    from time import sleep, time
+    from os import cpu_count, getloadavg
+
+    # Default to the whole machine
+    cores = cores if cores else cpu_count()
+    if mem is None:
+        try:
+            with open('/proc/meminfo') as f:
+                for line in f:
+                    if line.startswith('MemAvailable:'):
+                        mem = int(line.split()[1]) // 1024
+        except IOError:
+            pass
+
+    def need(job):
+        n = (job.nodes if job.nodes else 1) * \
+            (job.ppn if job.ppn and job.ppn > 0 else 1)
+        return n, (job.mem if job.mem else 0) * n
+
+    def run(job):
+        # The process exits with the status of the program
+        sys.exit(job.submit() or 0)
+
+    # Fork so that each job changes directories in its own process
+    ctx = get_context('fork')
+    queued, running = list(jobs), []
+    for job in queued:
+        if need(job)[0] > cores:
+            print('Warning: {0} asks for more than {1:d} cores.'.format(
+                  job.input['base'], cores), file=sys.stderr)
+    while queued or running:
+        # Report the jobs that have finished
+        for job, proc, start in list(running):
+            if not proc.is_alive():
+                proc.join()
+                running.remove((job, proc, start))
+                print('Finished {0} (exit {1:d}) after {2:.0f} s'.format(
+                      job.input['full'], proc.exitcode, time() - start),
+                      file=sys.stderr)
+
+        # Start as many new jobs as will fit
+        while queued and len(running) < maxjobs:
+            used_cores = sum(need(j)[0] for j, p, t in running)
+            used_mem = sum(need(j)[1] for j, p, t in running)
+            other = max(0.0, getloadavg()[0] - used_cores)
+            n, m = need(queued[0])
+            # Always allow one job so an oversized job cannot block the list
+            if running and (other + used_cores + n > cores or
+                            (mem is not None and used_mem + m > mem)):
+                break
+            job = queued.pop(0)
+            proc = ctx.Process(target=run, args=(job,))
+            proc.start()
+            running.append((job, proc, time()))
+            print('Started {0} ({1:d} running, {2:d} queued)'.format(
+                  job.input['full'], len(running), len(queued)),
+                  file=sys.stderr)
+        sleep(1)
+
+
+def stage_files(pairs, move=False, readonly=False, stats=None, threads=4):
+    '''Put each source file at its destination as cheaply as the file
+    systems allow.  With move the source is renamed if it is on the same
+    file system.  With readonly the program only reads the file, so it is
+    hard linked, or symbolically linked across file systems.  Otherwise
+    the destination is a reflink (a copy-on-write clone) where the file
+    system supports them, and a copy whose checksum is verified where it
+    does not; copies run in parallel.  The files, bytes, seconds and
+    methods used are added to stats, which is returned.'''
+    from concurrent.futures import ThreadPoolExecutor
+    from os.path import abspath, basename, getsize, isdir, join, lexists
+    from time import time
+    if stats is None:
+        stats = {'files': 0, 'bytes': 0, 'seconds': 0.0, 'methods': {}}
+    start = time()
+
+    def stage(pair):
+        source, dest = pair
+        if isdir(dest):
+            dest = join(dest, basename(source))
+        size = getsize(source)
+        if move:
+            try:
+                os.rename(source, dest)
+                return 'rename', size
+            except OSError:
+                pass
+        # A link left in place, e.g. to a logfile, is replaced
+        if lexists(dest):
+            os.remove(dest)
+        if readonly:
+            try:
+                os.link(source, dest)
+                return 'hardlink', size
+            except OSError:
+                os.symlink(abspath(source), dest)
+                return 'symlink', size
+        try:
+            reflink(source, dest)
+            return 'reflink', size
+        except (IOError, OSError, ImportError):
+            verified_copy(source, dest)
+            return 'copy', size
+
+    with ThreadPoolExecutor(max(1, threads)) as pool:
+        futures = [(pair, pool.submit(stage, pair)) for pair in pairs]
+        for (source, dest), future in futures:
+            try:
+                method, size = future.result()
+            except (IOError, OSError):
+                # Results that were not produced are not an error
+                if not move:
+                    raise
+                continue
+            stats['files'] += 1
+            stats['bytes'] += size
+            stats['methods'][method] = stats['methods'].get(method, 0) + 1
+    stats['seconds'] += time() - start
+    return stats
+
+
+def reflink(source, dest):
+    '''Clone source to dest without copying the data.  Raises an OSError
+    if the file system cannot.'''
+    import fcntl
+    from shutil import copystat
+    FICLONE = 0x40049409
+    try:
+        with open(source, 'rb') as src, open(dest, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except (IOError, OSError):
+        if os.path.exists(dest):
+            os.remove(dest)
+        raise
+    copystat(source, dest)
+
+
+def verified_copy(source, dest, tries=2):
+    '''Copy source to dest and check that the copy has the same checksum.'''
+    from shutil import copystat
+    from zlib import crc32
+
+    def checksum(f, out=None):
+        crc = 0
+        for block in iter(lambda: f.read(1 << 24), b''):
+            crc = crc32(block, crc)
+            if out is not None:
+                out.write(block)
+        return crc
+
+    for attempt in range(tries):
+        with open(source, 'rb') as src, open(dest, 'wb') as dst:
+            expected = checksum(src, dst)
+        with open(dest, 'rb') as dst:
+            if checksum(dst) == expected:
+                copystat(source, dest)
+                return
+    raise IOError('Checksum mismatch copying {0} to {1}'.format(source, dest))
+
+
+def stage_summary(stats):
+    '''Describe staging statistics in one line.'''
+    size = float(stats['bytes'])
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if size < 1024 or unit == 'TB':
+            break
+        size /= 1024
+    methods = ', '.join('{0} {1:d}'.format(m, n)
+                        for m, n in sorted(stats['methods'].items()))
+    return '{0:d} files, {1:.1f} {2} in {3:.2f} s ({4})'.format(
+             stats['files'], size, unit, stats['seconds'], methods or 'none')
+
+
+def submit_dir(*parts):
+    '''Return a path in the directory where submit keeps its own files,
+    $SUBMIT_HOME or ~/.submit by default, making the directory if needed.'''
+    from os.path import expanduser, join
+    base = os.environ.get('SUBMIT_HOME', expanduser(join('~', '.submit')))
+    path = join(base, *parts)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+def run_queue_command(command, cwd=None):
+    '''Run a qsub or sbatch command.  Returns the job ID, or None if the
+    submission failed, and everything that the command printed.'''
+    from subprocess import Popen, PIPE
+    try:
+        proc = Popen(command, stdout=PIPE, stderr=PIPE, cwd=cwd,
+                     universal_newlines=True)
+    except OSError as e:
+        return None, 'Could not run {0}: {1}\n'.format(command[0], e)
+    out, err = proc.communicate()
+    if proc.returncode != 0 or not out.split():
+        return None, out + err + '{0} failed with exit status {1:d}\n'.format(
+                                                  command[0], proc.returncode)
+    # sbatch prints "Submitted batch job 1234", qsub prints "1234.server";
+    # warnings on stderr are not part of it
+    return out.split()[-1].split(';')[0], out + err
+
+
+def queue_limited(out):
+    '''Whether a rejected submission was turned away by a limit of the
+    queue or a scheduler that was too busy, so that it may be retried
+    later, rather than for being wrong.'''
+    from re import search, IGNORECASE
+    return bool(search(r'MaxSubmit|QOSMax|AssocMax|max(imum)?[ _]?'
+                       r'(number of )?jobs|would exceed|job limit|'
+                       r'temporarily unable|try again|timed out',
+                       out, IGNORECASE))
+
+
+def queue_send(command, spool=False, record=None, retry=True):
+    '''Run a qsub or sbatch command, echo what it prints and return the
+    job ID, or None if the submission failed.  If spool is given, or the
+    queue turns the job away because of a limit, the command is put in the
+    spool instead.  Jobs whose ID is needed right away, e.g. for the
+    dependencies of a workflow, are not retried.  The record describing
+    the job is logged once it has a job ID.'''
+    if spool:
+        spool_command(command, record)
+        print('Spooled', command[-1])
+        return None
+    jobid, out = run_queue_command(command)
+    print(out, end='')
+    if jobid is None:
+        if retry and queue_limited(out):
+            spool_command(command, record)
+            print('Spooled', command[-1], 'to be retried by "submit.py drain"',
+                  file=sys.stderr)
+    elif record is not None:
+        log_job(jobid, record)
+    return jobid
+
+
+def job_record(jobs, script, command, resources=None, kind='single'):
+    '''Describe the submission of a script that runs the given submittables,
+    for the job log.  kind is single, array, pack or probe.'''
+    first = jobs[0]
+    record = {'program': type(first).__name__, 'host': first.host.name,
+              'queue': first.queue,
+              'queue_type': first.host.queue_type, 'script': script,
+              'command': command, 'cwd': os.getcwd(), 'kind': kind,
+              'allocation': first.allocation,
+              'inputs': [j.input['full'] for j in jobs],
+              'outputs': [j.output['full'] for j in jobs],
+              'hashes': [j.input_hash() for j in jobs],
+              'progress': [j.progress_file() for j in jobs],
+              'features': [j.features() for j in jobs]}
+    if resources is not None:
+        nodes, ppn, wall, mem = resources
+        record.update(nodes=nodes, ppn=ppn, wall=first.host.td2hms(wall),
+                      mem=mem)
+    return record
+
+
+def log_job(jobid, record):
+    '''Append a submitted job to the job log, jobs.log in submit_dir, as
+    one JSON object per line.'''
+    import json
+    from contextlib import closing
+    from time import time
+    record = dict(record, jobid=jobid, submitted=time())
+    with open(os.path.join(submit_dir(), 'jobs.log'), 'a') as f:
+        print(json.dumps(record), file=f)
+    with closing(open_ledger()) as db, db:
+        ledger_add(db, record)
+
+
+def read_job_log():
+    '''Return the records of the job log, oldest first.'''
+    import json
+    try:
+        with open(os.path.join(submit_dir(), 'jobs.log')) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except IOError:
+        return []
+
+
+def open_ledger():
+    '''Open the ledger, ledger.db in submit_dir, an SQLite database with
+    one row for each input of each submitted job.  A new ledger imports
+    the jobs already in the job log.'''
+    import sqlite3
+    path = os.path.join(submit_dir(), 'ledger.db')
+    new = not os.path.exists(path)
+    db = sqlite3.connect(path, timeout=60)
+    db.row_factory = sqlite3.Row
+    db.executescript('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            jobid TEXT, member INTEGER, kind TEXT, program TEXT, host TEXT,
+            allocation TEXT, queue TEXT, queue_type TEXT, input TEXT,
+            output TEXT, input_hash TEXT, script TEXT, nodes INTEGER,
+            ppn INTEGER, wall REAL, mem INTEGER, submitted REAL, state TEXT,
+            elapsed REAL, maxrss REAL, cores INTEGER, outcome TEXT,
+            started REAL, PRIMARY KEY (jobid, member));
+        CREATE INDEX IF NOT EXISTS jobs_program ON jobs (program);
+        CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+        CREATE INDEX IF NOT EXISTS jobs_hash ON jobs (input_hash);
+        CREATE INDEX IF NOT EXISTS jobs_submitted ON jobs (submitted);
+    ''')
+    # Ledgers from before the start of each job was kept
+    if 'started' not in [c[1] for c in db.execute('PRAGMA table_info(jobs)')]:
+        db.execute('ALTER TABLE jobs ADD COLUMN started REAL')
+    if new:
+        with db:
+            for record in read_job_log():
+                ledger_add(db, record)
+    return db
+
+
+def ledger_add(db, record):
+    '''Add the inputs of a job record from the job log to the ledger.'''
+    wall = elapsed_seconds(record['wall']) if record.get('wall') else None
+    hashes = record.get('hashes') or [None] * len(record['inputs'])
+    db.executemany('''INSERT OR IGNORE INTO jobs (jobid, member, kind,
+                      program, host, allocation, queue, queue_type, input,
+                      output, input_hash, script, nodes, ppn, wall, mem,
+                      submitted) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
+                      ?, ?, ?, ?, ?)''',
+                   [(record['jobid'], i, record.get('kind'), record['program'],
+                     record['host'], record.get('allocation'),
+                     record.get('queue'), record.get('queue_type'), inp, out,
+                     h, record['script'], record.get('nodes'),
+                     record.get('ppn'), wall, record.get('mem'),
+                     record.get('submitted'))
+                    for i, (inp, out, h) in enumerate(zip(record['inputs'],
+                                                           record['outputs'],
+                                                           hashes))])
+
+
+def ledger_update(db):
+    '''Fill in the final state, start, runtime, cores and peak memory of the
+    jobs in the ledger that were still unfinished, with one batched sacct
+    call.  Only SLURM keeps the accounting needed.'''
+    from subprocess import Popen, PIPE
+    rows = db.execute('''SELECT DISTINCT jobid FROM jobs
+                         WHERE queue_type = 'SBATCH' AND (state IS NULL OR
+                         state IN ('PENDING', 'RUNNING', 'REQUEUED',
+                                   'SUSPENDED'))''').fetchall()
+    if not rows:
+        return
+    try:
+        proc = Popen(['sacct', '-n', '-P', '-j',
+                      ','.join(r['jobid'] for r in rows), '-o',
+                      'JobID,State,Elapsed,MaxRSS,AllocCPUS,TotalCPU,Start'],
+                     stdout=PIPE, universal_newlines=True)
+    except OSError:
+        return
+    accounting = parse_sacct(proc.communicate()[0])
+    updates = []
+    for r in db.execute('''SELECT jobid, member, kind FROM jobs WHERE jobid
+                          IN ({0})'''.format(','.join('?' * len(rows))),
+                        [r['jobid'] for r in rows]):
+        task = '{0}_{1:d}'.format(r['jobid'], r['member']) \
+               if r['kind'] == 'array' else r['jobid']
+        acct = accounting.get(task)
+        if acct is not None and acct.get('state'):
+            updates.append((acct['state'], acct['elapsed'], acct['maxrss'],
+                            acct['cores'], acct.get('start'), r['jobid'],
+                            r['member']))
+    with db:
+        db.executemany('''UPDATE jobs SET state = ?, elapsed = ?, maxrss = ?,
+                          cores = ?, started = ? WHERE jobid = ? AND
+                          member = ?''',
+                       updates)
+
+
+def ledger(argv):
+    '''\
+    Query the ledger of submitted jobs.  Each input of each job is one row,
+    with its input hash, program, host, allocation, requested resources,
+    script and job ID, and its final state, runtime and peak memory once
+    SLURM accounting has them (the ledger is brought up to date with sacct
+    first).  By default the newest matching rows are listed.  --report
+    sums the core hours used and requested and the fraction of the
+    walltime and memory used, to spot over-allocation, and --paths prints
+    the inputs only, so that e.g. the failed ones can be piped back in:
+
+      submit.py ledger --failed --since 7 --paths | submit.py -d
+    '''
+    from argparse import ArgumentParser, RawDescriptionHelpFormatter
+    from time import localtime, strftime, time
+    parser = ArgumentParser(prog='submit.py ledger',
+                            description=dedent(ledger.__doc__),
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('-p', '--program', help='Only jobs of this program, '
+                        'e.g. NWChem.')
+    parser.add_argument('-A', '--allocation', help='Only jobs charged to '
+                        'this allocation.')
+    parser.add_argument('-s', '--state', help='Only jobs in these states, '
+                        'e.g. TIMEOUT,OUT_OF_MEMORY.')
+    parser.add_argument('--failed', help='Only jobs that did not complete, '
+                        'or whose output shows that the program failed.',
+                        action='store_true', default=False)
+    parser.add_argument('--since', help='Only jobs submitted in the last '
+                        '%(metavar)s days.', type=float, metavar='DAYS')
+    parser.add_argument('--report', help='Summarize the jobs by program, '
+                        'allocation or host.',
+                        choices=('program', 'allocation', 'host'))
+    parser.add_argument('--paths', help='Print the inputs only.',
+                        action='store_true', default=False)
+    parser.add_argument('-n', '--limit', help='List at most %(metavar)s '
+                        'jobs, %(default)i is default.  Not applied with '
+                        '--paths.', type=int, default=50,
+                        metavar='N')
+    parser.add_argument('--sql', help='Run a query of your own against the '
+                        'jobs table.', metavar='QUERY')
+    parser.add_argument('--no-update', help='Do not ask sacct for the jobs '
+                        'that were unfinished.', dest='update',
+                        action='store_false', default=True)
+    args = parser.parse_args(argv)
+
+    db = open_ledger()
+    if args.update:
+        ledger_update(db)
+    if args.sql:
+        for row in db.execute(args.sql):
+            print('\t'.join('' if v is None else str(v) for v in row))
+        return
+
+    where, values = [], []
+    if args.program:
+        where.append('program = ? COLLATE NOCASE')
+        values.append(args.program)
+    if args.allocation:
+        where.append('allocation = ? COLLATE NOCASE')
+        values.append(args.allocation)
+    if args.state:
+        states = args.state.upper().split(',')
+        where.append('state IN ({0})'.format(','.join('?' * len(states))))
+        values.extend(states)
+    if args.failed:
+        where.append("(state NOT IN ('COMPLETED', 'PENDING', 'RUNNING') OR "
+                     "outcome = 'failed')")
+    if args.since is not None:
+        where.append('submitted >= ?')
+        values.append(time() - args.since * 86400)
+    where = ' WHERE ' + ' AND '.join(where) if where else ''
+
+    if args.report:
+        print('{0:<20} {1:>6} {2:>6} {3:>10} {4:>10} {5:>6} {6:>6}'.format(
+              args.report, 'jobs', 'failed', 'core-h', 'asked', 'wall%',
+              'mem%'))
+        for r in db.execute('''SELECT {0} AS key, COUNT(*) AS jobs,
+                SUM(state IS NOT NULL AND state != 'COMPLETED') AS failed,
+                SUM(elapsed * cores) / 3600 AS used,
+                SUM(CASE WHEN elapsed IS NOT NULL
+                    THEN wall * nodes * ABS(ppn) END) / 3600 AS asked,
+                100 * AVG(elapsed / wall) AS wall,
+                100 * AVG(maxrss / mem) AS mem
+                FROM jobs{1} GROUP BY {0} ORDER BY used DESC'''.format(
+                    args.report, where), values):
+            print('{0:<20} {1:>6d} {2:>6d} {3:>10.1f} {4:>10.1f} {5:>6.0f} '
+                  '{6:>6.0f}'.format(r['key'] or '-', r['jobs'],
+                                     r['failed'] or 0, r['used'] or 0,
+                                     r['asked'] or 0, r['wall'] or 0,
+                                     r['mem'] or 0))
+        return
+
+    # Every matching input is printed with --paths
+    limit = -1 if args.paths else args.limit
+    rows = db.execute('''SELECT * FROM jobs{0} ORDER BY submitted DESC
+                         LIMIT ?'''.format(where), values + [limit])
+    if args.paths:
+        seen = set()
+        for r in rows:
+            if r['input'] not in seen:
+                seen.add(r['input'])
+                print(r['input'])
+        return
+    print('{0:<16} {1:<10} {2:<10} {3:<14} {4:>5} {5:>10} {6:>10}  {7}'
+          .format('submitted', 'job', 'program', 'state', 'cores', 'wall',
+                  'elapsed', 'input'))
+    hms = lambda t: '-' if t is None else '{0:d}:{1:02d}:{2:02d}'.format(
+                    int(t) // 3600, int(t) % 3600 // 60, int(t) % 60)
+    for r in rows:
+        cores = r['cores'] or (r['nodes'] or 0) * abs(r['ppn'] or 0) or None
+        print('{0:<16} {1:<10} {2:<10} {3:<14} {4:>5} {5:>10} {6:>10}  {7}'
+              .format(strftime('%F %H:%M', localtime(r['submitted'] or 0)),
+                      r['jobid'], r['program'], r['state'] or '-',
+                      cores or '-', hms(r['wall']), hms(r['elapsed']),
+                      r['input']))
+
+
+def efficiency(argv):
+    '''\
+    Compare what the finished jobs in the ledger asked for with what they
+    used: the CPU time against the cores times the elapsed time, the peak
+    memory against the memory per processor, and the elapsed time against
+    the walltime.  The jobs that used less than the threshold of any of
+    them are listed, and defaults for each program on each cluster are
+    suggested from its completed jobs: the usual nodes, the processors per
+    node scaled by how busy they were, and the longest walltime and largest
+    memory seen, with some headroom.  They are printed as sections named
+    after the cluster and program, e.g. [stampede3.nwchem], which are used
+    from ~/.submitrc for the values that are not given, and with --default.
+    --write puts them there, keeping the old file as ~/.submitrc.bak.
+
+    The accounting comes from sacct, or from a file of the same form, e.g.
+
+      sacct -n -P -o JobID,State,Elapsed,MaxRSS,AllocCPUS,TotalCPU > acct.txt
+    '''
+    from argparse import ArgumentParser, RawDescriptionHelpFormatter
+    from math import ceil
+    from subprocess import Popen, PIPE
+    from time import time
+    parser = ArgumentParser(prog='submit.py efficiency',
+                            description=dedent(efficiency.__doc__),
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('--accounting', help='Read the accounting from this '
+                        'file instead of asking sacct.', metavar='FILE')
+    parser.add_argument('-p', '--program', help='Only jobs of this program, '
+                        'e.g. NWChem.')
+    parser.add_argument('--since', help='Only jobs submitted in the last '
+                        '%(metavar)s days.', type=float, metavar='DAYS')
+    parser.add_argument('-t', '--threshold', help='Flag jobs using less than '
+                        '%(metavar)s percent of what they asked for, '
+                        '%(default)i is default.', type=float, default=50,
+                        metavar='PERCENT')
+    parser.add_argument('--min-jobs', help='Completed jobs needed before '
+                        'defaults are suggested for a program, %(default)i '
+                        'is default.', type=int, default=3, metavar='N')
+    parser.add_argument('--write', help='Write the suggested defaults to '
+                        '~/.submitrc, after backing it up.',
+                        action='store_true', default=False)
+    args = parser.parse_args(argv)
+
+    db = open_ledger()
+    where, values = ["kind NOT IN ('pack', 'probe')"], []
+    if args.program:
+        where.append('program = ? COLLATE NOCASE')
+        values.append(args.program)
+    if args.since is not None:
+        where.append('submitted >= ?')
+        values.append(time() - args.since * 86400)
+    rows = db.execute('SELECT * FROM jobs WHERE {0} ORDER BY submitted'
+                      .format(' AND '.join(where)), values).fetchall()
+    if args.accounting:
+        with open(args.accounting) as f:
+            accounting = parse_sacct(f.read())
+    elif rows:
+        try:
+            proc = Popen(['sacct', '-n', '-P', '-j',
+                          ','.join(sorted(set(r['jobid'] for r in rows))),
+                          '-o', 'JobID,State,Elapsed,MaxRSS,AllocCPUS,TotalCPU'],
+                         stdout=PIPE, universal_newlines=True)
+        except OSError:
+            sys.exit('sacct is not available here; give the accounting '
+                     'with --accounting')
+        accounting = parse_sacct(proc.communicate()[0])
+    else:
+        accounting = {}
+
+    # Work out the fraction of each resource that the finished jobs used
+    used, flagged = {}, []
+    for r in rows:
+        task = '{0}_{1:d}'.format(r['jobid'], r['member']) \
+               if r['kind'] == 'array' else r['jobid']
+        acct = accounting.get(task)
+        if not acct or not acct.get('elapsed') or acct.get('state') in (
+                                    None, 'PENDING', 'RUNNING', 'REQUEUED'):
+            continue
+        cores = acct['cores'] or (r['nodes'] or 1) * abs(r['ppn'] or 1)
+        job = {'row': r, 'state': acct['state'], 'elapsed': acct['elapsed'],
+               'maxrss': acct['maxrss'], 'cores': cores,
+               'cpu': acct['cpu'] / (acct['elapsed'] * cores)
+                      if 'cpu' in acct else None,
+               'mem': acct['maxrss'] / r['mem'] if r['mem'] else None,
+               'wall': acct['elapsed'] / r['wall'] if r['wall'] else None}
+        used.setdefault((cluster(r['host']), r['program']), []).append(job)
+        low = [k for k in ('cpu', 'mem', 'wall') if job[k] is not None
+               and job[k] * 100 < args.threshold]
+        if low and acct['state'] == 'COMPLETED':
+            flagged.append((job, low))
+
+    pct = lambda f: '-' if f is None else '{0:.0f}'.format(100 * f)
+    print('{0:<10} {1:<10} {2:>5} {3:>5} {4:>5} {5:>5}  {6}'.format(
+          'job', 'program', 'cores', 'cpu%', 'mem%', 'wall%', 'input'))
+    for job, low in flagged:
+        print('{0:<10} {1:<10} {2:>5d} {3:>5} {4:>5} {5:>5}  {6}'.format(
+              job['row']['jobid'], job['row']['program'], job['cores'],
+              pct(job['cpu']), pct(job['mem']), pct(job['wall']),
+              job['row']['input']))
+    print('{0:d} of {1:d} completed jobs used less than {2:.0f}% of the '
+          'cores, memory or walltime they asked for'.format(len(flagged),
+          sum(1 for jobs in used.values() for j in jobs
+              if j['state'] == 'COMPLETED'), args.threshold))
+
+    # Suggest defaults for each program on each cluster from its completed
+    # jobs, leaving out what was not recorded
+    suggestions = {}
+    for (host, program), jobs in sorted(used.items()):
+        jobs = [j for j in jobs if j['state'] == 'COMPLETED']
+        if len(jobs) < args.min_jobs:
+            continue
+        common = lambda key: max(set(j['row'][key] for j in jobs),
+                                 key=[j['row'][key] for j in jobs].count)
+        nodes, ppn = common('nodes'), common('ppn')
+        rc = {'nodes': str(nodes)} if nodes else {}
+        busy = sorted(j['cpu'] for j in jobs if j['cpu'] is not None)
+        if ppn and ppn > 0 and busy:
+            # Leave room for the busiest runs, not the average one
+            busiest = busy[int(0.9 * (len(busy) - 1) + 0.5)]
+            rc['ppn'] = str(max(1, min(ppn, int(ceil(ppn * busiest)))))
+        longest = max(j['elapsed'] for j in jobs) * 1.25
+        quarters = -(-int(longest) // 900) * 900
+        rc['wall'] = '{0:d}:{1:02d}:00'.format(quarters // 3600,
+                                               quarters % 3600 // 60)
+        largest = max([j['maxrss'] for j in jobs if j['maxrss']] or [0])
+        if largest:
+            rc['mem'] = str(-(-int(largest * 1.2) // 100) * 100)
+        section = '.'.join([host, program.lower()])
+        suggestions[section] = rc
+        print('\n# From {0:d} completed {1} jobs on {2}'.format(len(jobs),
+                                                             program, host))
+        print('[{0}]'.format(section))
+        for key in ('nodes', 'ppn', 'wall', 'mem'):
+            if key in rc:
+                print('{0} = {1}'.format(key, rc[key]))
+
+    if args.write and suggestions:
+        from shutil import copy2
+        try:
+            from configparser import RawConfigParser
+        except ImportError:
+            from ConfigParser import RawConfigParser
+        path = os.path.join(os.path.expanduser('~'), '.submitrc')
+        rc = RawConfigParser()
+        rc.read(path)
+        if os.path.exists(path):
+            copy2(path, path + '.bak')
+            print('\nBacked up {0} to {0}.bak'.format(path))
+        for section, options in suggestions.items():
+            if not rc.has_section(section):
+                rc.add_section(section)
+            for key, value in options.items():
+                rc.set(section, key, value)
+        with open(path, 'w') as f:
+            rc.write(f)
+        print('Wrote the defaults of {0} to {1}'.format(
+              ', '.join(sorted(suggestions)), path))
+
+
+def parse_sacct(text):
+    '''Parse "sacct -n -P -o JobID,State,Elapsed,MaxRSS,AllocCPUS" output.
+    Returns a dictionary of job (or array task) ID to its state, elapsed
+    seconds, cores and the largest MaxRSS of its steps in MB.  If TotalCPU
+    is given as a sixth column, the CPU seconds of the job are included, and
+    if Start is given as a seventh, the time the job started.'''
+    from time import mktime, strptime
+    jobs = {}
+    for line in text.splitlines():
+        cols = line.split('|')
+        if len(cols) < 5:
+            continue
+        jobid, state, elapsed, maxrss, cpus = cols[:5]
+        job = jobs.setdefault(jobid.split('.')[0], {'maxrss': 0.0})
+        # The job's own line sums the CPU time of its steps
+        if len(cols) > 5 and cols[5]:
+            job['cpu'] = max(job.get('cpu', 0.0),
+                             elapsed_seconds(cols[5]) or 0.0)
+        if '.' not in jobid:
+            job['state'] = state.split()[0] if state else ''
+            job['elapsed'] = elapsed_seconds(elapsed)
+            job['cores'] = int(cpus) if cpus.isdigit() else None
+            if len(cols) > 6:
+                try:
+                    job['start'] = mktime(strptime(cols[6],
+                                                   '%Y-%m-%dT%H:%M:%S'))
+                except ValueError:
+                    job['start'] = None
+        if maxrss:
+            scale = {'K': 1.0/1024, 'M': 1.0, 'G': 1024.0, 'T': 1048576.0}
+            unit = maxrss[-1].upper()
+            mb = float(maxrss[:-1]) * scale[unit] if unit in scale \
+                 else float(maxrss) / 1048576
+            job['maxrss'] = max(job['maxrss'], mb)
+    return jobs
+
+
+def elapsed_seconds(elapsed):
+    '''Return the seconds in a [D-][HH:]MM:SS[.sss] time.'''
+    days = 0
+    if '-' in elapsed:
+        days, elapsed = elapsed.split('-')
+    seconds = 0.0
+    for part in elapsed.split(':'):
+        try:
+            seconds = seconds * 60 + float(part)
+        except ValueError:
+            return None
+    return int(days) * 86400 + seconds
+
+
+def read_history():
+    '''Return the past runs in history.log in submit_dir.'''
+    import json
+    try:
+        with open(os.path.join(submit_dir(), 'history.log')) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except IOError:
+        return []
+
+
+def update_history():
+    '''Add the runtime and peak memory of finished jobs in the job log to the
+    history, with one batched sacct call.  Only SLURM keeps the accounting
+    needed.  Packed jobs are skipped since their inputs share the
+    allocation, and probes since they are cut short.'''
+    import json
+    from subprocess import Popen, PIPE
+    # Tasks of an array finish at different times, so each is kept once
+    seen = set(h.get('task', h['jobid']) for h in read_history())
+    task = lambda r, i: r['jobid'] if r.get('kind') != 'array' \
+                        else '{0}_{1:d}'.format(r['jobid'], i)
+    records = [r for r in read_job_log()
+               if r.get('queue_type') == 'SBATCH'
+               and r.get('kind') not in ('pack', 'probe')
+               and any(task(r, i) not in seen
+                       for i in range(len(r['inputs'])))]
+    if not records:
+        return
+    try:
+        proc = Popen(['sacct', '-n', '-P', '-j',
+                      ','.join(r['jobid'] for r in records),
+                      '-o', 'JobID,State,Elapsed,MaxRSS,AllocCPUS'],
+                     stdout=PIPE, universal_newlines=True)
+    except OSError:
+        return
+    accounting = parse_sacct(proc.communicate()[0])
+
+    with open(os.path.join(submit_dir(), 'history.log'), 'a') as f:
+        for r in records:
+            features = r.get('features') or [{}] * len(r['inputs'])
+            for i, feature in enumerate(features):
+                if task(r, i) in seen:
+                    continue
+                acct = accounting.get(task(r, i))
+                if acct is None or acct.get('state') in ('PENDING', 'RUNNING',
+                                                         'REQUEUED', None):
+                    continue
+                cores = acct['cores'] or 1
+                print(json.dumps(dict(feature, jobid=r['jobid'], task=task(r, i),
+                                      program=r['program'], host=r['host'],
+                                      state=acct['state'], cores=cores,
+                                      elapsed=acct['elapsed'],
+                                      maxrss=acct['maxrss'],
+                                      wall=r.get('wall'))), file=f)
+
+
+def current_history():
+    '''The past runs, with the history brought up to date with the
+    accounting only once per run of submit.py however many inputs ask.'''
+    if current_history.runs is None:
+        update_history()
+        current_history.runs = read_history()
+    return current_history.runs
+current_history.runs = None
+
+
+def predict_resources(program, features, cores):
+    '''Predict the walltime and memory per processor (MB) of a run of program
+    on an input with the given features using cores processors.  The
+    core-seconds of past completed runs of the program with the same
+    calculation type and basis (or any, if there are none) are fitted as
+    a power of the number of atoms.  The walltime is padded by a quarter
+    and rounded up to 15 minutes, which keeps it short enough to backfill;
+    the memory is the largest peak of those runs plus a fifth.  Returns the
+    walltime, memory and number of runs used, or None without history.'''
+    from math import exp, log
+    runs = [h for h in current_history() if h['program'] == program
+            and h['state'] == 'COMPLETED' and h.get('elapsed')]
+    similar = [h for h in runs if h.get('calctype') == features['calctype']
+               and h.get('basis') == features['basis']]
+    runs = similar if similar else runs
+    if not runs:
+        return None
+
+    # Fit log(core-seconds) = a + b log(atoms) if there are sizes to fit
+    cost = [(h['atoms'], h['elapsed'] * h['cores']) for h in runs]
+    sized = [(log(n), log(max(c, 1.0))) for n, c in cost if n]
+    atoms = features['atoms']
+    if atoms and len(set(x for x, y in sized)) > 1:
+        mx = sum(x for x, y in sized) / len(sized)
+        my = sum(y for x, y in sized) / len(sized)
+        b = sum((x-mx)*(y-my) for x, y in sized) / \
+            sum((x-mx)**2 for x, y in sized)
+        coreseconds = exp(my + b * (log(atoms) - mx))
+    else:
+        coreseconds = sorted(c for n, c in cost)[len(cost)//2]
+
+    seconds = coreseconds / max(cores, 1) * 1.25
+    quarters = max(1, int(-(-seconds // 900)))
+    wall = '{0:d}:{1:02d}:00'.format(quarters // 4, 15 * (quarters % 4))
+    peak = max(h['maxrss'] for h in runs) * 1.2
+    mem = int(-(-max(peak, 100) // 100) * 100)
+    return wall, mem, len(runs)
+
+
+def submit_probes(jobs, host, opts, subopts, cores, iterations=10):
+    '''Submit short runs of each submittable on each of the given core
+    counts.  Each probe is a copy of the input that is cancelled after the
+    given number of iterations, while the job samples how many iterations
+    it has done.  The resources of the probes are requested as for any other job,
+    with the memory asked for once.  The probes are registered in
+    probes.json in submit_dir so that read_scaling can turn the samples
+    into a scaling curve of this cluster once they have finished.  Returns
+    the job IDs.'''
+    import json
+    from copy import copy
+    from shutil import copy2
+    pending = os.path.join(submit_dir(), 'probes.json')
+    try:
+        with open(pending) as f:
+            probes = json.load(f)
+    except (IOError, ValueError):
+        probes = []
+    jobids, mem = [], None
+    for job in jobs:
+        if job.iteration_pattern is None:
+            print('Cannot probe {0} inputs, skipping {1}'.format(
+                  type(job).__name__, job.input['full']), file=sys.stderr)
+            continue
+        job.edit_input()
+        for n in cores:
+            # The probe is a copy of the input and its companion files
+            name = '{0}.probe{1:d}'.format(job.noext['full'], n)
+            for ext in (job.ext,) + job.companions:
+                if os.path.exists('.'.join([job.noext['full'], ext])):
+                    copy2('.'.join([job.noext['full'], ext]),
+                          '.'.join([name, ext]))
+            o = copy(opts)
+            o.nodes, o.ppn = job.spread_cores(n)
+            o.wall = job.wall if job.wall else '0:30:00'
+            o.out, o.pid, o.cache, o.predict = None, False, False, False
+            # Only the memory may still come from the defaults
+            o.defaulted = [d for d in opts.defaulted if d == 'mem']
+            probe = determine_file_type('.'.join([name, job.ext]), host, o,
+                                        subopts)
+            probe.samples = name + '.samples'
+            if os.path.exists(probe.samples):
+                os.remove(probe.samples)
+            probe.iterations = iterations
+            probe.mem = probe.mem if probe.mem else mem
+            resources = probe.request_resources()
+            mem = resources[3]
+            jobids.append(probe.submit_queue(resources, 'probe'))
+            probes.append({'program': type(job).__name__, 'cores': n,
+                           'host': cluster(host.name),
+                           'features': job.features(),
+                           'samples': probe.samples})
+    with open(pending, 'w') as f:
+        json.dump(probes, f)
+    return jobids
+
+
+def iteration_time(samples):
+    '''The seconds per iteration from the samples of a probe, which are
+    lines of a time and the number of iterations done by then.  Returns
+    None if fewer than two iterations were seen.'''
+    points = []
+    with open(samples) as f:
+        for line in f:
+            cols = line.split()
+            if len(cols) == 2 and cols[0].isdigit() and cols[1].isdigit():
+                points.append((int(cols[0]), int(cols[1])))
+    started = [(t, n) for t, n in points if n > 0]
+    if not started:
+        return None
+    last = max(n for t, n in started)
+    t0, n0 = started[0]
+    t1 = min(t for t, n in started if n == last)
+    if last <= n0 or t1 <= t0:
+        return None
+    return float(t1 - t0) / (last - n0)
+
+
+def read_scaling():
+    '''Return the measured scaling points in scaling.json in submit_dir,
+    first adding those of probes that have finished.  A probe has finished
+    once its samples have not changed for five minutes.'''
+    import json
+    from time import time
+    pending = os.path.join(submit_dir(), 'probes.json')
+    scaling = os.path.join(submit_dir(), 'scaling.json')
+    try:
+        with open(scaling) as f:
+            points = json.load(f)
+    except (IOError, ValueError):
+        points = []
+    try:
+        with open(pending) as f:
+            probes = json.load(f)
+    except (IOError, ValueError):
+        return points
+    waiting = []
+    for probe in probes:
+        try:
+            done = time() - os.path.getmtime(probe['samples']) > 300
+        except OSError:
+            done = False
+        if not done:
+            waiting.append(probe)
+            continue
+        seconds = iteration_time(probe['samples'])
+        if seconds is None:
+            print('The probe {0} did not get through two iterations'.format(
+                  probe['samples']), file=sys.stderr)
+            continue
+        points.append(dict(probe['features'], program=probe['program'],
+                           host=probe.get('host'), cores=probe['cores'],
+                           seconds=seconds))
+    if len(waiting) < len(probes):
+        with open(scaling, 'w') as f:
+            json.dump(points, f, indent=1)
+        with open(pending, 'w') as f:
+            json.dump(waiting, f)
+    return points
+
+
+def best_cores(program, features, host):
+    '''Choose the core count for a run of program on an input with the
+    given features from the scaling curve probed on the cluster host for
+    the closest system size, within a factor of two.  The best core count has the smallest
+    product of the time to solution and the core-hours it costs, so cores
+    are only added while they still pay for themselves.  Returns the core
+    count and the probed number of atoms, or None.'''
+    from math import log
+    atoms = features['atoms']
+    points = [p for p in read_scaling() if p['program'] == program
+              and p.get('host') == host and p.get('atoms')
+              and p.get('seconds')]
+    if not atoms or not points:
+        return None
+    similar = [p for p in points if p.get('calctype') == features['calctype']]
+    points = similar if similar else points
+    closest = min(set(p['atoms'] for p in points),
+                  key=lambda n: abs(log(float(n) / atoms)))
+    if abs(log(float(closest) / atoms)) > log(2):
+        return None
+    curve = {}
+    for p in points:
+        if p['atoms'] == closest:
+            curve.setdefault(p['cores'], []).append(p['seconds'])
+    if len(curve) < 2:
+        return None
+    cost = dict((n, sum(t) / len(t)) for n, t in curve.items())
+    return min(cost, key=lambda n: cost[n]**2 * n), closest
+
+
+def spool_command(command, record=None):
+    '''Write a queue command to the spool, along with the directory it is
+    run from since that becomes the job's working directory.'''
+    import json
+    from time import time
+    spool = submit_dir('spool')
+    entry = {'command': command, 'cwd': os.getcwd(), 'attempts': 0,
+             'spooled': time(), 'next': time(), 'record': record}
+    name = '{0:.6f}.{1:d}.job'.format(time(), os.getpid())
+    # Write then rename so the drain never reads half a file
+    with open(os.path.join(spool, name+'.tmp'), 'w') as f:
+        json.dump(entry, f)
+    os.rename(os.path.join(spool, name+'.tmp'), os.path.join(spool, name))
+
+
+def drain(argv):
+    '''\
+    Submit the jobs waiting in the spool at a steady rate.  A rejected
+    submission (e.g. a QOS or max-submit limit) is retried with exponential
+    backoff and moved to the failed directory after too many attempts.  The
+    job IDs are recorded in the submitted.log file of the spool.
+    '''
+    import json
+    from argparse import ArgumentParser, RawDescriptionHelpFormatter
+    from fcntl import flock, LOCK_EX, LOCK_NB
+    from glob import glob
+    from os.path import basename, join
+    from time import sleep, strftime, time
+    parser = ArgumentParser(prog='submit.py drain',
+                            description=dedent(drain.__doc__),
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('-r', '--rate', help='Submissions per minute, '
+                        '%(default)s is default.', default=30.0, type=float)
+    parser.add_argument('--retries', help='Attempts before a job is given '
+                        'up on, %(default)i is default.', default=8, type=int)
+    parser.add_argument('--backoff', help='Seconds to wait after the first '
+                        'rejection, doubled for each later one; %(default)i '
+                        'is default.', default=60, type=int)
+    parser.add_argument('-f', '--follow', help='Keep running and submit '
+                        'jobs as they are spooled.', action='store_true',
+                        default=False)
+    args = parser.parse_args(argv)
+
+    spool = submit_dir('spool')
+    failed = submit_dir('spool', 'failed')
+    # Two drains would submit the same jobs twice
+    lock = open(join(spool, 'drain.lock'), 'a')
+    try:
+        flock(lock, LOCK_EX | LOCK_NB)
+    except (IOError, OSError):
+        sys.exit('Another "submit.py drain" is already draining the spool')
+    while True:
+        entries = sorted(glob(join(spool, '*.job')))
+        waiting = False
+        for name in entries:
+            with open(name) as f:
+                entry = json.load(f)
+            if entry['next'] > time():
+                waiting = True
+                continue
+
+            jobid, out = run_queue_command(entry['command'], entry['cwd'])
+            entry['attempts'] += 1
+            if jobid is not None:
+                with open(join(spool, 'submitted.log'), 'a') as log:
+                    print(strftime('%F %T'), jobid, entry['command'][-1],
+                          sep='\t', file=log)
+                if entry.get('record') is not None:
+                    log_job(jobid, entry['record'])
+                os.remove(name)
+                print('Submitted', entry['command'][-1], 'as', jobid)
+            elif entry['attempts'] >= args.retries:
+                os.rename(name, join(failed, basename(name)))
+                print('Gave up on', entry['command'][-1], 'after',
+                      entry['attempts'], 'attempts:', out.strip(),
+                      file=sys.stderr)
+            else:
+                delay = min(args.backoff * 2**(entry['attempts']-1), 3600)
+                entry['next'] = time() + delay
+                entry['output'] = out
+                with open(name, 'w') as f:
+                    json.dump(entry, f)
+                waiting = True
+                print('Rejected', entry['command'][-1], '- retrying in',
+                      delay, 's:', out.strip(), file=sys.stderr)
+            # Keep to the rate limit
+            sleep(60.0 / args.rate)
+
+        if not (waiting or args.follow):
+            break
+        if not entries or waiting:
+            sleep(min(args.backoff, 10))
+
+
+def output_complete(program, output):
+    '''Return whether an output file exists and shows that the program
+    finished, using the success_marker of the program's class.'''
+    try:
+        with open(output, 'rb') as f:
+            # The marker is near the end, so only read the tail of big files
+            f.seek(0, 2)
+            size = f.tell()
+            f.seek(max(0, size - 65536))
+            tail = f.read().decode('utf-8', 'replace')
+    except IOError:
+        return False
+    cls = globals().get(program)
+    marker = getattr(cls, 'success_marker', None)
+    return size > 0 and (marker is None or marker in tail)
+
+
+def cluster(hostname):
+    '''The name of the cluster a host belongs to, which is the same on each
+    of its login nodes, e.g. login1.stampede3.tacc.utexas.edu is stampede3.'''
+    parts = hostname.split('.')
+    return parts[1] if len(parts) > 2 else parts[0]
+
+
+def split_directives(script):
+    '''Split the queue directives that a script gives before its first
+    command from the rest of the script.'''
+    lines = script.split('\n')
+    head = next((i for i, line in enumerate(lines) if line.strip()
+                 and not line.lstrip().startswith('#')), len(lines))
+    directives = [i for i in range(head)
+                  if lines[i].startswith(('#PBS', '#SBATCH'))]
+    return ('\n'.join(lines[i] for i in directives),
+            '\n'.join(l for i, l in enumerate(lines) if i not in directives))
+
+
+def queue_jobid(jobid):
+    '''A job ID as the queue lists it for the user: without the server of
+    PBS or the brackets of a PBS array, e.g. 1234[].server is 1234.'''
+    from re import sub
+    return sub(r'\[\d*\]$', '', jobid.split('.')[0])
+
+
+def queue_states(queue_type):
+    '''One batched query of the queue for the jobs of the user.  Returns
+    the queued job IDs and whether they are pending or running, or None if
+    the queue could not be asked.'''
+    from subprocess import Popen, PIPE
+    user = os.environ.get('USER', '')
+    if queue_type == 'PBS':
+        command = ['qstat', '-u', user]
+    else:
+        command = ['squeue', '-h', '-u', user, '-o', '%i %T']
+    try:
+        proc = Popen(command, stdout=PIPE, stderr=PIPE,
+                     universal_newlines=True)
+    except OSError:
+        return None
+    out = proc.communicate()[0]
+    if proc.returncode != 0:
+        return None
+    queued = {}
+    for line in out.splitlines():
+        cols = line.split()
+        if queue_type == 'PBS':
+            if len(cols) > 2 and cols[0][0].isdigit():
+                state = 'running' if cols[-2] in 'RE' else 'pending'
+                jobid = queue_jobid(cols[0])
+                if queued.get(jobid) != 'running':
+                    queued[jobid] = state
+        elif len(cols) == 2:
+            # Array tasks are reported as 1234_5 or 1234_[6-9]
+            state = 'running' if cols[1] in ('RUNNING', 'COMPLETING') \
+                    else 'pending'
+            jobid = cols[0].split('_')[0]
+            if queued.get(jobid) != 'running':
+                queued[jobid] = state
+    return queued
+
+
+def queue_snapshot(filename=None, queue_type='SBATCH'):
+    '''The expected start times of the jobs pending in the queue, from
+    squeue --start or from a file of its output saved with
+    squeue --start -h -o "%a %P %S".  Returns a list of the account,
+    partition and start time (None if not yet known) of each pending job,
+    or None if there is no snapshot.'''
+    from subprocess import Popen, PIPE
+    from time import mktime, strptime
+    if filename is not None:
+        try:
+            with open(filename) as f:
+                text = f.read()
+        except IOError as e:
+            sys.exit('Cannot read the queue snapshot: ' + str(e))
+    elif queue_type == 'SBATCH':
+        try:
+            proc = Popen(['squeue', '--start', '-h', '-o', '%a %P %S'],
+                         stdout=PIPE, stderr=PIPE, universal_newlines=True)
+        except OSError:
+            return None
+        text = proc.communicate()[0]
+        if proc.returncode != 0:
+            return None
+    else:
+        return None
+    pending = []
+    for line in text.splitlines():
+        cols = line.split()
+        if len(cols) != 3 or cols[0] == 'ACCOUNT':
+            continue
+        try:
+            start = mktime(strptime(cols[2], '%Y-%m-%dT%H:%M:%S'))
+        except ValueError:
+            start = None
+        pending.append((cols[0], cols[1], start))
+    return pending
+
+
+def expected_waits(queues, cores=None, snapshot=None, days=7):
+    '''Estimate the seconds a job of cores processors would wait to start
+    in each queue (an account or partition).  The job is expected to start
+    after the last job pending in the queue in the squeue --start snapshot,
+    and after the median wait of our jobs in the queue over the last days,
+    from the ledger; the two are averaged when both are known.  The history
+    only counts jobs of about the same size if there are enough of them.
+    Returns a dictionary of each queue to its wait, None if unknown.'''
+    from contextlib import closing
+    from time import time
+    now = time()
+    with closing(open_ledger()) as db, db:
+        ledger_update(db)
+        rows = db.execute('''SELECT queue, started - submitted AS wait,
+                             COALESCE(cores, nodes * ABS(ppn)) AS cores
+                             FROM jobs WHERE member = 0 AND started IS NOT NULL
+                             AND started >= submitted AND submitted > ?''',
+                          (now - days * 86400,)).fetchall()
+    waits = {}
+    for queue in queues:
+        estimates = []
+        if snapshot is not None:
+            starts = [s for a, p, s in snapshot if queue in (a, p)]
+            known = [s for s in starts if s is not None]
+            if not starts:
+                estimates.append(0.0)
+            elif known:
+                estimates.append(max(0.0, max(known) - now))
+        history = [r for r in rows if r['queue'] == queue]
+        similar = [r for r in history if cores and r['cores']
+                   and cores / 2.0 <= r['cores'] <= cores * 2]
+        if len(similar) >= 3:
+            history = similar
+        if history:
+            history = sorted(r['wait'] for r in history)
+            estimates.append(history[len(history) // 2])
+        waits[queue] = sum(estimates) / len(estimates) if estimates else None
+    return waits
+
+
+def choose_allocation(allocations, host, cores, snapshot=None):
+    '''Pick the allocation whose queue is expected to start a job of cores
+    cores soonest, for -A auto.  Every allocation is asked for the same
+    walltime, so the one that starts first also finishes first.  The queue
+    is looked at once, from the snapshot file if one is given, and reused
+    for every job of the submission.'''
+    if choose_allocation.queues is None:
+        choose_allocation.queues = queue_snapshot(snapshot, host.queue_type)
+    waits = expected_waits(set(allocations.values()), cores,
+                           choose_allocation.queues)
+    hms = lambda t: '{0:d}:{1:02d}:{2:02d}'.format(
+                    int(t) // 3600, int(t) % 3600 // 60, int(t) % 60)
+    print('Expected wait for {0:d} cores: {1}'.format(cores, ', '.join(
+          '{0} ({1}) {2}'.format(letter, allocations[letter],
+                                 'unknown' if waits[allocations[letter]] is None
+                                 else hms(waits[allocations[letter]]))
+          for letter in sorted(allocations))))
+    known = sorted((waits[q], letter) for letter, q in allocations.items()
+                   if waits[q] is not None)
+    if not known:
+        letter = 'o' if 'o' in allocations else sorted(allocations)[0]
+        print('Nothing is known about the queues, using', letter,
+              file=sys.stderr)
+        return letter
+    print('Submitting to', known[0][1], '({0})'.format(
+                                                  allocations[known[0][1]]))
+    return known[0][1]
+
+choose_allocation.queues = None
+
+
+def watch(argv):
+    '''\
+    Follow the jobs that were submitted until they finish.  Each cycle makes
+    one squeue or qstat call for all jobs, reports how many are pending,
+    running, completed and failed, and checks the outputs of the jobs that
+    left the queue.  Commands may be run when a job completes or fails; in
+    them {jobid}, {input}, {output} and {script} are replaced.  The state of
+    every job is cached in watch.json in the submit directory.
+    '''
+    import asyncio, json
+    from argparse import ArgumentParser, RawDescriptionHelpFormatter
+    from contextlib import closing
+    from time import strftime
+    parser = ArgumentParser(prog='submit.py watch',
+                            description=dedent(watch.__doc__),
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('-i', '--interval', help='Seconds between polls, '
+                        '%(default)i is default.', default=60, type=int)
+    parser.add_argument('--on-done', help='Command to run for each output '
+                        'of a completed job, e.g. "collect {output}".',
+                        metavar='CMD')
+    parser.add_argument('--on-fail', help='Command to run for each output '
+                        'of a failed job.', metavar='CMD')
+    parser.add_argument('--resubmit', help='Resubmit failed jobs up to '
+                        '%(metavar)s times.', type=int, default=0, metavar='N')
+    parser.add_argument('--once', help='Poll once and exit.',
+                        action='store_true', default=False)
+    args = parser.parse_args(argv)
+
+    cache = os.path.join(submit_dir(), 'watch.json')
+    try:
+        with open(cache) as f:
+            states = json.load(f)
+    except (IOError, ValueError):
+        states = {}
+    final = ('completed', 'failed')
+
+    async def run(command, cwd=None):
+        '''Run a command and return its exit status and output'''
+        proc = await asyncio.create_subprocess_exec(*command, cwd=cwd,
+                           stdout=asyncio.subprocess.PIPE,
+                           stderr=asyncio.subprocess.STDOUT)
+        out = await proc.communicate()
+        return proc.returncode, out[0].decode('utf-8', 'replace')
+
+    async def in_queue(queue_type):
+        '''One batched query of the queue: return the queued job IDs
+        and their states'''
+        return await asyncio.get_event_loop().run_in_executor(None,
+                                                   queue_states, queue_type)
+
+    async def finished(record):
+        '''A job has left the queue: check its outputs and run callbacks'''
+        # Probes are cancelled on purpose and have no results
+        if record.get('kind') == 'probe':
+            return 'completed', [True] * len(record['outputs'])
+        loop = asyncio.get_event_loop()
+        checks = [loop.run_in_executor(None, output_complete,
+                                       record['program'], o)
+                  for o in record['outputs']]
+        done = await asyncio.gather(*checks)
+        calls = []
+        for ok, inp, out in zip(done, record['inputs'], record['outputs']):
+            command = args.on_done if ok else args.on_fail
+            if command:
+                command = command.format(jobid=record['jobid'], input=inp,
+                                         output=out, script=record['script'])
+                calls.append(run(['bash', '-c', command], record['cwd']))
+        state = 'completed' if all(done) else 'failed'
+        if state == 'failed' and record.get('resubmits', 0) < args.resubmit:
+            jobid, out = await loop.run_in_executor(None, run_queue_command,
+                                           record['command'], record['cwd'])
+            if jobid is not None:
+                log_job(jobid, dict(record,
+                                    resubmits=record.get('resubmits', 0)+1))
+                print('Resubmitted', record['script'], 'as', jobid)
+                state = 'resubmitted'
+        for status, out in await asyncio.gather(*calls):
+            print(out, end='')
+        return state, done
+
+    async def cycle():
+        records = [r for r in read_job_log()
+                   if states.get(r['jobid']) not in final + ('resubmitted',)]
+        queue_types = set(r.get('queue_type') for r in records)
+        queues = dict(zip(queue_types, await asyncio.gather(
+                                  *[in_queue(q) for q in queue_types])))
+        leaving = []
+        for r in records:
+            queued = queues[r.get('queue_type')]
+            if queued is None:
+                continue
+            jobid = queue_jobid(r['jobid'])
+            if jobid in queued:
+                states[r['jobid']] = queued[jobid]
+            else:
+                leaving.append(r)
+        outcomes = []
+        for r, (state, done) in zip(leaving, await asyncio.gather(
+                                          *[finished(r) for r in leaving])):
+            states[r['jobid']] = state
+            print('Job', r['jobid'], state, ' '.join(r['outputs']))
+            outcomes.extend(('completed' if ok else 'failed', r['jobid'], i)
+                            for i, ok in enumerate(done))
+        # Keep what the output of each member showed in the ledger
+        if leaving:
+            with closing(open_ledger()) as db, db:
+                db.executemany('''UPDATE jobs SET outcome = ?
+                                  WHERE jobid = ? AND member = ?''',
+                               outcomes)
+        # Learn the runtime and memory of the jobs that finished
+        if leaving:
+            await asyncio.get_event_loop().run_in_executor(None,
+                                                           update_history)
+        with open(cache, 'w') as f:
+            json.dump(states, f)
+
+        counts = {}
+        for r in read_job_log():
+            counts[states.get(r['jobid'], 'pending')] = \
+                       counts.get(states.get(r['jobid'], 'pending'), 0) + 1
+        print(strftime('%F %T'), ', '.join('{0} {1}'.format(counts.get(k, 0), k)
+              for k in ('pending', 'running', 'completed', 'failed')))
+        return any(states.get(r['jobid']) in ('pending', 'running', None)
+                   for r in records)
+
+    async def loop():
+        while await cycle() and not args.once:
+            await asyncio.sleep(args.interval)
+
+    asyncio.run(loop())
+
+
+def progress(argv):
+    '''\
+    Follow the outputs of the running jobs and estimate when they will
+    finish.  The SCF iterations, geometry steps, frequency displacements and
+    converged response vectors each program prints are counted as the
+    outputs grow; the time per iteration and how fast the SCF error falls
+    give the time left for each job and for the whole batch.  Jobs whose
+    output has stopped growing, or whose SCF is not converging, are reported
+    and may be cancelled with --kill.
+    '''
+    import json, re
+    from argparse import ArgumentParser, RawDescriptionHelpFormatter
+    from math import log10
+    from subprocess import call
+    from time import time, sleep, strftime
+    parser = ArgumentParser(prog='submit.py progress',
+                            description=dedent(progress.__doc__),
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('-p', '--program', help='Only the jobs of this '
+                        'program.')
+    parser.add_argument('-i', '--interval', help='Seconds between polls, '
+                        '%(default)i is default.', default=30, type=int)
+    parser.add_argument('--once', help='Poll once and exit.',
+                        action='store_true', default=False)
+    parser.add_argument('--stall', help='Minutes without output before a '
+                        'job counts as stalled, %(default)i is default.',
+                        default=30, type=int, metavar='MIN')
+    parser.add_argument('--kill', help='Cancel the jobs that stalled or '
+                        'whose SCF is not converging.', action='store_true',
+                        default=False)
+    args = parser.parse_args(argv)
+
+    try:
+        with open(os.path.join(submit_dir(), 'watch.json')) as f:
+            states = json.load(f)
+    except (IOError, ValueError):
+        states = {}
+    hms = lambda t: '{0:d}:{1:02d}:{2:02d}'.format(
+                    int(t) // 3600, int(t) % 3600 // 60, int(t) % 60)
+    # What was read of each output so far, by job ID and output
+    followed = {}
+    killed = set()
+
+    def started(record, inp):
+        '''When the compute phase of an input began, or None'''
+        phases = os.path.join(record['cwd'],
+                              os.path.splitext(inp)[0] + '.phases')
+        try:
+            with open(phases) as f:
+                for line in f:
+                    cols = line.split()
+                    if len(cols) == 2 and cols[0] == 'compute':
+                        return int(cols[1])
+        except (IOError, ValueError):
+            pass
+        return None
+
+    def follow(path, state, cls):
+        '''Count what was added to an output since the last poll.  Only
+        complete lines are read; an output that shrank is read again.'''
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return False
+        if size < state['offset']:
+            state.update(offset=0, iterations=0, errors=[],
+                         steps=dict.fromkeys(state['steps'], 0))
+        with open(path, 'rb') as f:
+            f.seek(state['offset'])
+            data = f.read(size - state['offset'])
+        end = data.rfind(b'\n') + 1
+        state['offset'] += end
+        iteration = re.compile(cls.iteration_pattern) \
+                    if cls.iteration_pattern else None
+        error = re.compile(cls.scf_error) if cls.scf_error else None
+        steps = [(name, re.compile(pattern))
+                 for name, pattern, per_atom in cls.progress_steps]
+        for line in data[:end].decode('utf-8', 'replace').splitlines():
+            if iteration is not None and iteration.search(line):
+                state['iterations'] += 1
+            m = error.search(line) if error is not None else None
+            if m is not None:
+                try:
+                    state['errors'].append(
+                                   abs(float(m.group(1).replace('D', 'E'))))
+                except ValueError:
+                    pass
+            for name, pattern in steps:
+                if pattern.search(line):
+                    state['steps'][name] += 1
+                    # Each step starts a new SCF
+                    state['errors'] = []
+        return True
+
+    def estimate(state, cls, atoms, now):
+        '''Describe the progress of an output and return the seconds left
+        (None if unknown) and whether the SCF is not converging'''
+        words, left, diverging = [], [], False
+        elapsed = now - state['start'] if state['start'] else None
+        if state['iterations']:
+            words.append('{0:d} iterations'.format(state['iterations']))
+        errors = [e for e in state['errors'] if e > 0][-8:]
+        if errors and cls.scf_target:
+            words.append('SCF error {0:.1e}'.format(errors[-1]))
+            if len(errors) >= 3 and errors[-1] > cls.scf_target:
+                slope = (log10(errors[-1]) - log10(errors[0])) \
+                        / (len(errors) - 1)
+                if slope >= 0 and len(errors) == 8:
+                    diverging = True
+                    words.append('not converging')
+                elif slope < 0 and elapsed and state['iterations']:
+                    per = float(elapsed) / state['iterations']
+                    left.append(per * (log10(cls.scf_target)
+                                       - log10(errors[-1])) / slope)
+        for name, pattern, per_atom in cls.progress_steps:
+            done = state['steps'][name]
+            if not done:
+                continue
+            if per_atom and atoms:
+                total = per_atom * atoms
+                words.append('{0} {1:d}/{2:d}'.format(name, done, total))
+                if elapsed and total > done:
+                    left.append(float(elapsed) / done * (total - done))
+            else:
+                words.append('{0} {1:d}'.format(name, done))
+        return ', '.join(words), (max(left) if left else None), diverging
+
+    def poll():
+        records = [r for r in read_job_log()
+                   if r.get('kind') != 'probe'
+                   and states.get(r['jobid']) not in ('completed', 'failed',
+                                                      'resubmitted')
+                   and (args.program is None
+                        or r['program'].lower() == args.program.lower())]
+        queue_types = set(r.get('queue_type') for r in records)
+        queues = dict((q, queue_states(q)) for q in queue_types)
+        now = time()
+        running, etas, rows = 0, [], []
+        for r in records:
+            queued = queues[r.get('queue_type')]
+            jobid = queue_jobid(r['jobid'])
+            if queued is None or queued.get(jobid) != 'running':
+                continue
+            running += 1
+            cls = globals().get(r['program'], Submittable)
+            paths = r.get('progress', r['outputs'])
+            features = r.get('features', [{}] * len(paths))
+            for i, (inp, out, path, feat) in enumerate(zip(r['inputs'],
+                                           r['outputs'], paths, features)):
+                path = path.replace('$SLURM_JOB_ID', jobid)
+                path = path.replace('$PBS_JOBID', r['jobid'])
+                path = os.path.join(r['cwd'], os.path.expandvars(path))
+                key = (r['jobid'], path)
+                if key not in followed:
+                    followed[key] = {'offset': 0, 'iterations': 0,
+                                     'errors': [], 'start': None,
+                                     'steps': dict((s[0], 0) for s in
+                                                   cls.progress_steps)}
+                state = followed[key]
+                if state['start'] is None:
+                    state['start'] = started(r, inp)
+                # Members of arrays and packs that finished stop writing
+                if cls.success_marker and any(output_complete(r['program'],
+                        os.path.join(r['cwd'], f)) for f in (path, out)):
+                    continue
+                if not follow(path, state, cls):
+                    rows.append((r['jobid'], inp, 'no output yet', ''))
+                    continue
+                words, left, diverging = estimate(state, cls,
+                                                  (feat or {}).get('atoms'),
+                                                  now)
+                quiet = now - os.path.getmtime(path)
+                if quiet > args.stall * 60:
+                    words = 'stalled, no output for {0:d} min'.format(
+                                                           int(quiet // 60))
+                if quiet > args.stall * 60 or diverging:
+                    left = None
+                    # Only the task of an array is cancelled, and a pack
+                    # is never cancelled for one of its members
+                    target = r['jobid']
+                    if r.get('kind') == 'array':
+                        target = target.replace('[]', '[{0:d}]'.format(i)) \
+                                 if '[]' in target \
+                                 else '{0}_{1:d}'.format(target, i)
+                    if args.kill and r.get('kind') == 'pack':
+                        words += ', not cancelled since it shares a pack'
+                    elif args.kill and target not in killed:
+                        cancel = 'qdel' if r.get('queue_type') == 'PBS' \
+                                 else 'scancel'
+                        try:
+                            status = call([cancel, target])
+                        except OSError as e:
+                            print('Could not run {0}: {1}'.format(cancel, e),
+                                  file=sys.stderr)
+                            status = None
+                        if status == 0:
+                            killed.add(target)
+                            words += ', cancelled'
+                elif left is not None:
+                    etas.append(left)
+                rows.append((r['jobid'], inp, words or 'started',
+                             '~' + hms(left) if left is not None else ''))
+        for row in rows:
+            print('  {0:<10} {1:<30} {2:<50} {3}'.format(*row))
+        print(strftime('%F %T'), '{0:d} running'.format(running) +
+              (', batch done in ~' + hms(max(etas)) if etas else ''))
+        return running
+
+    # inotify is not in the standard library, so the outputs are polled;
+    # each poll only reads what was added since the last one
+    while poll() and not args.once:
+        sleep(args.interval)
+
+
+def count_atoms(lines):
+    '''Count the lines that look like atomic coordinates, i.e. an element
+    label followed by three numbers.'''
+    from re import compile
+    coord = compile(r'^\s*[A-Za-z][A-Za-z]?\S*(\s+-?\d+\.?\d*){3}\s*')
+    return sum(1 for l in lines if coord.match(l))
+
+
+def input_block(lines, start, end=r'end\b'):
+    '''Return the lines after the first line matching the regular expression
+    start up to the line matching end (case-insensitive).'''
+    from re import match, IGNORECASE
+    block = None
+    for line in lines:
+        if block is None:
+            if match(r'\s*' + start, line, IGNORECASE):
+                block = []
+        elif match(r'\s*' + end, line, IGNORECASE):
+            break
+        else:
+            block.append(line)
+    return block if block is not None else []
+
+
+def memory_mb(amount, unit, word=8):
+    '''Convert an amount of memory in the given unit (b, kb, mb, gb, tb or
+    kw, mw, gw, which are words of word bytes) to MB.'''
+    unit = unit.lower()
+    scale = {'b': 1.0/1048576, 'k': 1.0/1024, 'm': 1.0, 'g': 1024.0,
+             't': 1048576.0}[unit[0] if unit[0] in 'bkmgt' else 'b']
+    if unit.endswith('w') or unit == 'w':
+        scale *= word
+    return float(amount) * scale
+
+
+def read_workflow(filename):
+    '''Read a workflow file and return its steps in dependency order as
+    a list of (name, options) pairs.'''
+    try:
+        from configparser import RawConfigParser
+    except ImportError:
+        from ConfigParser import RawConfigParser
+    wf = RawConfigParser()
+    if not wf.read(filename):
+        sys.exit('Cannot read workflow file ' + filename)
+
+    steps = {}
+    for name in wf.sections():
+        step = dict(wf.items(name))
+        step['after'] = step.get('after', '').replace(',', ' ').split()
+        if ('inputs' in step) == ('command' in step):
+            sys.exit('Workflow step [{0}] needs exactly one of inputs or '
+                     'command'.format(name))
+        for dep in step['after']:
+            if not wf.has_section(dep):
+                sys.exit('Workflow step [{0}] is after unknown step '
+                         '[{1}]'.format(name, dep))
+        steps[name] = step
+
+    # Order the steps so each comes after the steps it depends on
+    order, done = [], set()
+    while len(order) < len(steps):
+        ready = [n for n in wf.sections() if n not in done
+                 and all(d in done for d in steps[n]['after'])]
+        if not ready:
+            sys.exit('The steps of workflow {0} depend on each '
+                     'other in a cycle'.format(filename))
+        for n in ready:
+            order.append((n, steps[n]))
+            done.add(n)
+
+    # Steps whose inputs are made by a command can only be globbed once that
+    # command has run, so they are submitted from inside the queue later.
+    deferred = set()
+    for name, step in order:
+        if any(d in deferred or 'command' in steps[d] for d in step['after']):
+            deferred.add(name)
+        if step.get('defer', '').lower() in ('yes', 'true', '1'):
+            deferred.add(name)
+        elif step.get('defer', '').lower() in ('no', 'false', '0'):
+            deferred.discard(name)
+        step['deferred'] = name in deferred and 'inputs' in step
+    return order
+
+
+def run_workflow(filename, host, opts, subopts, only=None):
+    '''Submit a workflow of chained steps.  The workflow file is an INI file
+    where each section is a step, e.g.
+
+        [DEFAULT]
+        all = 1 16 24:00:00 2000
+
+        [freq]
+        inputs = freq.run
+
+        [displace]
+        after = freq
+        command = nmodes2numdiff.py -t template.run freq.out
+        wall = 0:30:00
+
+        [modes]
+        after = displace
+        inputs = mode*.run
+        array = yes
+
+        [collect]
+        after = modes
+        command = plot_RamanIR.py -r freq.out
+
+    A step has either inputs (globs, relative to the workflow file) or a shell
+    command, and may set after, nodes, ppn, wall, mem, all, array or pack.
+    On a queueing host every step is submitted at once with afterok
+    dependencies.  Steps whose inputs are created by an earlier command are
+    submitted by a small launcher job once that command has finished; the
+    launcher then moves the dependencies of later steps onto the new jobs.
+    On an interactive host the steps are simply run in order.'''
+    from copy import copy
+    from fcntl import flock, LOCK_EX
+    from glob import glob
+    from os.path import abspath, dirname, join, splitext
+    from shlex import quote
+    from subprocess import call
+
+    filename = abspath(filename)
+    wfdir = dirname(filename)
+    wfname = splitext(filename)[0]
+    order = read_workflow(filename)
+    jobfile = wfname + '.jobs'
+    queue = host.submit_type == 'queue'
+
+    def read_jobids():
+        '''The job IDs of steps that were already submitted'''
+        jobids = {}
+        with open(jobfile) as f:
+            for line in f:
+                name, ids = line.rstrip('\n').split('\t')
+                jobids[name] = ids.split()
+        return jobids
+
+    jobids = {}
+    if only:
+        jobids = read_jobids()
+        order = [(n, s) for n, s in order if n == only]
+        if not order:
+            sys.exit('No step [{0}] in workflow {1}'.format(only, filename))
+
+    def step_opts(step):
+        '''Copy the command line options with the step's overrides'''
+        o = copy(opts)
+        if 'all' in step:
+            o.nodes, o.ppn, o.wall, o.mem = step['all'].split()
+        for key in ('nodes', 'ppn', 'wall', 'mem'):
+            if key in step:
+                setattr(o, key, step[key])
+        # Only the walltime is not an integer
+        for key in ('nodes', 'ppn', 'mem'):
+            if getattr(o, key) is not None:
+                setattr(o, key, int(getattr(o, key)))
+        # A deferred step is launched once its dependencies are done
+        ids = [i for d in step['after'] for i in jobids.get(d, [])]
+        o.dependency = 'afterok:' + ':'.join(ids) if ids and not only else None
+        return o
+
+    # A deferred step is submitted from inside a job, where nobody can
+    # answer the questions about missing resources
+    needed = ['nodes', 'ppn', 'wall'] + \
+             (['mem'] if host.queue_type == 'SBATCH' else [])
+    for name, step in order:
+        o = step_opts(step)
+        missing = [k for k in needed if not getattr(o, k)]
+        if step['deferred'] and queue and not only and missing:
+            sys.exit('Workflow step [{0}] is submitted from inside a job, so '
+                     'it needs {1} in the workflow file or on the command '
+                     'line'.format(name, ', '.join(missing)))
+
+    # The launcher of a deferred step runs submit.py again with the options
+    # given here, for that one step
+    forward, skip = [], False
+    for arg in sys.argv[1:]:
+        if skip or arg in ('--workflow', '--step'):
+            skip = not skip
+        elif not arg.startswith(('--workflow=', '--step=')):
+            forward.append(arg)
+
+    for name, step in order:
+        print('Workflow step [{0}]'.format(name))
+        o = step_opts(step)
+        if 'command' in step or (step['deferred'] and queue and not only):
+            # Write the command, or the launcher of a deferred step, to a
+            # shell script and submit it as its own job.
+            sh = '{0}.{1}.sh'.format(wfname, name)
+            with open(sh, 'w') as f:
+                print('cd {0}'.format(wfdir), file=f)
+                if 'command' in step:
+                    print(step['command'], file=f)
+                else:
+                    launch = [sys.executable, abspath(__file__)] + forward + \
+                             ['--workflow', filename, '--step', name,
+                              '-A', opts.allocation]
+                    # Relative paths among the options are from here
+                    if os.getcwd() != wfdir:
+                        print('cd', quote(os.getcwd()), file=f)
+                    print(' '.join(quote(a) for a in launch), file=f)
+                    # The launcher itself is small
+                    o.nodes, o.ppn, o.wall = 1, 1, '0:30:00'
+            jobids[name] = [Shell(sh, host, o, []).submit()]
+        else:
+            inputs = []
+            for pattern in step['inputs'].split():
+                inputs.extend(sorted(glob(join(wfdir, pattern))))
+            if not inputs:
+                print('No inputs match', step['inputs'], file=sys.stderr)
+            jobs = [determine_file_type(f, host, o, subopts) for f in inputs]
+            jobs = [j for j in jobs if j is not None]
+            if queue and step.get('array', '').lower() in ('yes', 'true', '1'):
+                jobids[name] = submit_arrays(jobs, opts.array_size,
+                                             opts.array_limit)
+            elif queue and 'pack' in step:
+                jobids[name] = submit_packs(jobs, int(step['pack']),
+                                            opts.pack_cores)
+            else:
+                jobids[name] = [j.submit() for j in jobs]
+        jobids[name] = [i for i in jobids[name] if i]
+
+    if not queue:
+        return
+
+    if only:
+        # Move the dependencies of later steps from the launcher to the
+        # jobs that were just submitted.
+        for name, step in read_workflow(filename):
+            if only not in step['after']:
+                continue
+            ids = [i for d in step['after'] for i in jobids.get(d, [])]
+            depend = 'afterok:' + ':'.join(ids) if ids else ''
+            for jobid in jobids.get(name, []):
+                if host.queue_type == 'PBS':
+                    call(['qalter', '-W', 'depend='+depend, jobid])
+                else:
+                    call(['scontrol', 'update', 'JobId='+jobid,
+                          'Dependency='+depend])
+
+    # Remember the job IDs so that deferred steps can find them.  Launchers
+    # may finish at the same time, so each one adds its step to what is in
+    # the file under a lock.
+    with open(jobfile + '.lock', 'a') as lock:
+        flock(lock, LOCK_EX)
+        if only:
+            jobids = dict(read_jobids(), **{only: jobids[only]})
+        with open(jobfile, 'w') as f:
+            for name, ids in jobids.items():
+                print(name, ' '.join(ids), sep='\t', file=f)
+
+
 def determine_host(hostname):
     '''Return the correct host class based on the name'''
     if 'chem.psu.edu' in hostname:
@@ -301,6 +2575,54 @@ class Submittable(object):
     that are submittable.  This is intended to be subclassed and many
     of the methods may be overwritten.'''
 
+    # The shell the job script is written for
+    shell = 'bash'
+    # Text near the end of the output of a run that finished normally,
+    # or None if any non-empty output will do
+    success_marker = None
+    # Environment variables that identify the version of the program
+    version_env = ()
+    # An extended regular expression matching each iteration in the output,
+    # or None if the progress of the program cannot be followed
+    iteration_pattern = None
+    # A regular expression whose group is the error of each SCF iteration in
+    # the output, and the error at which the SCF has converged
+    scf_error = None
+    scf_target = None
+    # The other steps of a run to count in its output: their names, regular
+    # expressions and how many there are per atom (None if not known)
+    progress_steps = ()
+    # Extentions of other files that belong with the input
+    companions = ()
+    # How MPI ranks of this program are placed, or None for the host's
+    # default.  One of cores, sockets or none.
+    bind_policy = None
+    # Whether the program runs OpenMP threads, whose number and placement
+    # the job then sets
+    openmp = True
+    # Whether an unfinished run can be continued from its restart files,
+    # and an extended regular expression for the output of a run that
+    # ended without converging
+    chainable = False
+    unconverged_pattern = None
+    # Whether the program can run in the node-local directories that
+    # --bcast creates on every node
+    bcastable = False
+    # Glob patterns of the scratch files to archive after a run (None for
+    # all of them) and of those to leave out because they can be
+    # regenerated.  {name} is replaced by the base name of the input.
+    archive_include = None
+    archive_exclude = ()
+    # The expected size of the scratch files in GB per atom squared, or
+    # None to leave the striping of the scratch directory alone, and the
+    # Lustre stripe count and size for scratch files up to each size in GB
+    scratch_gb_per_atom2 = None
+    stripe_rules = ((1, 1, '1M'), (10, 4, '1M'), (100, 8, '4M'),
+                    (None, 16, '4M'))
+    # The walltime and memory already suggested from past runs, shared by
+    # every input of a batch
+    suggested = set()
+
     def __init__(self, filename, host, opts, subopts):
         '''Initiallizes the Submittable class, accepting the
         command-line arguments.'''
@@ -324,12 +2646,39 @@ class Submittable(object):
         self.exact        = opts.exact
         self.open         = opts.open
         self.lexclusive   = opts.lexclusive
+        self.dependency   = opts.dependency
+        self.spool        = opts.spool
+        self.workflow     = getattr(opts, 'workflow', None)
+        self.cache        = opts.cache
+        self.predict      = opts.predict
+        self.grace        = opts.grace
+        self.bind         = opts.bind
+        self.threads      = opts.threads
+        self.chain        = opts.chain
+        self.allocation   = opts.allocation
+        self.snapshot     = getattr(opts, 'queue_snapshot', None)
+        self.bcast        = opts.bcast
+        self.defaulted    = getattr(opts, 'defaulted', [])
+
+        if self.bcast and not self.bcastable:
+            print('Warning: --bcast is ignored for {0}'.format(
+                  type(self).__name__), file=sys.stderr)
+            self.bcast = False
+
+        # The hash of the input, once it is known
+        self.inputhash = None
+
+        # The file where a probe samples its progress, if this is a probe
+        self.samples = None
+        self.iterations = None
 
         # Keep the suboptions
         self.subopts = subopts
 
-        # Store the host information
+        # Store the host information, and the queue of the allocation,
+        # which -A auto chooses for each job
         self.host = host
+        self.queue = getattr(host, 'queue', None)
 
         # Grab the filename and extention separetely
         self.noext, self.ext = splitext(filename)
@@ -389,26 +2738,379 @@ class Submittable(object):
                 print(fs, file=f)
 
     def submit(self):
-        '''Submits the job'''
+        '''Submits the job.  Returns the job ID on a queueing host, or the
+        exit status of the program when it is run interactively.'''
 
         # See if the input file must be edited, and do so if necessary
         self.edit_input()
 
+        # Reuse the results of an identical input if there are any
+        if self.from_cache():
+            return None
+
         # Submit interactively
         if self.host.submit_type == 'interactive':
-            self.submit_interactive()
+            status = self.submit_interactive()
+            self.store_result()
             # Pull up output file if debugging
             if self.debug:
                 from subprocess import call
                 call([self.display_prog(), self.output['full']])
+            return status
 
         # Submit by queue
         else:
             if self.host.queue_type == 'PBS':
-                self.submit_PBS_queue()
+                return self.submit_PBS_queue()
             elif self.host.queue_type == 'SBATCH':
-                self.submit_SBATCH_queue()
+                return self.submit_SBATCH_queue()
+
+
+    def input_hash(self, current=False):
+        '''A hash of the normalized input together with the program, its
+        version and the contents of the other files the run reads, which
+        identifies the results of the calculation.  It is worked out once,
+        before the input is reconciled with the job, unless the hash of the
+        input as it is now is asked for.'''
+        from hashlib import sha1
+        if self.inputhash is not None and not current:
+            return self.inputhash
+        with open(self.input['full']) as f:
+            lines = [l.rstrip() for l in f.read().splitlines()]
+        while lines and not lines[-1]:
+            lines.pop()
+        h = sha1(type(self).__name__.encode())
+        for var in self.version_env:
+            h.update('{0}={1}\n'.format(var, os.environ.get(var, '')).encode())
+        h.update('\n'.join(lines).encode())
+        for name in self.cache_inputs():
+            h.update('\n{0}\n'.format(os.path.basename(name)).encode())
+            try:
+                with open(name, 'rb') as f:
+                    for block in iter(lambda: f.read(1 << 20), b''):
+                        h.update(block)
+            except IOError:
+                h.update(b'missing')
+        if current:
+            return h.hexdigest()
+        self.inputhash = h.hexdigest()
+        return self.inputhash
+
+    def cache_inputs(self):
+        '''The files besides the input that the run reads, i.e. the
+        companion, pseudopotential and restart files, whose contents are
+        part of the hash of the input.  May be overwritten by the subclass'''
+        companions = ['.'.join([self.noext['full'], ext])
+                      for ext in self.companions]
+        return [f for f in companions if os.path.isfile(f)] + \
+               list(self.psp or [])
+
+    def result_store(self, h=None):
+        '''The directory where the results of this input, or of the input
+        with hash h, are kept.'''
+        h = h if h else self.input_hash()
+        return os.path.join(submit_dir('results'), h[:2], h)
+
+    def result_suffixes(self):
+        '''The suffixes (after the input name) of the files that make up
+        the results of a job.  May be overwritten by the subclass'''
+        suffixes = [self.output['full'][len(self.noext['full'])+1:], 'tar.gz']
+        suffixes.extend(getattr(self, 'save_files', {}).values())
+        return suffixes
+
+    def from_cache(self):
+        '''Copy in the results of an identical input that ran to completion
+        instead of running this one.  Returns True if it did.'''
+        import json
+        from shutil import copy2
+        from os.path import join
+        if not self.cache:
+            return False
+        store = self.result_store()
+        try:
+            with open(join(store, 'result.json')) as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            return False
+        for suffix in meta['files']:
+            copy2(join(store, suffix), '.'.join([self.noext['full'], suffix]))
+        print('Reusing the results of {0} for {1}'.format(meta['input'],
+                                                          self.input['full']))
+        return True
+
+    def store_result(self):
+        '''Keep the results of a completed interactive job so that
+        identical inputs can reuse them.'''
+        import json
+        from shutil import copy2
+        from os.path import exists, join
+        if not self.cache:
+            return
+        if not output_complete(type(self).__name__, self.output['full']):
+            return
+        store = self.result_store()
+        if not os.path.isdir(store):
+            os.makedirs(store)
+        files = []
+        for suffix in self.result_suffixes():
+            name = '.'.join([self.noext['full'], suffix])
+            if exists(name):
+                copy2(name, join(store, suffix))
+                files.append(suffix)
+        with open(join(store, 'result.json'), 'w') as f:
+            json.dump({'input': self.input['full'], 'files': files}, f)
+
+    def store_commands(self):
+        '''The shell commands that keep the results of a completed queue
+        job so that identical inputs can reuse them.'''
+        if self.success_marker is None:
+            test = '[ -s {0} ]'.format(self.output['full'])
+        else:
+            test = "grep -q '{0}' {1} 2>/dev/null".format(self.success_marker,
+                                                          self.output['full'])
+        # The input was rewritten to match the job, so resubmitting it
+        # looks for the results under another hash
+        alias, now = '', self.input_hash(current=True)
+        if now != self.input_hash():
+            alias = '\n    mkdir -p {0} && ln -sfn {1} {2}'.format(
+                    os.path.dirname(self.result_store(now)), self.result_store(),
+                    self.result_store(now))
+        return dedent('''\
 
+          # Keep the results so that identical inputs can reuse them
+          if {test}; then
+              mkdir -p {store}
+              FILES=""
+              for SUFFIX in {suffixes}; do
+                  if [ -e {noext}.$SUFFIX ]; then
+                      cp -p {noext}.$SUFFIX {store}/$SUFFIX
+                      FILES="$FILES, \\"$SUFFIX\\""
+                  fi
+              done
+              echo "{{\\"input\\": \\"{inp}\\", \\"files\\": [${{FILES#, }}]}}" \\
+                  > {store}/result.json{alias}
+          fi
+          ''').format(test=test, store=self.result_store(), alias=alias,
+                      suffixes=' '.join(self.result_suffixes()),
+                      noext=self.noext['full'], inp=self.input['full']).rstrip()
+
+    def archive_rules(self):
+        '''The glob patterns of the files to include in and exclude from
+        the archive of the scratch directory.  These may be changed with
+        archive_include and archive_exclude in a section named after the
+        program in ~/.submitrc, e.g.
+
+            [nwchem]
+            archive_exclude = *.aoints.* *.gridpts.* *.movecs
+        '''
+        try:
+            from configparser import RawConfigParser
+        except ImportError:
+            from ConfigParser import RawConfigParser
+        include, exclude = self.archive_include, self.archive_exclude
+        rc = RawConfigParser()
+        rc.read(os.path.join(os.path.expanduser('~'), '.submitrc'))
+        section = type(self).__name__.lower()
+        if rc.has_option(section, 'archive_include'):
+            include = rc.get(section, 'archive_include').split()
+        if rc.has_option(section, 'archive_exclude'):
+            exclude = rc.get(section, 'archive_exclude').split()
+        # Never archive the archive itself
+        exclude = list(exclude) + ['*.tar.gz']
+        if include is not None:
+            include = [p.format(name=self.noext['base']) for p in include]
+        return include, [p.format(name=self.noext['base']) for p in exclude]
+
+    def archive(self, tarname, directory, threads=None):
+        '''Archive the scratch directory to tarname following the archive
+        rules.  The compression is done by pigz on all cores if it is
+        installed, otherwise by tarfile.'''
+        from fnmatch import fnmatch
+        from subprocess import Popen, PIPE
+        from os import cpu_count
+        try:
+            from shutil import which
+        except ImportError:
+            which = lambda prog: None
+        include, exclude = self.archive_rules()
+        names = sorted(n for n in os.listdir(directory)
+                       if (include is None or
+                           any(fnmatch(n, p) for p in include)) and
+                       not any(fnmatch(n, p) for p in exclude))
+        if which('pigz'):
+            threads = threads if threads else cpu_count()
+            with open(tarname, 'wb') as out:
+                tar = Popen(['tar', '-C', directory, '-cf', '-'] +
+                            ['--exclude='+p for p in exclude] + ['--'] + names,
+                            stdout=PIPE)
+                pigz = Popen(['pigz', '-p', str(threads)], stdin=tar.stdout,
+                             stdout=out)
+                tar.stdout.close()
+                pigz.communicate()
+                tar.wait()
+        else:
+            import tarfile
+            def keep(info):
+                name = os.path.basename(info.name)
+                return None if any(fnmatch(name, p) for p in exclude) \
+                            else info
+            with tarfile.open(tarname, 'w:gz') as tar:
+                for n in names:
+                    tar.add(os.path.join(directory, n), n, filter=keep)
+
+    def archive_commands(self, tarname, directory='.', threads=1):
+        '''The shell commands that archive the scratch directory to tarname
+        following the archive rules, compressing with pigz if the node
+        has it.'''
+        include, exclude = self.archive_rules()
+        return dedent('''\
+          # Archive the scratch files that cannot be regenerated
+          if command -v pigz >/dev/null 2>&1; then GZ="pigz -p {threads:d}"; else GZ=gzip; fi
+          (cd {dir} && tar -cf - {exclude} {include}) | $GZ > {tarname}
+          ''').format(threads=max(1, threads), dir=directory, tarname=tarname,
+                      exclude=' '.join("--exclude='{0}'".format(p)
+                                       for p in exclude),
+                      include=' '.join(include) if include else '.').rstrip()
+
+    def restore_commands(self, tarball, members):
+        '''The shell commands that extract members from tarball into the
+        current directory.  The tarball is extracted only once per content
+        into a cache in the scratch directory (or $SUBMIT_STAGE_CACHE),
+        with a lock so that packed or array jobs sharing one tarball wait
+        for the first to extract it.  The members are then cloned out of
+        the cache, since programs update their restart files in place.
+        Entries unused for two weeks are removed.'''
+        return dedent('''\
+          # Extract the restart files once per tarball content into a cache
+          CACHE=${{SUBMIT_STAGE_CACHE:-{cache}}}
+          KEY=$(sha1sum < {tarball} | cut -c1-40)
+          mkdir -p $CACHE
+          (
+              flock 9
+              if [ ! -d $CACHE/$KEY ]; then
+                  rm -rf $CACHE/$KEY.part && mkdir $CACHE/$KEY.part
+                  # Members missing from the tarball are not an error
+                  if tar -C $CACHE/$KEY.part -xzf {tarball} {members} ||
+                     tar -tzf {tarball} > /dev/null; then
+                      mv $CACHE/$KEY.part $CACHE/$KEY
+                  else
+                      echo "Could not extract {tarball}" >&2
+                      rm -rf $CACHE/$KEY.part
+                  fi
+              fi
+              [ -d $CACHE/$KEY ] && touch $CACHE/$KEY
+              find $CACHE -mindepth 1 -maxdepth 1 -mtime +14 -exec rm -rf {{}} +
+          ) 9>$CACHE/$KEY.lock
+          for F in {members}; do
+              [ -e $CACHE/$KEY/$F ] && cp --reflink=auto $CACHE/$KEY/$F .
+          done
+          ''').format(cache=os.path.join(self.host.scratch, '.stage-cache'),
+                      tarball=tarball, members=' '.join(members))
+
+    def stripe(self):
+        '''The Lustre stripe count and size for the scratch directory,
+        chosen by the expected size of the scratch files, or None if it is
+        not known.  They may be fixed with stripe_count and stripe_size in
+        a section named after the program in ~/.submitrc, e.g.
+
+            [adf]
+            stripe_count = 8
+            stripe_size = 4M
+        '''
+        try:
+            from configparser import RawConfigParser
+        except ImportError:
+            from ConfigParser import RawConfigParser
+        rc = RawConfigParser()
+        rc.read(os.path.join(os.path.expanduser('~'), '.submitrc'))
+        section = type(self).__name__.lower()
+        if rc.has_option(section, 'stripe_count'):
+            size = rc.get(section, 'stripe_size') \
+                   if rc.has_option(section, 'stripe_size') else '1M'
+            try:
+                return rc.getint(section, 'stripe_count'), size
+            except ValueError:
+                print('Warning: stripe_count of [{0}] in ~/.submitrc is not '
+                      'a number, ignoring it'.format(section), file=sys.stderr)
+        if self.scratch_gb_per_atom2 is None:
+            return None
+        atoms = self.features().get('atoms')
+        if not atoms:
+            return None
+        gb = self.scratch_gb_per_atom2 * atoms**2
+        for limit, count, size in self.stripe_rules:
+            if limit is None or gb <= limit:
+                return count, size
+
+    def stripe_commands(self, directory='.'):
+        '''The shell commands that stripe directory over several Lustre
+        OSTs, so the large scratch files of the program are not all
+        written to one.  They do nothing where lfs is missing or the
+        directory is not on Lustre, such as a node-local $TMPDIR.'''
+        stripe = self.stripe()
+        if stripe is None or not self.host.lustre or self.bcast:
+            return ''
+        return dedent('''\
+          # Stripe the scratch files over {count:d} OST(s) if this is Lustre
+          if command -v lfs >/dev/null 2>&1 &&
+             df -t lustre {dir} >/dev/null 2>&1; then
+              lfs setstripe -c {count:d} -S {size} {dir} || true
+          fi''').format(count=stripe[0], size=stripe[1], dir=directory)
+
+    def local_dir(self):
+        '''The node-local directory the job runs in with --bcast.  It is
+        named after the job so packed and array jobs do not share it.'''
+        jobid = '$PBS_JOBID' if self.host.queue_type == 'PBS' \
+                else '$SLURM_JOB_ID'
+        return os.path.join(self.host.temp, '.'.join([self.noext['base'],
+                                                      jobid]))
+
+    def work_dir(self, shared):
+        '''The directory the program runs in: the node-local one with
+        --bcast, otherwise the shared one.'''
+        return self.local_dir() if self.bcast else shared
+
+    def bcast_commands(self, files, local):
+        '''The shell commands that create the directory local on every
+        node of the job and copy the files, pairs of source and name, into
+        it.  sbcast sends each file over the interconnect once rather than
+        having every node read it from the shared filesystem; where it is
+        missing the nodes copy it themselves.  Sources that do not exist
+        are skipped, so restart files may be optional.'''
+        lines = ['# Broadcast the files to node-local storage on every node']
+        if self.host.queue_type == 'PBS':
+            copies = ' && '.join('{{ [ ! -e {0} ] || cp {0} {1}/{2}; }}'
+                                 .format(src, local, name)
+                                 for src, name in files)
+            lines.append('for NODE in $(sort -u $PBS_NODEFILE); do')
+            lines.append('    ssh $NODE "mkdir -p {0}{1}" &'.format(
+                         local, ' && ' + copies if copies else ''))
+            lines.append('done')
+            lines.append('wait')
+        else:
+            srun = 'srun --nodes=$SLURM_NNODES --ntasks=$SLURM_NNODES ' \
+                   '--ntasks-per-node=1'
+            lines.append('{0} mkdir -p {1}'.format(srun, local))
+            for src, name in files:
+                lines.append('if [ -e {0} ]; then'.format(src))
+                lines.append('    sbcast -f {0} {1}/{2} 2>/dev/null ||'
+                             .format(src, local, name))
+                lines.append('        {0} cp {1} {2}/{3}'
+                             .format(srun, src, local, name))
+                lines.append('fi')
+        return '\n'.join(lines)
+
+    def bcast_cleanup(self, local):
+        '''The shell commands that remove the node-local directory from
+        every node once the results have been gathered.'''
+        if self.host.queue_type == 'PBS':
+            return dedent('''\
+              for NODE in $(sort -u $PBS_NODEFILE); do
+                  ssh $NODE "rm -rf {0}" &
+              done
+              wait''').format(local)
+        return ('srun --nodes=$SLURM_NNODES --ntasks=$SLURM_NNODES '
+                '--ntasks-per-node=1 rm -rf {0}'.format(local))
 
     def create_script(self, **kwargs) -> str:
         '''Creates the .script file used for submitting on queueing hosts.
@@ -421,19 +3123,23 @@ class Submittable(object):
         pass
 
     def copy_input(self, tmpdir):
-        '''Copies input to the temp directory.
-        May be overwritten by the subclass'''
-        from shutil import copy
+        '''Stages input to the temp directory.  Returns the staging
+        statistics.  May be overwritten by the subclass'''
         import os.path
         from os.path import join
         # hack to get TAPE21 and TAPE16 files into scratch for densf calculations
+        # ADF writes to its TAPE files, so they must not be linked
+        tapes = []
         bases = os.path.splitext(self.input['full'])[0]
         if (os.path.isfile(bases+".t21")):
-             copy(bases+".t21", join(tmpdir, "TAPE21"))
+             tapes.append((bases+".t21", join(tmpdir, "TAPE21")))
         if (os.path.isfile(bases+".t16")):
-             copy(bases+".t16", join(tmpdir, "TAPE16"))
+             tapes.append((bases+".t16", join(tmpdir, "TAPE16")))
+        stats = stage_files(tapes)
 
-        copy(self.input['full'], join(tmpdir, self.input['base']))
+        return stage_files([(self.input['full'],
+                             join(tmpdir, self.input['base']))],
+                           readonly=True, stats=stats)
 
     def add_input(self, arguments):
         '''Appends the input files to the executable statement
@@ -458,104 +3164,38 @@ class Submittable(object):
         May be overwritten by the subclass'''
         return 'less'
 
-    def submit_PBS_queue(self):
-        '''Submits the file on the PBS queueing system.'''
-        from subprocess import call
-        from os import chmod, environ
-
-        # If a required argument is missing, request it from the user now
-        n = 'How many nodes do you want assigned? [{0}] '
-        n = n.format(self.host.defaultnodes)
-        p = 'How many processors per node? [{0}] '.format(self.host.defaultppn)
-        w = 'Requested wall clock time? [{0}] '.format(self.host.defaultwall)
-        m = 'How much memory per processor do you want (MB) [{0}] '
-        m = m.format(self.host.defaultmem)
-        print('File', self.input['full'])
-        nodes = self.nodes if self.nodes else raw_input(n)
-        ppn   = self.ppn   if self.ppn   else raw_input(p)
-        wall  = self.wall  if self.wall  else raw_input(w)
-        mem   = self.mem   if self.mem   else raw_input(m)
-
-        # Default the values if none are still given
-        nodes = nodes if nodes else self.host.defaultnodes
-        ppn   = ppn   if ppn   else self.host.defaultppn
-        wall  = wall  if wall  else self.host.defaultwall
-        mem   = mem   if mem   else self.host.defaultmem
+    def request_resources(self):
+        '''Returns the nodes, ppn, wall and mem for this job.  Missing values
+        are requested from the user, then defaulted and checked against
+        the host limits.'''
 
-        # Make sure that the options are the correct type
-        nodes, ppn, wall, mem = self.host.type_check(nodes, ppn, wall, mem)
-        # Check that the values are OK and format them
-        if self.check_limits: self.host.check_limits(nodes, ppn, wall, mem)
+        # Defaults for this program in ~/.submitrc replace the host's
+        defaults = dict(nodes=self.host.defaultnodes, ppn=self.host.defaultppn,
+                        wall=self.host.defaultwall, mem=self.host.defaultmem)
+        defaults.update(self.program_defaults())
+        for name in self.defaulted:
+            setattr(self, name, defaults[name])
 
-        # Open the submit script and create it
-        script = '.'.join([self.noext['full'], 'script'])
-        with open(script, 'w') as sc:
-            # Q-Chem is a little more particular
-            if self.ext == 'qchem':
-                print('#!/bin/csh', file=sc)
-            print('#', file=sc)
-            if self.exact: print('#PBS -W x=nmatchpolicy:exactnode', file=sc)
-            if ppn == -1:
-                procs = '#PBS -l nodes={0[0]:d}'
-            else:
-                procs = '#PBS -l nodes={0[0]:d}:ppn={0[1]:d}'
-            print(procs.format([nodes, ppn]), file=sc)
-            print('#PBS -l walltime={0}'.format(self.host.td2hms(wall)),
-                                                file=sc)
-            # Add memory request if necessary
-            if mem is not None:
-                print('#PBS -l pmem={0:d}mb'.format(mem), file=sc)
-            # Direct output to correct files
-            print('#PBS -j eo', file=sc)
-
-            print('#PBS -e {name}.err'.format(name=self.noext['full']), file=sc)
-            # Add email options
-           #print('#PBS -m ae', file=sc)
-           #print('#PBS -M {user}@psu.edu'.format(user=environ['USER']),
-           #                                file=sc)
-            # Create the remainder of the script
-            print(self.create_script(pp=abs(nodes*ppn)), file=sc)
+        # Use the core count that the scaling probes found best
+        if not (self.nodes or self.ppn):
+            self.probed_cores()
 
-        # Make the script executable
-        chmod(script, 0o755)
-
-        # The job name can only be 15 bytes and must begin with a letter
-        jobname = self.noext['base'][0:15]
-        if jobname[0].isdigit(): jobname = 'q'+jobname[1:]
-
-        # Submit the script unless otherwise directed
-        if not self.script:
-            print('Submitting {0} job {1}...'.format(type(self).__name__,
-                                                     self.noext['base']))
-            if self.open:
-                call(['qsub', '-N', jobname, script])
-            else:
-                call(['qsub', '-A','%s'%(self.host.queue),'-N',jobname, script])
-            print()
-        else:
-            from os.path import relpath
-            script = relpath(script)
-            print('Wrote {0} job script {1}...'.format(type(self).__name__,
-                                                       script))
-            print('Submit with "qsub -N {0} {1}"'.format(jobname, script))
-            print()
-
-    def submit_SBATCH_queue(self):
-        '''Submits the file on the SBATCH queueing system.'''
-        from subprocess import call
-        from os import chmod, environ
+        # Fill in or suggest the walltime and memory from past runs
+        if not (self.wall and self.mem):
+            self.predict_resources()
 
         # If a required argument is missing, request it from the user now
         n = 'How many nodes do you want assigned? [{0}] '
-        n = n.format(self.host.defaultnodes)
-        p = 'How many processors per node? [{0}] '.format(self.host.defaultppn)
-        w = 'Requested wall clock time? [{0}] '.format(self.host.defaultwall)
+        n = n.format(defaults['nodes'])
+        p = 'How many processors per node? [{0}] '.format(defaults['ppn'])
+        w = 'Requested wall clock time? [{0}] '.format(defaults['wall'])
         m = 'How much memory per processor do you want (MB) [{0}] '
-        m = m.format(self.host.defaultmem)
+        m = m.format(defaults['mem'])
         print('File', self.input['full'])
-        if 'stampede3.tacc.utexas.edu' in self.host.name:
-            self.lexclusive = True
-        if self.lexclusive:
+        if self.host.queue_type == 'SBATCH':
+            if 'stampede3.tacc.utexas.edu' in self.host.name:
+                self.lexclusive = True
+        if self.host.queue_type == 'SBATCH' and self.lexclusive:
             nodes = self.nodes if self.nodes else raw_input(n)
             wall  = self.wall  if self.wall  else raw_input(w)
             # ppn   = self.ppn   if self.ppn   else raw_input(p)
@@ -569,77 +3209,598 @@ class Submittable(object):
             mem   = self.mem   if self.mem   else raw_input(m)
 
         # Default the values if none are still given
-        nodes = nodes if nodes else self.host.defaultnodes
-        ppn   = ppn   if ppn   else self.host.defaultppn
-        wall  = wall  if wall  else self.host.defaultwall
-        # mem   = mem   if mem   else self.host.defaultmem
+        nodes = nodes if nodes else defaults['nodes']
+        ppn   = ppn   if ppn   else defaults['ppn']
+        wall  = wall  if wall  else defaults['wall']
+        if self.host.queue_type == 'PBS':
+            mem   = mem   if mem   else defaults['mem']
 
         # Make sure that the options are the correct type
         nodes, ppn, wall, mem = self.host.type_check(nodes, ppn, wall, mem)
         # Check that the values are OK and format them
         if self.check_limits: self.host.check_limits(nodes, ppn, wall, mem)
 
+        return nodes, ppn, wall, mem
+
+    def program_defaults(self):
+        '''The nodes, ppn, wall and mem given for this program in a section
+        of ~/.submitrc named after it, or after the cluster and it as
+        suggested by "submit.py efficiency", which takes precedence:
+
+            [stampede3.nwchem]
+            ppn = 8
+            wall = 6:00:00
+            mem = 1200
+        '''
+        try:
+            from configparser import RawConfigParser
+        except ImportError:
+            from ConfigParser import RawConfigParser
+        rc = RawConfigParser()
+        rc.read(os.path.join(os.path.expanduser('~'), '.submitrc'))
+        program = type(self).__name__.lower()
+        defaults = {}
+        for section in (program, '.'.join([cluster(self.host.name), program])):
+            defaults.update((name, rc.get(section, name))
+                            for name in ('nodes', 'ppn', 'wall', 'mem')
+                            if rc.has_option(section, name))
+        return defaults
+
+    def features(self):
+        '''The properties of the input that the cost of a calculation
+        depends on: the number of atoms, the basis and the type of
+        calculation.  Unknown properties are None.
+        May be overwritten by the subclass'''
+        return {'atoms': None, 'basis': None, 'calctype': None}
+
+    def predict_resources(self):
+        '''Predict the walltime and memory per processor from past runs of
+        this program with a similar input.  They are filled in if --predict
+        was given, otherwise they are only suggested.'''
+        nodes = int(self.nodes if self.nodes else self.host.defaultnodes)
+        ppn = int(self.ppn if self.ppn else self.host.defaultppn)
+        cores = nodes if ppn < 1 else nodes * ppn
+        guess = predict_resources(type(self).__name__, self.features(), cores)
+        if guess is None:
+            return
+        wall, mem, nruns = guess
+        if self.predict:
+            self.wall = self.wall if self.wall else wall
+            self.mem  = self.mem  if self.mem  else mem
+            print('Predicted from {0:d} past runs: --wall {1} --mem {2:d}'
+                  .format(nruns, self.wall, self.mem))
+        elif (wall, mem) not in self.suggested:
+            # A batch of similar inputs gets the same suggestion once
+            self.suggested.add((wall, mem))
+            print('Suggested from {0:d} past runs: --wall {1} --mem {2:d}'
+                  .format(nruns, wall, mem))
+
+    def spread_cores(self, cores):
+        '''The nodes and processors per node to run on cores processors,
+        spread evenly over as few nodes as the host allows.'''
+        nodes = max(1, -(-cores // self.host.maxppn))
+        return nodes, -(-cores // nodes)
+
+    def probed_cores(self):
+        '''Set the nodes and processors per node to the best core count
+        found by the scaling probes of this program, if there are any.'''
+        best = best_cores(type(self).__name__, self.features(),
+                          cluster(self.host.name))
+        if best is None:
+            return
+        cores, atoms = best
+        self.nodes, self.ppn = self.spread_cores(cores)
+        print('Scaling probes of {0:d} atoms chose {1:d} cores: -n {2:d} '
+              '-p {3:d}'.format(atoms, cores, self.nodes, self.ppn))
+
+    def progress_file(self):
+        '''The file the program writes its iterations to while it runs.
+        May be overwritten by the subclass'''
+        return self.output['full']
+
+    def probe_commands(self):
+        '''The shell commands that sample the number of iterations done
+        during a probe, and cancel the probe once it has done enough.'''
+        cancel = 'qdel $PBS_JOBID' if self.host.queue_type == 'PBS' \
+                 else 'scancel $SLURM_JOB_ID'
+        return dedent('''\
+          # Sample the progress of this probe, and stop after {iters:d} iterations
+          (
+              while sleep 5; do
+                  N=$(grep -ciE '{pattern}' {progress} 2>/dev/null)
+                  echo "$(date +%s) ${{N:-0}}" >> {samples}
+                  if [ "${{N:-0}}" -ge {iters:d} ]; then
+                      {cancel}
+                  fi
+              done
+          ) &
+          ''').format(iters=self.iterations, pattern=self.iteration_pattern,
+                      progress=self.progress_file(), samples=self.samples,
+                      cancel=cancel)
+
+    def checkpoint_commands(self):
+        '''The shell commands that save the restart files and partial output
+        of a job that is about to run out of walltime, or None if there is
+        nothing to save.  May be overwritten by the subclass'''
+        return None
+
+    def phase(self, name):
+        '''The shell command that marks the start of a phase of the job,
+        in a form that both bash and csh run.'''
+        return 'date "+{0} %s" >> {1}.phases'.format(name, self.noext['full'])
+
+    def phases(self):
+        '''The phase marks for the job script templates, as t_ followed
+        by the name of the phase.'''
+        return dict(('t_'+name, self.phase(name)) for name in
+                    ('modules', 'stagein', 'restart', 'compute', 'archive',
+                     'copyback'))
+
+    def timing_commands(self):
+        '''The shell commands that end the timing of the job and turn the
+        phase marks into a JSON sidecar next to the output, with the start
+        and end times and the seconds spent in each phase.  The awk program
+        is one line without a "!", so that csh runs it as well.'''
+        awk = (r'{n[NR] = $1; t[NR] = $2} END {printf "{\"start\": %d, '
+               r'\"end\": %d, \"phases\": {", t[1], t[NR]; '
+               r'for (i = 1; i < NR; i++) {if ((n[i] in d) == 0) o[++k] = n[i]; '
+               r'd[n[i]] += t[i+1] - t[i]} '
+               r'for (j = 1; j <= k; j++) printf "%s\"%s\": %d", '
+               r'(j > 1 ? ", " : ""), o[j], d[o[j]]; print "}}"}')
+        phases = self.noext['full'] + '.phases'
+        return '\n'.join(['# Write the time spent in each phase of the job',
+                          self.phase('end'),
+                          "awk '" + awk + "' " + phases + ' > ' +
+                          self.noext['full'] + '.timing.json && rm -f ' +
+                          phases])
+
+    def cache_modules(self, script):
+        '''Replace each run of module commands in the job script with the
+        environment they produce, from a snapshot in submit_dir that is
+        taken by the first job that needs it.  The snapshot is named after
+        the host, program, version of the module system and the module
+        commands, so changing the modules makes a new one, and it is taken
+        again if MODULEPATH or the module system changed or it is a week
+        old.  It holds only the exported variables and functions that the
+        module commands set, change or unset, so nothing belonging to the
+        job that took it leaks into the others.  They are compared by name
+        and value in bash itself and written back with printf %q and
+        declare -f, so values with newlines and exported functions survive.
+        csh scripts are left alone.'''
+        from hashlib import sha1
+        from re import match
+        if self.shell != 'bash':
+            return script
+        runs, lines = [], script.split('\n')
+        for i, line in enumerate(lines):
+            if match(r'\s*module\s+(purge|load|add|unload|rm|swap|switch|use)\b',
+                     line):
+                if runs and runs[-1][1] == i:
+                    runs[-1][1] = i + 1
+                else:
+                    runs.append([i, i + 1])
+        cache = submit_dir('modules')
+        # Lmod and Environment Modules export their version
+        version = os.environ.get('LMOD_VERSION',
+                                 os.environ.get('MODULE_VERSION', ''))
+        for start, end in reversed(runs):
+            commands = [l.strip() for l in lines[start:end]]
+            key = sha1('\n'.join([self.host.name, type(self).__name__,
+                                  version] + commands).encode()).hexdigest()
+            snapshot = dedent('''\
+              # Set up the environment of these modules from a snapshot
+              MODENV={env}
+              MODHEAD="# MODULEPATH=$MODULEPATH ${{LMOD_VERSION:-$MODULE_VERSION}}"
+              if [ -r $MODENV ] && [ -n "$(find $MODENV -mtime -7)" ] &&
+                 [ "$(head -1 $MODENV)" = "$MODHEAD" ]; then
+                  . $MODENV
+              else
+                  declare -A MODVARS MODFUNCS
+                  for MODV in $(compgen -e); do MODVARS[$MODV]=${{!MODV}}; done
+                  for MODF in $(declare -Fx | cut -d' ' -f3); do
+                      MODFUNCS[$MODF]=$(declare -f $MODF)
+                  done
+                  {commands}
+                  {{
+                      echo "$MODHEAD"
+                      for MODV in $(compgen -e); do
+                          [ "$MODV" = _ ] && continue
+                          if [ -z "${{MODVARS[$MODV]+set}}" ] ||
+                             [ "${{MODVARS[$MODV]}}" != "${{!MODV}}" ]; then
+                              printf 'export %s=%q\\n' "$MODV" "${{!MODV}}"
+                          fi
+                      done
+                      for MODV in "${{!MODVARS[@]}}"; do
+                          [ -n "${{!MODV+set}}" ] || echo "unset $MODV"
+                      done
+                      for MODF in $(declare -Fx | cut -d' ' -f3); do
+                          if [ "${{MODFUNCS[$MODF]}}" != "$(declare -f $MODF)" ]; then
+                              declare -f $MODF
+                              echo "export -f $MODF"
+                          fi
+                          unset "MODFUNCS[$MODF]"
+                      done
+                      for MODF in "${{!MODFUNCS[@]}}"; do
+                          if declare -F $MODF >/dev/null; then
+                              echo "export -fn $MODF"
+                          else
+                              echo "unset -f $MODF"
+                          fi
+                      done
+                  }} > $MODENV.$$ && mv $MODENV.$$ $MODENV
+                  unset MODVARS MODFUNCS MODV MODF
+              fi''').format(env=os.path.join(cache, key + '.sh'),
+                            commands='\n    '.join(commands))
+            lines[start:end] = [snapshot]
+        return '\n'.join(lines)
+
+    def binding_commands(self, packed=False):
+        '''The environment that places the MPI ranks and OpenMP threads of
+        the job, for srun, Open MPI and Intel MPI alike, so that it also
+        applies to programs that start MPI themselves.  Packed jobs share
+        their nodes, so only srun, which knows the cores of each member's
+        job step, binds them.'''
+        bind = self.bind or self.bind_policy or self.host.bind
+        threads = self.threads
+        env = []
+        if bind == 'cores':
+            env.append(('SLURM_CPU_BIND', 'cores'))
+            env.append(('SLURM_DISTRIBUTION', 'block:block'))
+            env.append(('OMPI_MCA_hwloc_base_binding_policy', 'core'))
+            if threads > 1:
+                env.append(('OMPI_MCA_rmaps_base_mapping_policy',
+                            'slot:PE={0:d}'.format(threads)))
+            env.append(('I_MPI_PIN', '1'))
+            env.append(('I_MPI_PIN_DOMAIN', 'core' if threads == 1 else
+                                            '{0:d}:compact'.format(threads)))
+        elif bind == 'sockets':
+            env.append(('SLURM_CPU_BIND', 'sockets'))
+            env.append(('SLURM_DISTRIBUTION', 'block:cyclic'))
+            env.append(('OMPI_MCA_hwloc_base_binding_policy', 'socket'))
+            env.append(('OMPI_MCA_rmaps_base_mapping_policy', 'socket'))
+            env.append(('I_MPI_PIN', '1'))
+            env.append(('I_MPI_PIN_DOMAIN', 'socket'))
+        else:
+            env.append(('SLURM_CPU_BIND', 'none'))
+            env.append(('OMPI_MCA_hwloc_base_binding_policy', 'none'))
+            env.append(('I_MPI_PIN', '0'))
+        if packed:
+            env = [(k, v) for k, v in env if not k.startswith(('OMPI', 'I_'))]
+            env.extend([('OMPI_MCA_hwloc_base_binding_policy', 'none'),
+                        ('I_MPI_PIN', '0')])
+        if self.openmp:
+            env.append(('OMP_NUM_THREADS', str(threads)))
+        if self.openmp and bind != 'none':
+            env.extend([('OMP_PLACES', 'cores'), ('OMP_PROC_BIND', 'close')])
+        export = 'setenv {0} {1}' if self.shell == 'csh' else 'export {0}={1}'
+        lines = ['# Place the ranks: bind to {0}, {1:d} thread(s) per rank'
+                 .format(bind, threads)]
+        lines.extend(export.format(k, v) for k, v in env)
+        return '\n'.join(lines) + '\n'
+
+    def reconcile_input(self, pp, mem):
+        '''Make the parallelism and memory directives of the input match
+        the pp processors and mem MB per processor of the job, adding the
+        directives that are missing and warning about those that do not
+        match.  May be overwritten by the subclass'''
+        pass
+
+    def rewrite_input(self, text):
+        '''Replace the input with text, keeping the input as it was given
+        next to it with a .orig extension.'''
+        from shutil import copy2
+        copy2(self.input['full'], self.input['full'] + '.orig')
+        with open(self.input['full'], 'w') as f:
+            f.write(text)
+
+    def preflight(self):
+        '''Quick checks for mistakes that would make the job fail as soon
+        as it starts: the syntax of the input, the files it refers to and
+        the program itself.  Returns a list of the problems found.
+        May be overwritten by the subclass'''
+        return []
+
+    def missing(self, files, what):
+        '''The problems for those of files that do not exist.'''
+        return ['{0} {1} does not exist'.format(what, f) for f in files
+                if not os.path.exists(f)]
+
+    def program_problems(self, var, default):
+        '''The problem if the program named by the environment variable var
+        does not exist.  Without var the job runs default, which is only
+        where the program is on some hosts, so its absence is a warning
+        rather than a reason to skip the input.'''
+        if var in os.environ:
+            return self.missing([os.environ[var]], 'Program')
+        if not os.path.exists(default):
+            print('Warning: ${0} is not set and {1} does not exist here, so '
+                  'the job of {2} may not find the program'.format(
+                  var, default, self.input['base']), file=sys.stderr)
+        return []
+
+    def syntax_check(self, command):
+        '''The problem reported by a syntax checker that failed on the
+        input, if any.'''
+        from subprocess import Popen, PIPE, STDOUT
+        check = Popen(command + [self.input['full']], stdout=PIPE,
+                      stderr=STDOUT, universal_newlines=True)
+        out = check.communicate()[0].strip()
+        return [out or 'syntax error'] if check.returncode else []
+
+    def mismatch(self, directive, wanted):
+        '''Warn that a directive of the input does not match the job.'''
+        print('Warning: {0} has {1} but the job {2}'.format(
+              self.input['base'], directive, wanted), file=sys.stderr)
+
+    def chain_commands(self, resources):
+        '''The shell commands that submit a job continuing this one from
+        its restart files, if the walltime ran out (the checkpoint trap
+        fired) or the output shows that the run did not converge, or None if
+        there should be no continuation.  Runs that failed for any other
+        reason are not continued.'''
+        if not (self.chain and self.chainable) or self.samples:
+            return None
+        from os.path import abspath
+        nodes, ppn, wall, mem = resources
+        unfinished = '[ -n "$CHECKPOINTED" ]'
+        if self.unconverged_pattern is not None:
+            unfinished += " || grep -qiE '{0}' {1} 2>/dev/null".format(
+                                 self.unconverged_pattern, self.output['full'])
+        submit = [sys.executable, abspath(__file__), '-r', self.noext['full'],
+                  '-n', str(nodes), '-p', str(ppn),
+                  '-w', self.host.td2hms(wall), '--chain', str(self.chain-1),
+                  '--grace', str(self.grace), '-A', self.allocation,
+                  '-s', self.host.scratch, '--no-cache']
+        if mem: submit += ['-m', str(mem)]
+        if not self.check_limits: submit.append('--nolimit')
+        if self.bcast: submit.append('--bcast')
+        return dedent('''\
+          # Continue from the restart files if the walltime ran out or the
+          # run did not converge
+          if {unfinished}; then
+              cd {dir} && {submit} {inp}
+          fi
+          ''').format(unfinished=unfinished, dir=self.path,
+                      submit=' '.join(submit),
+                      inp=self.input['full']).rstrip()
+
+    def checkpoint_script(self, chain=None):
+        '''The trap that runs the checkpoint commands when the queue warns
+        that the walltime is running out (USR1 on SLURM, TERM on PBS), or
+        None if there are none.  The chain commands, if any, are run after
+        the checkpoint.  csh scripts and probes are not checkpointed.'''
+        from textwrap import indent
+        commands = self.checkpoint_commands()
+        if commands is None or self.shell != 'bash' or self.samples:
+            return None
+        commands = '\n'.join([commands, self.timing_commands()])
+        if chain is not None:
+            commands = '\n'.join([commands, chain])
+        return dedent('''\
+          # Save the restart files and partial output if the walltime runs out
+          checkpoint() {{
+              trap '' USR1 TERM
+              CHECKPOINTED=1
+              echo "$(date '+%F %T') walltime running out, saving restart files" >&2
+          {commands}
+              exit 1
+          }}
+          trap checkpoint USR1 TERM
+          ''').format(commands=indent(commands, '    '))
+
+    def jobname(self):
+        '''The job name can only be 15 bytes and must begin with a letter'''
+        jobname = self.noext['base'][0:15]
+        if jobname[0].isdigit(): jobname = 'q'+jobname[1:]
+        return jobname
+
+    def write_PBS_header(self, sc, nodes, ppn, wall, mem, errfile=None,
+                         shell=None):
+        '''Writes the #PBS directives of a job script to the open file sc.'''
+        # Q-Chem is a little more particular
+        if (shell or self.shell) == 'csh':
+            print('#!/bin/csh', file=sc)
+        print('#', file=sc)
+        if self.exact: print('#PBS -W x=nmatchpolicy:exactnode', file=sc)
+        if ppn == -1:
+            procs = '#PBS -l nodes={0[0]:d}'
+        else:
+            procs = '#PBS -l nodes={0[0]:d}:ppn={0[1]:d}'
+        print(procs.format([nodes, ppn]), file=sc)
+        print('#PBS -l walltime={0}'.format(self.host.td2hms(wall)),
+                                            file=sc)
+        # Add memory request if necessary
+        if mem is not None:
+            print('#PBS -l pmem={0:d}mb'.format(mem), file=sc)
+        # Direct output to correct files
+        print('#PBS -j eo', file=sc)
+
+        if errfile is None:
+            errfile = '{name}.err'.format(name=self.noext['full'])
+        print('#PBS -e {0}'.format(errfile), file=sc)
+        # Add email options
+       #print('#PBS -m ae', file=sc)
+       #print('#PBS -M {user}@psu.edu'.format(user=environ['USER']),
+       #                                file=sc)
+
+    def write_SBATCH_header(self, sc, nodes, ppn, wall, mem, errfile=None,
+                            shell=None):
+        '''Writes the #SBATCH directives of a job script to the open file
+        sc.'''
+        # Q-Chem is a little more particular
+        if (shell or self.shell) == 'csh':
+            print('#!/bin/csh', file=sc)
+        else:
+            print('#!/bin/bash', file=sc)
+        print('#', file=sc)
+        # print(self.lexclusive)
+
+        print('#SBATCH --time={0}'.format(self.host.td2hms(wall)),
+                                            file=sc)
+        print("#SBATCH --nodes={0:}".format(nodes), file=sc)
+
+
+        if self.lexclusive:
+            print("#SBATCH --exclusive", file=sc)
+        #else:
+        if ppn != -1:
+            print("#SBATCH --ntasks-per-node={0:}".format(ppn // self.threads),
+                  file=sc)
+            if self.threads > 1:
+                print("#SBATCH --cpus-per-task={0:d}".format(self.threads),
+                      file=sc)
+        # Add memory request if necessary
+        if mem is not None:
+            print('#SBATCH --mem-per-cpu={0:d}mb'.format(mem), file=sc)
+
+
+        if 'hpc.psu.edu' in self.host.name:
+            print(self.queue)
+            if self.queue != 'open':
+                print('#SBATCH --account={}'.format(self.queue), file=sc)
+                print('#SBATCH --partition={}'.format('sla-prio'), file=sc)
+            else :
+                print('#SBATCH --account={}'.format(self.queue), file=sc)
+                print('#SBATCH --partition={}'.format('basic'), file=sc) # mhy5052 - changed 'open' here to 'basic', because ROAR changed the partition name.
+        elif 'stampede3.tacc.utexas.edu' in self.host.name:
+            print('#SBATCH -p {}'.format(self.queue), file=sc)
+
+        if errfile is None:
+            errfile = '{name}.err'.format(name=self.noext['full'])
+        print('#SBATCH --error {0}'.format(errfile), file=sc)
+        # Warn the batch shell before the walltime runs out, if it has a
+        # trap to catch the warning; an untrapped USR1 kills bash
+        if (shell or self.shell) == 'bash' and self.grace \
+                and self.checkpoint_script() is not None:
+            print('#SBATCH --signal=B:USR1@{0:d}'.format(self.grace), file=sc)
+
+    def write_script(self, nodes, ppn, wall, mem, pp=None):
+        '''Writes the complete job script for this input and returns
+        its name.  pp overrides the number of processors the program
+        is told to use.'''
+        from os import chmod
+
         # Open the submit script and create it
         script = '.'.join([self.noext['full'], 'script'])
         with open(script, 'w') as sc:
-            # Q-Chem is a little more particular
-            if self.ext == 'qchem':
-                print('#!/bin/csh', file=sc)
+            if self.host.queue_type == 'PBS':
+                self.write_PBS_header(sc, nodes, ppn, wall, mem)
             else:
-                print('#!/bin/bash', file=sc)
-            print('#', file=sc)
-            # print(self.lexclusive)
-
-            print('#SBATCH --time={0}'.format(self.host.td2hms(wall)),
-                                                file=sc)
-            print("#SBATCH --nodes={0:}".format(nodes), file=sc)
-        
-
-            if self.lexclusive:
-                print("#SBATCH --exclusive", file=sc)
-            #else:
-            if ppn != -1:
-                print("#SBATCH --ntasks-per-node={0:}".format(ppn), file=sc)
-            # Add memory request if necessary
-            if mem is not None:
-                print('#SBATCH --mem-per-cpu={0:d}mb'.format(mem), file=sc)
-
-
-            if 'hpc.psu.edu' in self.host.name:
-                print(self.host.queue)
-                if self.host.queue != 'open':
-                    print('#SBATCH --account={}'.format(self.host.queue), file=sc)
-                    print('#SBATCH --partition={}'.format('sla-prio'), file=sc)
-                else :
-                    print('#SBATCH --account={}'.format(self.host.queue), file=sc)
-                    print('#SBATCH --partition={}'.format('basic'), file=sc) # mhy5052 - changed 'open' here to 'basic', because ROAR changed the partition name.
-            elif 'stampede3.tacc.utexas.edu' in self.host.name:
-                print('#SBATCH -p {}'.format(self.host.queue), file=sc)
-                
+                self.write_SBATCH_header(sc, nodes, ppn, wall, mem)
             # Create the remainder of the script
-            print('#SBATCH --error {name}.err'.format(name=self.noext['full']), file=sc)
-            print(self.create_script(pp=abs(nodes*ppn)), file=sc)
+            packed = pp is not None
+            pp = pp if pp else abs(nodes*ppn)
+            ranks = max(1, pp // self.threads)
+            # The results are stored under the hash of the input as given
+            self.input_hash()
+            # The input is told the host's default memory when the queue
+            # is given none, e.g. for whole nodes on Stampede
+            self.reconcile_input(ranks, mem if mem else self.host.defaultmem)
+            chain = self.chain_commands((nodes, ppn, wall, mem))
+            checkpoint = self.checkpoint_script(chain)
+            body = self.cache_modules(self.create_script(pp=ranks, mem=mem))
+            # The queue ignores the directives of the program's script
+            # after the first command, so they go before anything else
+            directives, body = split_directives(body)
+            if directives:
+                print(directives, file=sc)
+            # A probe samples its progress while the program runs
+            if self.samples is not None:
+                print(self.probe_commands(), file=sc)
+            # Place the ranks and threads, and tell the program the ranks
+            print(self.binding_commands(packed), file=sc)
+            # Time the phases of the job from here on
+            print('date "+setup %s" > {0}.phases'.format(self.noext['full']),
+                  file=sc)
+            if checkpoint is None:
+                print(body, file=sc)
+            else:
+                # Run the job in the background so the trap runs right away
+                print(checkpoint, file=sc)
+                print('(', file=sc)
+                print(body, file=sc)
+                print(') &\nwait $!', file=sc)
+            print(self.timing_commands(), file=sc)
+            # Continue an unfinished run in a new job
+            if chain is not None:
+                print(chain, file=sc)
+            # csh scripts cannot run the commands that store the results
+            if self.cache and self.shell == 'bash':
+                print(self.store_commands(), file=sc)
 
         # Make the script executable
         chmod(script, 0o755)
-
-        # The job name can only be 15 bytes and must begin with a letter
-        jobname = self.noext['base'][0:15]
-        if jobname[0].isdigit(): jobname = 'q'+jobname[1:]
+        return script
+
+    def pick_allocation(self, resources, jobs=()):
+        '''With -A auto, choose the allocation of this job from its size
+        and how busy the queues are.  The other jobs that run in the same
+        allocation, e.g. the members of a pack, are given the choice too.'''
+        if self.allocation == 'auto':
+            nodes, ppn = resources[:2]
+            cores = nodes * (abs(ppn) if ppn else self.host.maxppn)
+            self.allocation = choose_allocation(self.host.allocations,
+                                                self.host, cores,
+                                                self.snapshot)
+            self.queue = self.host.allocations[self.allocation]
+        for job in jobs:
+            job.allocation, job.queue = self.allocation, self.queue
+
+    def queue_command(self, script, jobname):
+        '''The command that hands the script to the queueing system.'''
+        if self.host.queue_type == 'PBS':
+            depend = ['-W', 'depend='+self.dependency] if self.dependency else []
+            if self.open:
+                return ['qsub', '-N', jobname] + depend + [script]
+            else:
+                return ['qsub', '-A','%s'%(self.queue),'-N',jobname] + \
+                        depend + [script]
+        else:
+            depend = ['--dependency='+self.dependency] if self.dependency else []
+            return ['sbatch', '--job-name',jobname] + depend + [script]
+
+    def submit_queue(self, resources=None, kind='single'):
+        '''Submits the file on the host's queueing system.  The resources
+        are requested from the user unless they are given.  kind is
+        recorded in the job log.  Returns the job ID.'''
+
+        if resources is None:
+            resources = self.request_resources()
+        nodes, ppn, wall, mem = resources
+        self.pick_allocation(resources)
+        script = self.write_script(nodes, ppn, wall, mem)
+        jobname = self.jobname()
+        command = self.queue_command(script, jobname)
 
         # Submit the script unless otherwise directed
         if not self.script:
             print('Submitting {0} job {1}...'.format(type(self).__name__,
                                                      self.noext['base']))
-            call(['sbatch', '--job-name',jobname, script])
+            record = job_record([self], script, command, resources, kind)
+            jobid = queue_send(command, self.spool, record,
+                               retry=not self.workflow)
+            if self.host.queue_type == 'PBS': print()
+            return jobid
         else:
             from os.path import relpath
             script = relpath(script)
             print('Wrote {0} job script {1}...'.format(type(self).__name__,
                                                        script))
-            print('Submit with "sbatch --job-name {0} {1}"'.format(jobname, script))
+            if self.host.queue_type == 'PBS':
+                print('Submit with "qsub -N {0} {1}"'.format(jobname, script))
+            else:
+                print('Submit with "sbatch --job-name {0} {1}"'.format(jobname,
+                                                                      script))
             print()
 
+    def submit_PBS_queue(self):
+        '''Submits the file on the PBS queueing system.'''
+        return self.submit_queue()
+
+    def submit_SBATCH_queue(self):
+        '''Submits the file on the SBATCH queueing system.'''
+        return self.submit_queue()
+
 
 class PBSScript(Submittable):
     '''Class to submit a PBS job script directly'''
@@ -658,17 +3819,19 @@ class PBSScript(Submittable):
 
     def submit_PBS_queue(self):
         '''Submit to the PBS queueing system'''
-        from subprocess import call
-
         # The job name can only be 15 bytes and must begin with a letter
-        jobname = self.noext['base'][0:15]
-        if jobname[0].isdigit(): jobname = 'q'+jobname[1:]
+        jobname = self.jobname()
+        depend = ['-W', 'depend='+self.dependency] if self.dependency else []
 
         # Submit the script
         print('Submitting {0} job {1}...'.format(type(self).__name__,
                                                      self.noext['base']))
-        call(['qsub', '-N', jobname, self.input['full']])
+        command = ['qsub', '-N', jobname] + depend + [self.input['full']]
+        record = job_record([self], self.input['full'], command)
+        jobid = queue_send(command, self.spool, record,
+                           retry=not self.workflow)
         print()
+        return jobid
 
 
 
@@ -683,10 +3846,10 @@ class Scratch(Submittable):
     def submit_interactive(self):
         '''Submits a job interactively
         with an excplicit scratch directory'''
-        from shutil import rmtree, copy, Error
+        from shutil import rmtree
         from subprocess import call
         from os.path import join
-        from os import getpid, mkdir, remove
+        from os import getpid, mkdir
 
         # Make a temp dir in the scratch directory
         tmpdir = '.'.join([type(self).__name__, str(getpid())])
@@ -723,12 +3886,15 @@ class Scratch(Submittable):
         mkdir(tmpdir)
         # if TAPE16 or TAPE21 files exist move them into temp dir
         import os.path
-        if (os.path.isfile("TAPE21")):
-             copy("TAPE21", tmpdir)
-        if (os.path.isfile("TAPE16")):
-             copy("TAPE16", tmpdir)
-        # Copy input file into that directory
-        self.copy_input(tmpdir)
+        tapes = [(t, tmpdir) for t in ("TAPE21", "TAPE16")
+                             if os.path.isfile(t)]
+        stagein = stage_files(tapes)
+        # Stage the input file into that directory
+        stats = self.copy_input(tmpdir)
+        for key in ('files', 'bytes', 'seconds'):
+            stagein[key] += stats[key]
+        for method, n in stats['methods'].items():
+            stagein['methods'][method] = stagein['methods'].get(method, 0) + n
         # Return where the output is going (in input is coming from)
         stdin, stdout, stderr = self.stdstreams(tmpdir=tmpdir)
         # Make a soft link of the logfile if appropriate
@@ -736,22 +3902,12 @@ class Scratch(Submittable):
         # Make the submittable argument list
         arguments = self.add_input(['nice', '-n', str(self.nice)])
         # Submit
-        call(arguments, stdout=stdout, stderr=stderr, stdin=stdin, cwd=tmpdir)
+        status = call(arguments, stdout=stdout, stderr=stderr, stdin=stdin,
+                      cwd=tmpdir)
         # Clean up
         sources, dests = self.clean(tmpdir=tmpdir)
-        # Copy the sources to the dest
-        for source, dest in zip(sources, dests):
-            try:
-                copy(source, dest)
-            except (IOError, OSError):
-                pass
-            except Error:
-                # If there is a link, remove the link before continuing
-                remove(dest)
-                try:
-                    copy(source, dest)
-                except (IOError, OSError):
-                    pass
+        # Move the sources to the dest, since the temp dir is removed
+        stageout = stage_files(zip(sources or [], dests or []), move=True)
         # Remove the temporary directory
         rmtree(tmpdir, True)
 
@@ -759,12 +3915,17 @@ class Scratch(Submittable):
         if not self.quiet:
             print('''\
 
+   Stage in  : {stagein}
+   Stage out : {stageout}
+
    Job finish at : {date}
 
 ***********************************************************************
 ***********************************************************************
 ***********************************************************************
-'''.format(date=strftime('%c')))
+'''.format(date=strftime('%c'), stagein=stage_summary(stagein),
+           stageout=stage_summary(stageout)))
+        return status
 
     def link_log(self, tmpdir):
         '''Make a soft link to the logfile in the submitted directory.
@@ -776,6 +3937,13 @@ class ABINIT(Scratch):
     '''Class that handles the submission of ABINIT files.
     It is a subclass of Submittable and overrides some methods.'''
 
+    # Printed at the end of a successful run
+    success_marker = 'Calculation completed.'
+    # Only the output files are kept
+    archive_include = ('{name}o*',)
+    # Runs in node-local directories with --bcast
+    bcastable = True
+
     def __init__(self, host, filename, opts, subopts):
         '''Initiallizes the ABINIT submission class'''
 
@@ -794,15 +3962,22 @@ class ABINIT(Scratch):
         class's method.'''
         return '.'.join([self.noext['full'], 'logfile'])
 
+    def cache_inputs(self):
+        '''The pseudopotentials and the auxillary input (i*) files.'''
+        from glob import glob
+        from os.path import splitext
+        return Scratch.cache_inputs(self) + \
+               sorted(glob(splitext(self.input['full'])[0]+'i*'))
+
     def executable(self):
         '''The executable to use for interactive jobs.
         Overrides the base class'''
         return 'abinis' if 'hammer' in self.host.name else 'abinit'
 
     def copy_input(self, tmpdir):
-        '''Copies input files to the temp directory.'''
+        '''Stages input files to the temp directory.  Returns the staging
+        statistics.'''
         from glob import glob
-        from shutil import copy
         from os.path import join, splitext
 
         # Construct a .files file
@@ -818,13 +3993,11 @@ class ABINIT(Scratch):
             for p in self.psp:
                 print(p, file=f)
 
-        # Copy auxillary files
-        for x in glob(splitext(self.input['full'])[0]+'i*'):
-            x = x.strip()
-            copy(x, tmpdir)
-
-        # Copy the .files file
-        copy(self.files['full'], join(tmpdir, self.files['base']))
+        # Stage auxillary files and the .files file
+        files = [(x.strip(), tmpdir)
+                 for x in glob(splitext(self.input['full'])[0]+'i*')]
+        files.append((self.files['full'], join(tmpdir, self.files['base'])))
+        return stage_files(files, readonly=True)
 
     def stdstreams(self, **kwargs):
         '''Returns the proper standard in, out and error.'''
@@ -846,21 +4019,13 @@ class ABINIT(Scratch):
         '''Cleans up after a job.  Returns the sources and destinations
         of files to copy.'''
         from os.path import join
-        from os import chdir
-        from glob import glob
-        import tarfile
         try:
             tmpdir = kwargs['tmpdir']
         except KeyError:
             sys.exit('Missing key "tmpdir" in clean')
-        # Change to temp and tar all files together
-        chdir(tmpdir)
+        # Tar the output files together
         tarname = '.'.join([self.noext['base'], 'tar.gz'])
-        tar = tarfile.open(tarname, 'w:gz')
-        for f in glob(self.noext['base']+'o*'): tar.add(f)
-        tar.close()
-        # Go back to the input dir
-        chdir(self.path)
+        self.archive(join(tmpdir, tarname), tmpdir)
         # Create a list of the sources and the dest files
         sources = [join(tmpdir, tarname),
                    join(tmpdir, '.'.join([self.noext['base'], 'out']))]
@@ -868,19 +4033,39 @@ class ABINIT(Scratch):
                    '.'.join([self.noext['full'], 'out'])]
         return sources, dests
 
+    def checkpoint_commands(self):
+        '''Save the output files written so far.'''
+        from os.path import join
+        return self.archive_commands(join(self.path, self.noext['base']+
+                                          '.tar.gz'), self.work_dir('$TMPDIR'))
+
+    def preflight(self):
+        '''The pseudopotentials must exist.'''
+        return self.missing(self.psp, 'Pseudopotential')
+
     def create_script(self, **kwargs):
         '''Write the ABINIT script to file.'''
         from os.path import splitext
         try:
-            prog = 'mpirun abinip' if kwargs['pp'] > 1 else 'abinis'
+            prog = 'mpirun -np {0:d} abinip'.format(kwargs['pp']) \
+                   if kwargs['pp'] > 1 else 'abinis'
         except KeyError:
             sys.exit('Missing key "pp" in create_script')
+        # The input and psp files are read by the first rank, so only the
+        # directory is needed on the other nodes
+        workdir = self.work_dir('$TMPDIR')
+        stagein = cleanup = ''
+        if self.bcast:
+            stagein = '\n{0}\n'.format(self.bcast_commands([], workdir))
+            cleanup = '\ncd {0}\n{1}'.format(self.path,
+                                           self.bcast_cleanup(workdir))
         return dedent('''\
           #PBS -e {noext}.err
 
+          {t_modules}
           module load abinit
-
-          cd $TMPDIR
+          {t_stagein}{stagein}
+          cd {workdir}
 
           # Create the .files file
           touch {name}.files
@@ -896,14 +4081,22 @@ class ABINIT(Scratch):
             cp {inpnoext}i* .
           fi
 
+          {t_compute}
           {prog} < {name}.files > {out}
-          tar -czf {name}.tar.gz {name}o*
-          cp {name}.tar.gz {name}.out {name}.files {dir}\
+          {t_archive}
+          {archive}
+          {t_copyback}
+          cp {name}.tar.gz {name}.out {name}.files {dir}{cleanup}\
           ''').format(name=self.noext['base'], out=self.output['full'],
+                      workdir=workdir, stagein=stagein, cleanup=cleanup,
+                      archive=self.archive_commands(self.noext['base']+
+                                                    '.tar.gz',
+                                                    threads=kwargs['pp']),
                       inp=self.input['full'], noext=self.noext['full'],
                       psp='\n'.join(self.psp), dir=self.path, prog=prog,
                       inpname=splitext(self.input['base'])[0],
-                      inpnoext=splitext(self.input['full'])[0])
+                      inpnoext=splitext(self.input['full'])[0],
+                      **self.phases())
 
 
 
@@ -911,6 +4104,23 @@ class ADF(Scratch):
     '''Class that handles the submission of ADF files.
     It is a subclass of Submittable and overrides some methods.'''
 
+    # Printed at the end of a successful run
+    success_marker = 'NORMAL TERMINATION'
+    # Identify the version of ADF by where it is installed
+    version_env = ('ADFHOME', 'AMSHOME')
+    # The time-stamped SCF cycles
+    iteration_pattern = r'^<[^>]*> <[0-9:]*> +cycle +[0-9]+'
+    progress_steps = (('geometry steps', r'^<[^>]*> <[0-9:]*> +GEOMETRY '
+                                         r'(CONVERGED|CYCLE)', None),)
+    # ADF runs MPI ranks only
+    openmp = False
+    # The TAPE files grow with the square of the system size
+    scratch_gb_per_atom2 = 0.0005
+    # The name of the directory in scratch a queued job runs in, once known
+    ranjobname = None
+    # The number of ranks the job tells ADF, unless the input does
+    nscm = None
+
     def __init__(self, host, filename, opts, subopts):
         '''Initiallizes the ADF submission class'''
 
@@ -982,6 +4192,34 @@ class ADF(Scratch):
         call(['ln', '-sfT', os.path.join(tmpdir, self.rawlog),
                             os.path.join(self.path, logname)])
 
+    def link_logfile(self):
+        '''The command that links the logfile in the scratch directory of a
+        queued job next to the input, as link_log does for interactive
+        runs, so that its progress can be followed.'''
+        if self.iteration_pattern is None:
+            return ''
+        return 'ln -sfT "$PWD/{0}" {1}'.format(self.rawlog,
+                                               self.progress_file())
+
+    def progress_file(self):
+        '''ADF writes its SCF cycles and geometry steps to the logfile.'''
+        return '.'.join([self.noext['full'], 'logfile'])
+
+    def cache_inputs(self):
+        '''The TAPE files (.t21, .t16, TAPE21, ...) and any other files
+        next to the input that the ADF script refers to.'''
+        from re import findall
+        from os.path import join, isfile, abspath
+        fs = open(self.input['full']).read()
+        names = sorted(set(t for t in findall(r'[^\s"\'=<>;|&()]+', fs)
+                           if '$' not in t))
+        # The .t21 and .t16 of the same name are staged in as TAPE files
+        files = [join(self.path, t) for t in names] + \
+                ['.'.join([self.noext['full'], ext]) for ext in ('t21', 't16')]
+        files = [f for f in files if isfile(f)
+                 and abspath(f) != abspath(self.input['full'])]
+        return Scratch.cache_inputs(self) + sorted(set(files), key=files.index)
+
     def executable(self):
         '''The executable to use for interactive jobs.
         Overrides the base class'''
@@ -1028,6 +4266,100 @@ class ADF(Scratch):
         # Replace the first append with a create/overwrite and return.
         return inputfile.replace('<<eor>>', '<<eor>', 1)
 
+    def features(self):
+        '''The number of atoms, basis and calculation type of the input.'''
+        from re import search, IGNORECASE, MULTILINE
+        lines = open(self.input['full']).read().splitlines()
+        text = '\n'.join(lines)
+        basis = search(r'^\s*type\s+(\S+)', '\n'.join(input_block(lines,
+                       r'basis\b')), IGNORECASE | MULTILINE)
+        calctype = search(r'^\s*task\s+(\S+)', text, IGNORECASE | MULTILINE)
+        if calctype:
+            calctype = calctype.group(1).lower()
+        else:
+            for key in ('aoresponse', 'frequencies', 'analyticalfreq',
+                        'excitations', 'geometry'):
+                if search(r'^\s*' + key + r'\b', text, IGNORECASE | MULTILINE):
+                    calctype = key
+                    break
+            else:
+                calctype = 'singlepoint'
+        return {'atoms': count_atoms(input_block(lines, r'atoms\b')) or None,
+                'basis': basis.group(1).upper() if basis else None,
+                'calctype': calctype}
+
+    def preflight(self):
+        '''The input is a shell script, which must parse and whose ADF
+        programs and TAPE21 files must exist.'''
+        from re import findall
+        from os.path import join
+        problems = self.syntax_check(['bash', '-n'])
+        with open(self.input['full']) as f:
+            fs = f.read()
+        home = [os.environ[v] for v in self.version_env if v in os.environ]
+        if not home:
+            problems.append('$ADFHOME and $AMSHOME are not defined')
+        else:
+            bindir = os.environ.get('ADFBIN', join(home[0], 'bin'))
+            problems += self.missing(sorted(set(
+                join(bindir, p) for p in findall(r'\$ADFBIN/([\w.]+)', fs))),
+                'Program')
+        tapes = [t for t in findall(r'([^\s"\'=]+\.t21)\b', fs) if '$' not in t]
+        problems += self.missing([join(self.path, t) for t in sorted(set(tapes))],
+                                 'TAPE21 file')
+        return problems
+
+    def reconcile_input(self, pp, mem):
+        '''ADF is told its ranks with NSCM, which the job sets unless the
+        input does.'''
+        from re import search, MULTILINE
+        fs = open(self.input['full']).read()
+        nscm = search(r'^\s*(?:export\s+)?NSCM=(\S+)', fs, MULTILINE)
+        if nscm is None:
+            self.nscm = pp
+        elif nscm.group(1) != str(pp):
+            self.mismatch(nscm.group(0).strip(),
+                          'has {0:d} processors'.format(pp))
+
+    def run_dir(self):
+        '''The directory in scratch that a queued job runs in.  Its name has
+        a random suffix so that runs of the same input do not share it.'''
+        from os.path import join
+        import random, string
+        if self.ranjobname is None:
+            self.ranjobname = self.noext['base'][0:15] + ''.join(
+                              random.choice(string.ascii_lowercase)
+                              for _ in range(4))
+        return join(self.host.scratch, 'scratch_adf', self.ranjobname)
+
+    def checkpoint_commands(self):
+        '''Copy the logfile, the TAPE files and the other files to save
+        from the scratch directory next to the input, at the end of the
+        job and when the walltime runs out, since the directory is left
+        behind.  The logfile next to the input is a link into scratch, so
+        it is replaced.'''
+        from os.path import join
+        lines = ['cp --remove-destination {0} {1}.{2} 2>/dev/null'.format(
+                 join(self.run_dir(), raw), self.noext['full'], ext)
+                 for raw, ext in sorted(self.save_files.items())]
+        lines.append('for TAPE in {0}/TAPE*; do cp -n "$TAPE" {1}.t${{TAPE##'
+                     '*TAPE}} 2>/dev/null; done'.format(self.run_dir(),
+                                                      self.noext['full']))
+        return '\n'.join(lines)
+
+    def enter_scratch(self, ranjobname):
+        '''The commands that make and enter the directory ADF runs in.'''
+        return dedent('''\
+          cd {scratch}
+          if [ ! -d "scratch_adf" ]; then
+              mkdir scratch_adf
+          fi
+          mkdir scratch_adf/{ranjobname}
+          cd scratch_adf/{ranjobname}
+          {stripe}''').format(scratch=self.host.scratch,
+                              ranjobname=ranjobname,
+                              stripe=self.stripe_commands()).rstrip()
+
     def create_script(self, **kwargs):
         # Gaohe: Dispatch for submitting on different sbatch configuration
         host_type = type(self.host)
@@ -1039,45 +4371,49 @@ class ADF(Scratch):
     def create_script_stampede(self, **kwargs):
         '''Write the ADF script to file.'''
         from os import environ, getpid
-        import random, string
+        from os.path import basename
         # Edit the input file to redirect the output to the output file
         inp = self.redirect_output(open(self.input['full']).read())
         # NOTE: Comment or not for TCP workaround (leaving this in the code
         # if needed in the future).
         #comment = '' if self.host.name == 'lionxf.rcc.psu.edu' else '#'
         comment = '#'
-        randomword = lambda length: ''.join(random.choice(string.ascii_lowercase) for _ in range(length))
-        ranjobname = self.noext['base'][0:15] 
-        randstring = randomword(4)
-        ranjobname = ''.join([ranjobname, randstring])
+        ranjobname = basename(self.run_dir())
         print (ranjobname)
         return dedent('''\
+    {t_modules}
     #module load ams
     # Set stuff for ADF
-    cd {scratch}
-    if [ ! -d "scratch_adf" ]; then
-        mkdir scratch_adf
-    fi
-    mkdir scratch_adf/{ranjobname}
-    cd scratch_adf/{ranjobname}
+    {t_stagein}
+    {enter}
+    {link}
     export TMPDIR={temp}
     export SCM_RESULTDIR={dir}
     export SCM_TMPDIR=$TMPDIR
     export SCM_USETMPDIR=yes
+    {nscm}
     # Stampede requires a different mpirun
     export SCM_MPIRUN_EXE=ibrun
     export SCM_MPIRUN_OPTIONS=
 
+    {t_compute}
     {input}
-    \
+
+    {t_copyback}
+    {copyback}\
     ''').format(name=self.noext['full'], dir=self.path, input=inp,
                 comment=comment,ranjobname=ranjobname,
-                scratch=self.host.scratch, temp=self.host.temp)
+                enter=self.enter_scratch(ranjobname),
+                link=self.link_logfile(),
+                nscm='export NSCM={0:d}'.format(self.nscm) if self.nscm else '',
+                copyback=self.checkpoint_commands(),
+                scratch=self.host.scratch, temp=self.host.temp,
+                **self.phases())
 
     def create_script_hpc(self, **kwargs):
         '''Write the ADF script to file.'''
         from os import environ, getpid
-        import random, string
+        from os.path import basename
         # NOTE: Deprecated  -- Gaohe 20241026
         # Use a default OPAL_PREFIX location if not in user's bashrc
         # try:
@@ -1100,25 +4436,20 @@ class ADF(Scratch):
         #comment = '' if self.host.name == 'lionxf.rcc.psu.edu' else '#'
         comment = '#'
         pbs = '' if self.host.queue_type == 'PBS' else '#'
-        randomword = lambda length: ''.join(random.choice(string.ascii_lowercase) for _ in range(length))
-        ranjobname = self.noext['base'][0:15] 
-        randstring = randomword(4)
-        ranjobname = ''.join([ranjobname, randstring])
+        ranjobname = basename(self.run_dir())
         print (ranjobname)
         # TODO: Add a handle to automatic load ams. Configure related environmental variables here
         # Gaohe 20241026
         # TODO: Clean statement is currently not implemented
         
         return dedent('''\
+    {t_modules}
     #module load ams
     # Set stuff for ADF
     {pbs}cat $PBS_NODEFILE > {name}.nodefile
-    cd {scratch}
-    if [ ! -d "scratch_adf" ]; then
-        mkdir scratch_adf
-    fi
-    mkdir scratch_adf/{ranjobname}
-    cd scratch_adf/{ranjobname}
+    {t_stagein}
+    {enter}
+    {link}
     export TMPDIR={temp}
     export SCM_RESULTDIR={dir}
     export SCM_TMPDIR=$TMPDIR
@@ -1129,14 +4460,21 @@ class ADF(Scratch):
     {comment}export MPI_REMSH=$ADFBIN/torque_ssh # For PlatformMPI
     {comment}export MPIRUN_OPTIONS=-TCP # Use when Infiniband is broken
 
-    {pbs}export NSCM=$(wc -l < $PBS_NODEFILE)
+    {nscm}
 
+    {t_compute}
     {input}
 
+    {t_copyback}
+    {copyback}
     {clean}\
     ''').format(name=self.noext['full'], dir=self.path, input=inp, comment=comment, clean="",
+                enter=self.enter_scratch(ranjobname),
+                link=self.link_logfile(),
+                nscm='export NSCM={0:d}'.format(self.nscm) if self.nscm else '',
+                copyback=self.checkpoint_commands(),
                 base=self.noext['base'],ranjobname=ranjobname, scratch=self.host.scratch, temp=self.host.temp,
-                pbs=pbs, nodes=self.nodes, ppn=self.ppn)
+                pbs=pbs, nodes=self.nodes, ppn=self.ppn, **self.phases())
 
 
 class BAND(ADF):
@@ -1166,6 +4504,10 @@ class ReaxFF(ADF):
     '''Class that handles the submission of BAND files.
     It is a subclass of ADF and overrides some methods.'''
 
+    # ReaxFF does not print ADF's termination message or SCF cycles
+    success_marker = None
+    iteration_pattern = None
+
     def __init__(self, host, filename, opts, subopts):
         '''Initiallizes the BAND submission class'''
 
@@ -1207,6 +4549,40 @@ class NWChem(Scratch):
     '''Class that handles the submission of NWChem files.
     It is a subclass of Submittable and overrides some methods.'''
 
+    # Printed at the end of a successful run
+    success_marker = 'Total times'
+    # Identify the version of NWChem by where it is installed
+    version_env = ('NWCHEM', 'NWCHEM_TOP')
+    # The program run when $NWCHEM is not set
+    default_program = '/gpfs/group/jensen/nwchem-6.1.1/bin/LINUX64/nwchem'
+    # The integrals and grid are recomputed on a restart
+    archive_exclude = ('*.aoints.*', '*.gridpts.*')
+    # The DFT iterations, whose RMS change of the density is the error,
+    # geometry steps and finite-difference displacements for frequencies
+    iteration_pattern = r'^ *d= *[0-9]+,ls='
+    scf_error = r'^ *d= *\d+,ls=\S+ +\d+ +-?\d+\.\d+ +\S+ +(\S+)'
+    scf_target = 1e-5
+    progress_steps = (('geometry steps', r'^@ +\d+ +-\d+\.\d+', None),
+                      ('displacements', r'^ *atom: +\d+ +xyz: +\d\([+-]\)', 6))
+    # The top-level directives, those of them that open a block closed by
+    # end, and the blocks that may be nested in those
+    directives = frozenset('''start restart title echo memory charge
+        scratch_dir permanent_dir geometry basis ecp so dft scf mp2 ccsd tce
+        tddft task set unset print noprint property driver freq vib hessian
+        relativistic cosmo esp python stop mcscf nwpw pspw band qmmm md
+        prepare constraints dplot bq stepper selci rt_tddft raman oniom dim
+        fcidump nbo include ecce_print smd drdy bsse neb string qmd rimp2
+        gw'''.split())
+    blocks = frozenset('''geometry basis ecp so dft scf mp2 ccsd tce tddft
+        property driver freq vib hessian relativistic cosmo esp python mcscf
+        nwpw pspw band qmmm md prepare constraints dplot bq stepper selci
+        rt_tddft raman oniom dim fcidump nbo smd drdy bsse neb string qmd
+        rimp2 gw'''.split())
+    subblocks = frozenset('''zcoord zmatrix system variables constants
+        simulation_cell brillouin_zone'''.split())
+    # Runs in node-local directories with --bcast
+    bcastable = True
+
     def __init__(self, host, filename, opts, subopts):
         '''Initiallizes the NWChem submission class'''
         # Initiallize the parent
@@ -1231,27 +4607,91 @@ class NWChem(Scratch):
     def clean(self, **kwargs):
         '''Cleans up after a job.  Returns the sources and destinations
         of files to copy.'''
-        from os.path import join, basename
-        from os import chdir
-        from glob import glob
-        import tarfile
+        from os.path import join
         try:
             tmpdir = kwargs['tmpdir']
         except KeyError:
             sys.exit('Missing key "tmpdir" in clean')
-        # Change to temp and tar all files together
-        chdir(tmpdir)
+        # Tar the files that are worth keeping together
         tarname = '.'.join([self.noext['base'], 'tar.gz'])
-        tar = tarfile.open(tarname, 'w:gz')
-        for f in glob(join(tmpdir, '*')): tar.add(basename(f))
-        tar.close()
-        # Go back to the input dir
-        chdir(self.path)
+        self.archive(join(tmpdir, tarname), tmpdir)
         # Create a list of the sources and the dest files
         sources = [join(tmpdir, tarname)]
         dests   = [join(self.path, tarname)]
         return sources, dests
 
+    def reconcile_input(self, pp, mem):
+        '''NWChem's memory directive is per process.  A tenth is left for
+        MPI and the operating system.'''
+        from re import search, IGNORECASE, MULTILINE
+        if not mem:
+            return
+        fs = open(self.input['full']).read()
+        memory = search(r'^\s*memory\b(.*)$', fs, IGNORECASE | MULTILINE)
+        if memory is None:
+            self.rewrite_input('memory total {0:d} mb\n'.format(int(mem * 0.9))
+                               + fs)
+            return
+        total = search(r'(?:total\s+)?(\d+)\s*(b|kb|mb|gb|kw|mw|gw)?\b',
+                       memory.group(1), IGNORECASE)
+        if total and memory_mb(total.group(1), total.group(2) or 'w') > mem:
+            self.mismatch(memory.group(0).strip(),
+                          'has {0:d} MB per process'.format(mem))
+
+    def checkpoint_commands(self):
+        '''The output is written to the input directory as it goes, so only
+        the run database and vectors in scratch are saved.'''
+        from os.path import join
+        return self.archive_commands(join(self.path, self.noext['base']+
+                                          '.tar.gz'), self.work_dir('$TMPDIR'))
+
+    def preflight(self):
+        '''Every block must be closed, there must be a task, and the program
+        must exist.  The structure of the input past a directive that is
+        not known here cannot be followed, so that only gives a warning.'''
+        from re import search, IGNORECASE, MULTILINE
+        problems = self.program_problems('NWCHEM', self.default_program)
+        depth, tasks = 0, 0
+        with open(self.input['full']) as f:
+            text = f.read()
+        for n, line in enumerate(text.splitlines(), 1):
+            words = line.split('#')[0].split()
+            if not words:
+                continue
+            word = words[0].lower()
+            if depth == 0:
+                if word not in self.directives:
+                    print('Warning: {0} has the unknown directive "{1}" on '
+                          'line {2:d}; its structure is not checked past it'
+                          .format(self.input['base'], words[0], n),
+                          file=sys.stderr)
+                    if not search(r'^\s*task\b', text, IGNORECASE | MULTILINE):
+                        problems.append('There is no task directive')
+                    return problems
+                if word in self.blocks:
+                    depth = 1
+                tasks += word == 'task'
+            elif word == 'end':
+                depth -= 1
+            elif word in self.subblocks:
+                depth += 1
+        if depth:
+            problems.append('A block is not closed with "end"')
+        if not tasks:
+            problems.append('There is no task directive')
+        return problems
+
+    def features(self):
+        '''The number of atoms, basis and calculation type of the input.'''
+        from re import findall, IGNORECASE, MULTILINE
+        lines = open(self.input['full']).read().splitlines()
+        text = '\n'.join(lines)
+        basis = findall(r'^\s*\S+\s+library\s+(\S+)', text, IGNORECASE | MULTILINE)
+        tasks = findall(r'^\s*task\s+(.*?)\s*$', text, IGNORECASE | MULTILINE)
+        return {'atoms': count_atoms(input_block(lines, r'geometry\b')) or None,
+                'basis': ' '.join(sorted(set(basis))) if basis else None,
+                'calctype': tasks[-1].lower() if tasks else None}
+
     def create_script(self, **kwargs):
         '''Write the NWCHEM script to file.'''
         from os import environ
@@ -1259,13 +4699,27 @@ class NWChem(Scratch):
         try:
             nw = environ['NWCHEM']
         except KeyError:
-            nw = '/gpfs/group/jensen/nwchem-6.1.1/bin/LINUX64/nwchem'
+            nw = self.default_program
             print("$NWCHEM environment variable not defined")
             print("Defaulting to {0}".format(nw))
-        if self.host.queue == 'lxj18_collab':
+        from os.path import join
+        workdir = self.work_dir('$TMPDIR')
+        archive = self.archive_commands(self.noext['base']+'.tar.gz',
+                                        workdir, kwargs.get('pp', 1))
+        # Only the first rank reads the input, but every rank writes its
+        # scratch files to the directory it starts in
+        inp, stagein, cleanup = self.input['full'], '', ''
+        if self.bcast:
+            stagein = self.bcast_commands([(inp, self.input['base'])],
+                                          workdir) + '\n'
+            inp = join(workdir, self.input['base'])
+            cleanup = '\ncd {0}\n{1}'.format(self.path,
+                                           self.bcast_cleanup(workdir))
+        if self.queue == 'lxj18_collab':
             return dedent('''\
     #PBS -e {name}.logfile
 
+    {t_modules}
     module purge
     module load intel/2015.0090 intel-mpi mkl/090-11.2-0
 
@@ -1273,13 +4727,21 @@ class NWChem(Scratch):
     mkdir {jobname}
     export TMPDIR=gpfs/scratch/$USER/{jobname}
 
-    cd $TMPDIR
-    mpirun {nw} {inp} > {out}
-    tar -czf {base}.tar.gz --exclude='*.tar.gz' $TMPDIR
-    cp {base}.tar.gz {dir}\
-    ''').format(name=self.noext['full'], inp=self.input['full'],
+    {t_stagein}
+    {stagein}cd {workdir}
+    {t_compute}
+    mpirun -np {pp:d} {nw} {inp} > {out}
+    {t_archive}
+    {archive}
+    {t_copyback}
+    cp {base}.tar.gz {dir}{cleanup}\
+    ''').format(name=self.noext['full'], inp=inp,
                 base=self.noext['base'], out=self.output['full'],
-                nw=nw, dir=self.path, user=environ['USER'],jobname = self.noext['base'][0:15])
+                archive=archive, workdir=workdir, stagein=stagein,
+                cleanup=cleanup,
+                nw=nw, dir=self.path, user=environ['USER'],jobname = self.noext['base'][0:15],
+                pp=kwargs.get('pp', 1),
+                **self.phases())
         else:
             return dedent('''\
     #PBS -e {name}.logfile
@@ -1287,14 +4749,20 @@ class NWChem(Scratch):
     #module load openmpi/intel/1.7.3
     #module load intel mkl impi 
 
-    cd $TMPDIR
+    {t_stagein}
+    {stagein}cd {workdir}
+    {t_compute}
     #mpirun {nw} {inp} > {out}
     srun {nw} {inp} > {out}
-    tar -czf {base}.tar.gz --exclude='*.tar.gz' $TMPDIR
-    cp {base}.tar.gz {dir}\
-    ''').format(name=self.noext['full'], inp=self.input['full'],
+    {t_archive}
+    {archive}
+    {t_copyback}
+    cp {base}.tar.gz {dir}{cleanup}\
+    ''').format(name=self.noext['full'], inp=inp,
                 base=self.noext['base'], out=self.output['full'],
-                nw=nw, dir=self.path, user=environ['USER'])
+                archive=archive, workdir=workdir, stagein=stagein,
+                cleanup=cleanup,
+                nw=nw, dir=self.path, user=environ['USER'], **self.phases())
 
 
 
@@ -1302,11 +4770,73 @@ class Gaussian(Scratch):
     '''Class that handles the submission of Gaussian files.
     It is a subclass of Submittable and overrides some methods.'''
 
+    # Printed at the end of a successful run
+    success_marker = 'Normal termination of Gaussian'
+    # Gaussian is one process that places its own threads
+    bind_policy = 'none'
+    openmp = False
+
     def __init__(self, host, filename, opts, subopts):
         '''Initiallizes the Gaussian submission class'''
         # Initiallize the parent
         Scratch.__init__(self, host, filename, opts, subopts)
 
+    def features(self):
+        '''The number of atoms, basis and calculation type of the input.'''
+        from re import findall, IGNORECASE
+        lines = open(self.input['full']).read().splitlines()
+        route = ' '.join(l for l in lines if l.lstrip().startswith('#'))
+        basis = findall(r'/(\S+)', route)
+        calctype = [k for k in ('opt', 'freq', 'td', 'polar', 'nmr')
+                    if findall(r'\b' + k + r'\b', route, IGNORECASE)]
+        return {'atoms': count_atoms(lines) or None,
+                'basis': basis[0].upper() if basis else None,
+                'calctype': '+'.join(calctype) if calctype else 'sp'}
+
+    def reconcile_input(self, pp, mem):
+        '''Gaussian runs on one node with %nprocshared processors and %mem
+        memory in total.  A tenth of the memory is left for the operating
+        system.'''
+        from re import match, IGNORECASE
+        lines = open(self.input['full']).read().splitlines()
+        link0 = [l.strip().lower() for l in lines if l.strip().startswith('%')]
+        add = []
+        nproc = [l for l in link0 if l.startswith(('%nprocshared', '%nproc='))]
+        if not nproc:
+            add.append('%nprocshared={0:d}'.format(pp))
+        elif int(nproc[0].split('=')[1]) != pp:
+            self.mismatch(nproc[0], 'has {0:d} processors'.format(pp))
+        if self.nodes and self.nodes > 1 and self.ppn and self.ppn > 0:
+            self.mismatch('no Linda directive', 'has {0:d} nodes'.format(
+                                                                 self.nodes))
+        if mem:
+            memory = [l for l in link0 if l.startswith('%mem')]
+            total = int(mem * pp * 0.9)
+            if not memory:
+                add.append('%mem={0:d}MB'.format(total))
+            else:
+                m = match(r'%mem=(\d+)\s*([a-z]*)', memory[0], IGNORECASE)
+                if m and memory_mb(m.group(1), m.group(2) or 'w') > mem * pp:
+                    self.mismatch(memory[0], 'has {0:d} MB'.format(mem * pp))
+        if add:
+            self.rewrite_input('\n'.join(add + lines) + '\n')
+
+    def preflight(self):
+        '''The input needs a route section.'''
+        line = ''
+        with open(self.input['full']) as f:
+            for line in f:
+                if line.strip().startswith('#'):
+                    return []
+                if line.strip() and not line.strip().startswith(('%', '!')):
+                    break
+        return ['There is no route section before "{0}"'.format(line.strip())]
+
+    def output_name(self):
+        '''Gaussian writes its output to a .log file.  Overrides the base
+        class's method.'''
+        return '.'.join([self.noext['full'], 'log'])
+
     def create_script(self, **kwargs):
         '''Write the Gaussian script to file.'''
         # Gaussian by default writes output to .log files.  We name the
@@ -1317,39 +4847,104 @@ class Gaussian(Scratch):
 
           cd $PBS_O_WORKDIR
 
+          {t_modules}
           module load gaussian/g09c01
 
+          {t_compute}
           g09 {inp}
-          ''').format(name=self.noext['base'], inp=self.input['base'])
+          ''').format(name=self.noext['base'], inp=self.input['base'],
+                      **self.phases())
 
 
 class QChem(Scratch):
     '''Class that handles the submission of Q-Chem files.
     It is a subclass of Submittable and overrides some methods.'''
 
+    # Printed at the end of a successful run
+    success_marker = 'Thank you very much for using Q-Chem'
+
+    # Q-Chem scripts are run with csh
+    shell = 'csh'
+
     def __init__(self, host, filename, opts, subopts):
         '''Initiallizes the Q-Chem submission class'''
         # Initiallize the parent
         Scratch.__init__(self, host, filename, opts, subopts)
 
+    def reconcile_input(self, pp, mem):
+        '''Q-Chem is told its memory with MEM_TOTAL (MB) in each $rem
+        section.  A tenth is left for the operating system.'''
+        from re import match, IGNORECASE
+        if not mem:
+            return
+        lines = open(self.input['full']).read().splitlines()
+        out, inrem, found, changed = [], False, False, False
+        for line in lines:
+            word = line.strip().lower()
+            if word == '$rem':
+                inrem, found = True, False
+            elif inrem and word == '$end':
+                if not found:
+                    out.append('   MEM_TOTAL {0:d}'.format(int(mem*pp*0.9)))
+                    changed = True
+                inrem = False
+            elif inrem and word.startswith('mem_total'):
+                found = True
+                m = match(r'mem_total\s*=?\s*(\d+)', word, IGNORECASE)
+                if m and int(m.group(1)) > mem * pp:
+                    self.mismatch(line.strip(), 'has {0:d} MB'.format(mem*pp))
+            out.append(line)
+        if changed:
+            self.rewrite_input('\n'.join(out) + '\n')
+
+    def preflight(self):
+        '''Each job of the input needs $molecule and $rem sections, and
+        each section must be closed with $end.'''
+        problems, section, found = [], None, set()
+        with open(self.input['full']) as f:
+            lines = f.read().splitlines() + ['@@@']
+        for n, line in enumerate(lines, 1):
+            word = line.strip().lower()
+            if word == '@@@':
+                if section is not None:
+                    problems.append('${0} is not closed with $end'
+                                    .format(section))
+                problems += ['There is no ${0} section'.format(s) for s in
+                             ('molecule', 'rem') if s not in found]
+                section, found = None, set()
+            elif word == '$end':
+                if section is None:
+                    problems.append('$end without a section on line {0:d}'
+                                    .format(n))
+                section = None
+            elif word.startswith('$'):
+                if section is not None:
+                    problems.append('${0} is not closed with $end'
+                                    .format(section))
+                section = word[1:].split()[0] if word[1:] else ''
+                found.add(section)
+        return problems
+
     def create_script(self, **kwargs):
         '''Write the Q-Chem script to file.'''
         return dedent('''\
           #PBS -e {name}.logfile
 
+          {t_modules}
           module load qchem/4.001
 
-          cat  $PBS_NODEFILE
-          set NN = `cat $PBS_NODEFILE | wc -l`
+          set NN = {pp:d}
           setenv ONEEXE -DONEEXE
 
           cd $PBS_O_WORKDIR
+          {t_compute}
           qchem -pbs -np $NN {inp} {out}
 
           # Remove the temporary file created after the job finishes
           rm TMP
           ''').format(name=self.noext['base'], inp=self.input['base'],
-                      out=self.output['base'])
+                      out=self.output['base'], pp=kwargs['pp'],
+                      **self.phases())
 
 
 class Noscratch(Submittable):
@@ -1391,10 +4986,11 @@ class Noscratch(Submittable):
             stdin, stdout, stderr = self.stdstreams(log=logfile, dn=dev_null)
 
             # Run
-            call(arguments, stderr=stderr, stdout=stdout)
+            status = call(arguments, stderr=stderr, stdout=stdout)
 
             # Clean up
             self.clean(log=logfile, dn=dev_null)
+        return status
 
 
 
@@ -1402,6 +4998,31 @@ class Dalton(Noscratch):
     '''Class that handles the submission of Dalton files.
     It is a subclass of Submittable and overrides some methods.'''
 
+    # Printed at the end of a successful run
+    success_marker = 'Total wall time used in DALTON'
+    # Identify the version of Dalton by where it is installed
+    version_env = ('DALTON', 'DALHOME')
+    # Dalton continues from SIRIUS.RST and RSPVEC with --restart
+    chainable = True
+    unconverged_pattern = r'not converged|convergence not reached'
+    # The SCF iterations, whose gradient norm is the error, and the sets
+    # of response vectors that converged
+    iteration_pattern = r'^@ +[0-9]+ +-[0-9]+\.[0-9]+'
+    scf_error = r'^@ +\d+ +-\d+\.\d+ +(\S+)'
+    scf_target = 1e-5
+    progress_steps = (('response sets', r'SOLUTION VECTORS CONVERGED', None),)
+    # The molecule may be given in its own file
+    companions = ('mol',)
+    # The files needed to restart or analyse a run
+    archive_include = ('SIRIUS.RST', 'SIRIFC',     'molden.inp', 'DALTON.ORB',
+                       'DALTON.MOL', 'DALTON.ERR', 'DALTON.CM',  'DALTON.BAS',
+                       'RSPVEC')
+    # Runs in node-local directories with --bcast
+    bcastable = True
+    # The program run when $DALTON is not set
+    default_program = '/gpfs/group/jensen/dalton-2011/DALTON/bin/lionxg/' \
+                      'dalton_mpi.x'
+
     def __init__(self, host, filename, opts, subopts):
         '''Initiallizes the Dalton submission class'''
         # Initiallize the parent
@@ -1442,19 +5063,122 @@ class Dalton(Noscratch):
         else:
             return None, sys.stdout, sys.stderr
 
+    def scratch_dir(self):
+        '''The directory Dalton runs in.'''
+        from os.path import join
+        return self.work_dir(join(self.host.scratch, self.noext['base']))
+
+    def progress_file(self):
+        '''Dalton writes its output in the scratch directory until the end.
+        A node-local one cannot be read from the login node, so with --bcast
+        the job mirrors the output to the input directory as it grows.'''
+        from os.path import join
+        if self.bcast:
+            return self.output['full']
+        return join(self.scratch_dir(), 'DALTON.OUT')
+
+    def work_memory(self, mem):
+        '''The WRKMEM in words that Dalton is given for mem MB per
+        processor.'''
+        if self.host.name in ('lionxg.rcc.psu.edu', 'lionxf.rcc.psu.edu',):
+            return int(mem * 128 * 1024 / 2)
+        return mem * 128000
+
+    def reconcile_input(self, pp, mem):
+        '''Dalton is told its ranks with NSCM and its memory with WRKMEM by
+        the job, which replaces any that are set where it is submitted.'''
+        for name, value in (('NSCM', pp), ('WRKMEM', self.work_memory(mem))):
+            given = os.environ.get(name)
+            if given is not None and given != str(value):
+                print('Warning: {0}={1} is set, but the job of {2} sets '
+                      '{0}={3:d}'.format(name, given, self.input['base'],
+                                         value), file=sys.stderr)
+
+    def checkpoint_commands(self):
+        '''Copy back the partial output and the restart files.'''
+        from os.path import join
+        scratch = self.scratch_dir()
+        return '\n'.join(['cp {0} {1}'.format(join(scratch, 'DALTON.OUT'),
+                                              self.output['full']),
+                          self.archive_commands(join(self.path,
+                                    self.noext['base']+'.tar.gz'), scratch)])
+
+    def preflight(self):
+        '''The input must be a complete Dalton input, any restart archive
+        must exist, and so must the program.'''
+        from os.path import join
+        problems, section = [], False
+        with open(self.input['full']) as f:
+            lines = [l.strip() for l in f
+                     if l.strip() and not l.startswith(('!', '#'))]
+        if not lines or not lines[0].upper().startswith('**DALTON'):
+            problems.append('The input does not start with **DALTON')
+        if not any(l.upper().startswith(('**END', '*END')) for l in lines):
+            problems.append('The input does not end with **END OF DALTON '
+                            'INPUT')
+        for l in lines:
+            if l.startswith('*'):
+                section = True
+            elif l.startswith('.') and not section:
+                problems.append('Keyword {0} is outside of a section'
+                                .format(l.split()[0]))
+        if self.restart:
+            rstfile = self.restart if '/' in self.restart \
+                      else join(self.path, self.restart)
+            problems += self.missing([rstfile+'.tar.gz'], 'Restart archive')
+        elif self.restartdir:
+            problems += self.missing([join(self.restartdir,
+                                      self.noext['base'].replace('tpa_', ''))
+                                      + '.tar.gz'], 'Restart archive')
+        return problems + self.program_problems('DALTON',
+                                                self.default_program)
+
+    def cache_inputs(self):
+        '''The .mol file and the restart archive given with -r or -R.'''
+        from os.path import join
+        files = Noscratch.cache_inputs(self)
+        if self.restart:
+            files.append((self.restart if '/' in self.restart
+                          else join(self.path, self.restart)) + '.tar.gz')
+        elif self.restartdir:
+            files.append(join(self.restartdir,
+                              self.noext['base'].replace('tpa_', ''))
+                         + '.tar.gz')
+        return files
+
+    def features(self):
+        '''The number of atoms, basis and calculation type of the input.
+        The molecule is read from a .mol file of the same name, if any.'''
+        lines = open(self.input['full']).read().splitlines()
+        calctype = [l.strip().split()[0].upper() for l in lines
+                    if l.strip().startswith('*') and
+                    not l.strip().upper().startswith(('**DALTON', '**END'))]
+        atoms = basis = None
+        try:
+            mol = open('.'.join([self.noext['full'], 'mol'])).read()
+        except IOError:
+            pass
+        else:
+            mol = mol.splitlines()
+            atoms = count_atoms(mol) or None
+            if mol and mol[0].strip().upper() == 'BASIS' and len(mol) > 1:
+                basis = mol[1].strip().upper()
+        return {'atoms': atoms, 'basis': basis,
+                'calctype': ' '.join(calctype) if calctype else None}
+
     def create_script(self, **kwargs):
         '''Write the Dalton script to file.'''
         from os.path import join
         from os import environ
         # Make an explicit scratch directory
-        scratch = join(self.host.scratch, self.noext['base'])
+        scratch = self.scratch_dir()
         # Define the restart section
         restart = restopt = ''
         # Define Dalton location.  Use environment variable if possible
         try:
             dal = environ['DALTON']
         except KeyError:
-            dal = '/gpfs/group/jensen/dalton-2011/DALTON/bin/lionxg/dalton_mpi.x'
+            dal = self.default_program
             print("$DALTON environment variable not defined")
             print("Defaulting to {0}".format(dal))
 
@@ -1474,29 +5198,21 @@ class Dalton(Noscratch):
         # that say the memory cannot be allocated.  Some testing has indicated that
         # setting workmem to half of the memory per processor will work on those
         # clusters.  Values are given to Dalton in megawords.
-        if self.host.name in ('lionxg.rcc.psu.edu', 'lionxf.rcc.psu.edu',):
-            wrkmem = self.mem * 128 * 1024
-            wrkmem = int(wrkmem / 2)
-        else:
-            wrkmem = self.mem * 128000
+        # The memory of the job, if it asked for any
+        mem = kwargs.get('mem') or self.mem or self.host.defaultmem
+        wrkmem = self.work_memory(mem)
         if self.restart:
             if '/' in self.restart:
                 # If the restart file has a path associated with it, use that
                 # rather than where the file was submitted from.  This will
                 # probably only work with the absolute path.
-                restart = dedent('''\
-                  # Explicitly perform the -f flag (Dalton local submission)
-                  tar -x SIRIUS.RST -vzf {rstfile}.tar.gz
-                  tar -x RSPVEC -vzf {rstfile}.tar.gz
-                  ''').format(scratch=scratch, rstfile=self.restart)
+                rstfile = self.restart
             else:
                 # Restart file is in the same directory.
-                restart = dedent('''\
-                  # Explicitly perform the -f flag (Dalton local submission)
-                  tar -x SIRIUS.RST -vzf {dir}/{rstfile}.tar.gz
-                  tar -x RSPVEC -vzf {dir}/{rstfile}.tar.gz
-                  ''').format(scratch=scratch, dir=self.path,
-                              rstfile=self.restart)
+                rstfile = join(self.path, self.restart)
+            # Explicitly perform the -f flag (Dalton local submission)
+            restart = self.restore_commands(rstfile+'.tar.gz',
+                                            ('SIRIUS.RST', 'RSPVEC'))
             restopt = '-f {0}'.format(self.restart)
         # Restart directory.  This either assumes the file is named
         # identically to the filename being run, or that it is named
@@ -1518,37 +5234,55 @@ class Dalton(Noscratch):
                     self.restartdir = self.restartdir + '/' + self.noext['base'].replace("tpa_","")
                 else:
                     self.restartdir = self.restartdir + '/' + self.noext['base']
-            restart = dedent('''\
-              # Explicitly perform the -f flag (Dalton local submission)
-              tar -x SIRIUS.RST -vzf {rstfile}.tar.gz
-              tar -x RSPVEC -vzf {rstfile}.tar.gz
-              ''').format(scratch=scratch, rstfile=self.restartdir)
+            # Explicitly perform the -f flag (Dalton local submission)
+            restart = self.restore_commands(self.restartdir+'.tar.gz',
+                                            ('SIRIUS.RST', 'RSPVEC'))
         else:
             restart, restopt = '', ''
-        # Define files to grab
-        files = ('SIRIUS.RST', 'SIRIFC',     'molden.inp', 'DALTON.ORB',
-                 'DALTON.MOL', 'DALTON.ERR', 'DALTON.CM',  'DALTON.BAS',
-                 'RSPVEC')
+        archive = self.archive_commands(self.noext['base']+'.tar.gz',
+                                        scratch, kwargs.get('pp', 1))
+        # Every node needs the input and the restart files, which are
+        # broadcast from the cache they were extracted to
+        mkdir, cleanup = 'mkdir -p {0}'.format(scratch), 'rm -rf ' + scratch
+        mirror = ''
+        if self.bcast:
+            mkdir = self.bcast_commands([(self.input['full'], 'DALTON.INP')],
+                                        scratch)
+            cleanup = self.bcast_cleanup(scratch)
+            mirror = ('\ntail -n +1 -F --pid=$$ DALTON.OUT > {0} 2>/dev/null &'
+                      .format(self.output['full']))
+            if restart:
+                restart = '\n'.join([restart, self.bcast_commands(
+                              [('$CACHE/$KEY/' + f, f) for f in
+                               ('SIRIUS.RST', 'RSPVEC')], scratch)])
         return dedent('''\
-          mkdir -p {scratch}
-
+          {t_modules}
           module load openmpi/intel/1.6.0
           export WRKMEM={wrkmem:d}
           export NSCM={nscm:d}
 
+          {t_stagein}
+          {mkdir}
           cp {inp} {scratch}/DALTON.INP
-          cd {scratch}
+          cd {scratch}{mirror}
+          {t_restart}
           {restart}
-          mpirun {dal} {restopt}
+          {t_compute}
+          mpirun -np {nscm:d} {dal} {restopt}
+          {t_archive}
+          {archive}
+          {t_copyback}
           cp {scratch}/DALTON.OUT {out}
-          tar -C {scratch} -cvzf {name}.tar.gz {files}
           cp {scratch}/{name}.tar.gz {dir}
           cd {dir}
-          rm -rf {scratch}\
+          {cleanup}\
           ''').format(scratch=scratch, inp=self.input['full'],
+                      mkdir=mkdir, cleanup=cleanup, mirror=mirror,
                       out=self.output['full'], dir=self.path, dal=dal,
-                      wrkmem=wrkmem, nscm=8, name=self.noext['base'],
-                      files=' '.join(files), restopt=restopt, restart=restart)
+                      wrkmem=wrkmem, nscm=kwargs.get('pp', 8),
+                      name=self.noext['base'],
+                      archive=archive, restopt=restopt, restart=restart,
+                      **self.phases())
 
 
 
@@ -1621,21 +5355,26 @@ class POVRay(Noscratch):
 
           cd $TMPDIR
 
+          {t_compute}
           {povray} +L{dir} +L{home}/.povray/3.6/include {opts} {inp} -O{outbase}
 
           # Move image from $TMPDIR to the correct folder'
+          {t_copyback}
           cp $TMPDIR/{outbase} {out}\
           ''').format(name=self.noext['full'], home=environ['HOME'],
                      dir=self.path, inp=self.input['full'],
                      opts=' '.join(self.subopts), out=self.output['full'],
                      povray='/usr/global/povray/3.6.1/bin/povray',
-                     outbase=self.output['base'])
+                     outbase=self.output['base'], **self.phases())
 
 
 class DIM(Noscratch):
     '''Class that handles the submission of DIM files.
     It is a subclass of Submittable and overrides some methods.'''
 
+    # Identify the version of DIM by where it is installed
+    version_env = ('DIM', 'DIMPATH')
+
     def __init__(self, host, filename, opts, subopts):
         '''Initiallizes the DIM submission class'''
 
@@ -1687,21 +5426,24 @@ class DIM(Noscratch):
             dim = '/gpfs/group/jensen/dim/dim.py'
             print("$DIM environment variable not defined")
             print("Defaulting to {0}".format(dim))
-        if self.host.queue == 'lxj18_collab':
+        if self.queue == 'lxj18_collab':
             return dedent('''\
     #PBS -e {name}.err
 
+    {t_modules}
     module load python/2.7.9
     module load openmpi/1.8.4_A
 
+    {t_compute}
     {dim} -n -1 {inp} -o{out} > {name}.logfile
     ''').format(name=self.noext['full'], inp=self.input['full'],
-                out=self.output['full'], dim=dim)
+                out=self.output['full'], dim=dim, **self.phases())
 
         else:
             return dedent('''\
    #PBS -e {name}.err
 
+    {t_modules}
     module purge
     module load intel
     module load mkl impi
@@ -1709,9 +5451,50 @@ class DIM(Noscratch):
 
     export PBS_NODEFILE=$SLURM_JOB_NODELIST
 
+    {t_compute}
     {dim} -n -1 {inp} -o{out} > {name}.logfile
     ''').format(name=self.noext['full'], inp=self.input['full'],
-                out=self.output['full'], dim=dim)
+                out=self.output['full'], dim=dim, **self.phases())
+
+class Shell(Noscratch):
+    '''Class that handles the submission of shell scripts, such as the
+    command steps of a workflow.
+    It is a subclass of Submittable and overrides some methods.'''
+
+    def __init__(self, host, filename, opts, subopts):
+        '''Initiallizes the Shell submission class'''
+        # Initiallize the parent
+        Noscratch.__init__(self, host, filename, opts, subopts)
+        # Commands have side effects, so their results are never reused
+        self.cache = False
+
+    def executable(self):
+        '''The executable to use for interactive jobs.
+        Overrides the base class'''
+        return 'bash'
+
+    def add_input(self, arguments):
+        '''Appends the input files to the executable statement
+        in the appropriate way'''
+        return arguments + [self.input['full']]
+
+    def stdstreams(self, **kwargs):
+        '''Returns the proper standard in, out and error.'''
+        return Submittable.stdstreams(self, **kwargs)
+
+    def preflight(self):
+        '''The script must parse.'''
+        return self.syntax_check(['bash', '-n'])
+
+    def create_script(self, **kwargs):
+        '''Write the shell script to file.'''
+        return dedent('''\
+          cd {dir}
+          {t_compute}
+          bash {inp} > {out}\
+          ''').format(dir=self.path, inp=self.input['full'],
+                      out=self.output['full'], **self.phases())
+
 
 class Host(object):
     '''A base class for a host system.'''
@@ -1735,16 +5518,6 @@ class Host(object):
         from os.path import exists, isfile, getsize
         from os import access, R_OK
 
-        # Set the defaults if requested, but don't override user choices
-        if args.default and self.submit_type == 'queue':
-            # First try and read defaults from a .submitrc
-            self.import_defaults()
-            # Now set defaults
-            args.nodes = args.nodes if args.nodes else self.defaultnodes
-            args.ppn   = args.ppn   if args.ppn   else self.defaultppn
-            args.wall  = args.wall  if args.wall  else self.defaultwall
-            args.mem   = args.mem   if args.mem   else self.defaultmem
-
         # Try to unpack all into nodes, ppn and wall
         try:
             args.nodes, args.ppn, args.wall, args.mem = args.all
@@ -1759,10 +5532,28 @@ class Host(object):
         except (TypeError, AttributeError):
             pass
 
+        # Set the defaults if requested, but don't override user choices.
+        # Remember which were defaulted, since the program may have its own.
+        args.defaulted = []
+        if args.default and self.submit_type == 'queue':
+            # First try and read defaults from a .submitrc
+            self.import_defaults()
+            # Now set defaults
+            for name in ('nodes', 'ppn', 'wall', 'mem'):
+                if not getattr(args, name):
+                    setattr(args, name, getattr(self, 'default'+name))
+                    args.defaulted.append(name)
+
         # ppn of -1 makes no sense with the exact option
         if args.exact and args.ppn == -1:
             sys.exit('--exact not valid with --ppn = -1')
 
+        # Each rank needs at least one core
+        if args.threads < 1:
+            sys.exit('--threads must be at least 1')
+        if args.ppn and args.ppn > 0 and args.ppn % args.threads:
+            sys.exit('--ppn must be a multiple of --threads')
+
         # Make sure the scratch directory is an absolute path
         self.scratch = abs_file_path(args.scratch)
 
@@ -1853,6 +5644,12 @@ class Queue(Host):
         self.local = False
         self.queue_type  = None
 
+        # Bind MPI ranks to cores unless the program says otherwise
+        self.bind = 'cores'
+
+        # Whether scratch is on Lustre, where large files are striped
+        self.lustre = False
+
         # Set default values for jobs.  May be overridden in subclass
         self.defaultnodes = 8
         self.defaultppn   = 1
@@ -1878,7 +5675,10 @@ class Queue(Host):
         from a .submitrc file in $HOME'''
         from os import environ
         from os.path import join
-        from ConfigParser import RawConfigParser
+        try:
+            from configparser import RawConfigParser
+        except ImportError:
+            from ConfigParser import RawConfigParser
 
         # Initiallize the parser with defaults
         defaults = RawConfigParser({'nodes' : self.defaultnodes,
@@ -1893,7 +5693,10 @@ class Queue(Host):
             pass
         # If it succeeds, see if this file has any defaults for this host
         else:
-            defaults.readfp(rc)
+            try:
+                defaults.read_file(rc)
+            except AttributeError:
+                defaults.readfp(rc)
 
             # If this section doesn't exist, quit
             if not defaults.has_section('lionxf'):
@@ -2016,6 +5819,9 @@ class Stampede(Queue):
 
         self.temp = os.path.join('/tmp/')
 
+        # $SCRATCH is a Lustre filesystem
+        self.lustre = True
+
         self.queue_type = 'SBATCH'
 
 # jbb5516 Adding ACIb functionality. will remove comment when debugged
@@ -0,0 +1,304 @@
+'''Tests of submit.py that need no queue or program: the hash and cache of
+inputs, the choice of allocation, the striping of scratch directories and
+the defaults kept in ~/.submitrc.  Run them from the top of the repository
+with "python -m pytest tests" or "python -m unittest discover tests".'''
+from __future__ import print_function
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+from argparse import Namespace
+from contextlib import contextmanager
+from io import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import submit
+
+
+NWCHEM_INPUT = '''\
+start water
+geometry
+ O 0.0 0.0 0.0
+ H 0.0 0.8 0.6
+ H 0.0 -0.8 0.6
+end
+basis
+ * library 6-31g
+end
+task scf
+'''
+
+ADF_INPUT = '''\
+#!/bin/sh
+$ADFBIN/adf << eor
+Atoms
+{atoms}
+End
+Basis
+ Type TZP
+End
+eor
+'''
+
+
+@contextmanager
+def quiet():
+    '''Hide what submit.py prints.'''
+    out, err = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = StringIO(), StringIO()
+    try:
+        yield sys.stdout
+    finally:
+        sys.stdout, sys.stderr = out, err
+
+
+def options(**kwargs):
+    '''The options of the command line, as main gives them to the
+    submittables, with the defaults of submit.py.'''
+    opts = dict(out=None, psp=None, restart=None, restartdir=None,
+                nodes=None, ppn=None, wall=None, mem=None, check_limits=True,
+                debug=False, pid=False, nice=0, quiet=True, script=False,
+                exact=False, open=False, lexclusive=False, dependency=None,
+                spool=False, workflow=None, cache=True, predict=False,
+                grace=300, bind=None, threads=1, chain=None, allocation='o',
+                queue_snapshot=None, bcast=False, defaulted=[])
+    opts.update(kwargs)
+    return Namespace(**opts)
+
+
+class SubmitTestCase(unittest.TestCase):
+    '''Runs each test in its own directory, with its own home, scratch and
+    $SUBMIT_HOME.'''
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.env = dict(os.environ)
+        self.dir = tempfile.mkdtemp()
+        for name in ('home', 'scratch', 'work'):
+            os.mkdir(os.path.join(self.dir, name))
+        os.environ.update(HOME=os.path.join(self.dir, 'home'),
+                          SCRATCH=os.path.join(self.dir, 'scratch'),
+                          SUBMIT_HOME=os.path.join(self.dir, 'submit'),
+                          USER='tester')
+        os.chdir(os.path.join(self.dir, 'work'))
+        submit.choose_allocation.queues = None
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        os.environ.clear()
+        os.environ.update(self.env)
+        shutil.rmtree(self.dir)
+
+    def write(self, name, text):
+        '''Write a file in the working directory and return its path.'''
+        path = os.path.join(self.dir, 'work', name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def job(self, name, text, hostname='login1.hpc.psu.edu', **kwargs):
+        '''The submittable for an input with the given text.'''
+        with quiet():
+            host = submit.determine_host(hostname)
+            return submit.determine_file_type(self.write(name, text), host,
+                                              options(**kwargs), [])
+
+
+class TestInputHash(SubmitTestCase):
+
+    def test_trailing_whitespace_is_ignored(self):
+        a = self.job('a.nw', NWCHEM_INPUT)
+        b = self.job('b.nw', NWCHEM_INPUT.replace('end\n', 'end   \n')
+                                         + '\n\n')
+        self.assertEqual(a.input_hash(), b.input_hash())
+
+    def test_input_and_version_change_the_hash(self):
+        a = self.job('a.nw', NWCHEM_INPUT)
+        b = self.job('b.nw', NWCHEM_INPUT.replace('6-31g', 'cc-pvdz'))
+        self.assertNotEqual(a.input_hash(), b.input_hash())
+        os.environ['NWCHEM'] = '/opt/nwchem-7/bin/nwchem'
+        c = self.job('c.nw', NWCHEM_INPUT)
+        self.assertNotEqual(a.input_hash(), c.input_hash())
+
+    def test_hash_is_kept_until_the_current_one_is_asked_for(self):
+        job = self.job('a.nw', NWCHEM_INPUT)
+        before = job.input_hash()
+        with open(job.input['full'], 'a') as f:
+            f.write('task scf energy\n')
+        self.assertEqual(job.input_hash(), before)
+        self.assertNotEqual(job.input_hash(current=True), before)
+
+
+class TestCache(SubmitTestCase):
+
+    def store(self, job, files):
+        '''Keep results for the input of job, as a finished job would.'''
+        store = job.result_store()
+        os.makedirs(store)
+        for suffix, text in files.items():
+            with open(os.path.join(store, suffix), 'w') as f:
+                f.write(text)
+        with open(os.path.join(store, 'result.json'), 'w') as f:
+            json.dump({'input': '/elsewhere/a.nw', 'files': sorted(files)}, f)
+
+    def test_identical_input_reuses_the_results(self):
+        self.store(self.job('a.nw', NWCHEM_INPUT), {'out': 'Total times\n'})
+        job = self.job('b.nw', NWCHEM_INPUT)
+        with quiet():
+            self.assertTrue(job.from_cache())
+        with open(job.output['full']) as f:
+            self.assertEqual(f.read(), 'Total times\n')
+
+    def test_different_input_misses(self):
+        self.store(self.job('a.nw', NWCHEM_INPUT), {'out': 'Total times\n'})
+        job = self.job('b.nw', NWCHEM_INPUT.replace('scf', 'dft'))
+        self.assertFalse(job.from_cache())
+        self.assertFalse(os.path.exists(job.output['full']))
+
+    def test_no_cache_skips_the_lookup(self):
+        self.store(self.job('a.nw', NWCHEM_INPUT), {'out': 'Total times\n'})
+        job = self.job('b.nw', NWCHEM_INPUT, cache=False)
+        self.assertFalse(job.from_cache())
+
+
+class TestChooseAllocation(SubmitTestCase):
+
+    allocations = {'o': 'open', 'a': 'lxj18_a', 'b': 'lxj18_b'}
+
+    def choose(self, snapshot, cores=4):
+        host = submit.determine_host('login1.hpc.psu.edu')
+        with quiet():
+            return submit.choose_allocation(self.allocations, host, cores,
+                                            self.write('snapshot', snapshot))
+
+    def test_queue_without_pending_jobs_wins(self):
+        self.assertEqual(self.choose('open normal 2030-01-01T00:00:00\n'
+                                     'lxj18_a normal 2030-01-01T00:00:00\n'),
+                         'b')
+
+    def test_earliest_expected_start_wins(self):
+        self.assertEqual(self.choose('open normal 2030-01-01T00:00:00\n'
+                                     'lxj18_a normal 2029-01-01T00:00:00\n'
+                                     'lxj18_b normal 2031-01-01T00:00:00\n'),
+                         'a')
+
+    def test_open_when_nothing_is_known(self):
+        self.assertEqual(self.choose('open normal N/A\n'
+                                     'lxj18_a normal N/A\n'
+                                     'lxj18_b normal N/A\n'), 'o')
+
+    def test_snapshot_is_read_once(self):
+        self.choose('open normal 2030-01-01T00:00:00\n'
+                    'lxj18_a normal 2030-01-01T00:00:00\n')
+        # A second job of the same submission sees the same queue
+        self.assertEqual(self.choose('lxj18_b normal 2030-01-01T00:00:00\n'),
+                         'b')
+
+
+class TestStripe(SubmitTestCase):
+
+    stampede = 'login1.stampede3.tacc.utexas.edu'
+
+    def adf(self, natoms, hostname=stampede, **kwargs):
+        atoms = '\n'.join(' H {0:d}.0 0.0 0.0'.format(i)
+                          for i in range(natoms))
+        return self.job('a.run', ADF_INPUT.format(atoms=atoms), hostname,
+                        **kwargs)
+
+    def test_stripe_grows_with_the_atoms(self):
+        self.assertEqual(self.adf(10).stripe(), (1, '1M'))
+        self.assertEqual(self.adf(100).stripe(), (4, '1M'))
+        self.assertEqual(self.adf(1000).stripe(), (16, '4M'))
+
+    def test_commands_stripe_the_lustre_directory(self):
+        commands = self.adf(100).stripe_commands('/scratch/adf')
+        self.assertIn('df -t lustre /scratch/adf', commands)
+        self.assertIn('lfs setstripe -c 4 -S 1M /scratch/adf', commands)
+
+    def test_submitrc_fixes_the_stripe(self):
+        with open(os.path.join(os.environ['HOME'], '.submitrc'), 'w') as f:
+            f.write('[adf]\nstripe_count = 8\nstripe_size = 4M\n')
+        self.assertIn('lfs setstripe -c 8 -S 4M .',
+                      self.adf(10).stripe_commands())
+
+    def test_no_stripe_off_lustre(self):
+        self.assertEqual(self.adf(100, 'login1.hpc.psu.edu')
+                         .stripe_commands(), '')
+
+    def test_no_stripe_for_nwchem(self):
+        job = self.job('a.nw', NWCHEM_INPUT, self.stampede)
+        self.assertEqual(job.stripe_commands(), '')
+
+
+class TestSubmitrc(SubmitTestCase):
+
+    def submitrc(self):
+        return os.path.join(os.environ['HOME'], '.submitrc')
+
+    def log_jobs(self, n=3):
+        '''Log n NWChem jobs on HPC and return their accounting.'''
+        lines = []
+        for i in range(n):
+            jobid = str(1000 + i)
+            submit.log_job(jobid, {'program': 'NWChem',
+                                   'host': 'login1.hpc.psu.edu',
+                                   'kind': 'single', 'script': 'a.sh',
+                                   'inputs': ['a.nw'], 'outputs': ['a.out'],
+                                   'nodes': 1, 'ppn': 8, 'wall': '4:00:00',
+                                   'mem': 2000})
+            lines.append('{0}|COMPLETED|01:00:00||8|04:00:00'.format(jobid))
+            lines.append('{0}.batch|COMPLETED|01:00:00|1000M|8|'
+                         .format(jobid))
+        return self.write('acct.txt', '\n'.join(lines) + '\n')
+
+    def test_write_backs_up_submitrc(self):
+        with open(self.submitrc(), 'w') as f:
+            f.write('[nwchem]\nwall = 12:00:00\n')
+        with quiet():
+            submit.efficiency(['--accounting', self.log_jobs(), '--write'])
+        with open(self.submitrc() + '.bak') as f:
+            self.assertEqual(f.read(), '[nwchem]\nwall = 12:00:00\n')
+        with open(self.submitrc()) as f:
+            text = f.read()
+        self.assertIn('[nwchem]', text)
+        self.assertIn('[hpc.nwchem]', text)
+        self.assertIn('ppn = 4', text)
+        self.assertIn('wall = 1:15:00', text)
+        self.assertIn('mem = 1200', text)
+
+    def test_no_backup_without_a_submitrc(self):
+        with quiet():
+            submit.efficiency(['--accounting', self.log_jobs(), '--write'])
+        self.assertTrue(os.path.exists(self.submitrc()))
+        self.assertFalse(os.path.exists(self.submitrc() + '.bak'))
+
+    def test_too_few_jobs_write_nothing(self):
+        with quiet():
+            submit.efficiency(['--accounting', self.log_jobs(2), '--write'])
+        self.assertFalse(os.path.exists(self.submitrc()))
+
+    def test_cluster_section_takes_precedence(self):
+        with open(self.submitrc(), 'w') as f:
+            f.write('[nwchem]\nppn = 16\nwall = 12:00:00\n\n'
+                    '[hpc.nwchem]\nppn = 4\n\n'
+                    '[stampede3.nwchem]\nppn = 8\n')
+        job = self.job('a.nw', NWCHEM_INPUT)
+        self.assertEqual(job.program_defaults(),
+                         {'ppn': '4', 'wall': '12:00:00'})
+
+    def test_program_defaults_replace_the_host_defaults(self):
+        with open(self.submitrc(), 'w') as f:
+            f.write('[hpc.nwchem]\nnodes = 2\nppn = 4\nwall = 1:00:00\n'
+                    'mem = 1200\n')
+        job = self.job('a.nw', NWCHEM_INPUT,
+                       defaulted=['nodes', 'ppn', 'wall', 'mem'])
+        with quiet():
+            nodes, ppn, wall, mem = job.request_resources()
+        self.assertEqual((nodes, ppn, mem), (2, 4, 1200))
+        self.assertEqual(job.host.td2hms(wall), '1:00:00')
+
+
+if __name__ == '__main__':
+    unittest.main()